@@ -0,0 +1,89 @@
+"""Current academic year pointer, cached in process.
+
+Nearly every request needs the current year, so the AcademicYear table is read at most
+once per CURRENT_YEAR_TTL seconds per process. Changes made in this process are picked up
+immediately, other processes see them after the TTL.
+"""
+import time
+
+from django.apps import apps
+from django.utils import timezone
+
+
+CURRENT_YEAR_TTL = 60
+
+# Academic years start in August
+FIRST_MONTH = 8
+
+# (years latest first, current year, archived years, expiry on the monotonic clock),
+# replaced as a whole
+_cached = None
+
+
+def academic_year_of(date):
+    """Academic year (by its starting calendar year) a date falls in"""
+    return date.year if date.month >= FIRST_MONTH else date.year - 1
+
+
+def _load():
+    global _cached
+    cached = _cached
+    if cached is not None and time.monotonic() < cached[3]:
+        return cached
+    AcademicYear = apps.get_model('core', 'AcademicYear')
+    rows = list(AcademicYear.objects.values_list('year', 'is_current', 'is_archived'))
+    current = next(
+        (year for year, is_current, _ in rows if is_current),
+        academic_year_of(timezone.localdate()),
+    )
+    years = sorted({current, *(year for year, _, _ in rows)}, reverse=True)
+    archived = frozenset(year for year, _, is_archived in rows if is_archived)
+    _cached = (years, current, archived, time.monotonic() + CURRENT_YEAR_TTL)
+    return _cached
+
+
+def current_year():
+    """Year new payments and every view default to"""
+    return _load()[1]
+
+
+def known_years():
+    """Every academic year, latest first"""
+    return list(_load()[0])
+
+
+def archived_years():
+    """Closed years whose payments live in PaymentArchive"""
+    return _load()[2]
+
+
+def forget_years():
+    """Drop the cached pointer so the next call reads the table again"""
+    global _cached
+    _cached = None
+
+
+def requested_year(value, strict=False):
+    """Academic year from a request parameter, the current one when missing.
+
+    Unknown years also fall back to the current one, or raise ValueError when `strict`.
+    """
+    if value in (None, ''):
+        return current_year()
+    try:
+        year = int(value)
+    except (TypeError, ValueError):
+        year = None
+    if year in _load()[0]:
+        return year
+    if strict:
+        raise ValueError(f'سنة دراسية غير معروفة: {value}')
+    return current_year()
+
+
+def writable_year(value):
+    """Year of a payment write: known and not archived, raises ValueError otherwise"""
+    year = requested_year(value, strict=True)
+    if year in archived_years():
+        raise ValueError(f'السنة {year}/{year + 1} مؤرشفة ولا يمكن تعديلها')
+    return year
@@ -1,5 +1,10 @@
-from django.contrib import admin
-from .models import Grade, Student, Payment
+from django.contrib import admin, messages
+from django.db import transaction
+from django.template.response import TemplateResponse
+from .academic_years import current_year
+from .forms import RepriceForm
+from .models import AcademicYear, ExportJob, Grade, Student, Payment, PaymentArchive
+from .payments import reprice_unpaid_payments
 
 
 @admin.register(Grade)
@@ -7,6 +12,48 @@ class GradeAdmin(admin.ModelAdmin):
     list_display = ['grade', 'grade_name', 'monthly_fee']
     list_editable = ['monthly_fee']
     ordering = ['grade']
+    actions = ['reprice_unpaid']
+
+    @admin.action(description='تطبيق الرسوم الحالية على الأشهر غير المدفوعة')
+    def reprice_unpaid(self, request, queryset):
+        """Show the payments each grade would reprice for a year and first month, reprice on confirmation"""
+        submitted = 'apply' in request.POST or 'preview' in request.POST
+        form = RepriceForm(request.POST if submitted else None)
+        valid = submitted and form.is_valid()
+        if valid:
+            year, from_month = form.cleaned_data['year'], form.cleaned_data['from_month']
+        else:
+            year, from_month = current_year(), Payment.MONTHS[0]
+
+        try:
+            if valid and 'apply' in request.POST:
+                with transaction.atomic():
+                    repriced = sum(reprice_unpaid_payments(grade, year, from_month) for grade in queryset)
+                self.message_user(request, f'تم تحديث مبلغ {repriced} دفعة غير مدفوعة', messages.SUCCESS)
+                return None
+            grades = [
+                (grade, reprice_unpaid_payments(grade, year, from_month, dry_run=True)) for grade in queryset
+            ]
+        except ValueError as e:
+            self.message_user(request, str(e), messages.ERROR)
+            return None
+        return TemplateResponse(request, 'admin/core/grade/reprice.html', {
+            **self.admin_site.each_context(request),
+            'title': 'تطبيق الرسوم على الأشهر غير المدفوعة',
+            'opts': self.model._meta,
+            'form': form,
+            'grades': grades,
+            'queryset': queryset,
+            'action_checkbox_name': admin.helpers.ACTION_CHECKBOX_NAME,
+        })
+
+
+@admin.register(AcademicYear)
+class AcademicYearAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'year', 'is_current', 'is_archived']
+    ordering = ['-year']
+    # Set by the rollover_year command together with moving the payments
+    readonly_fields = ['is_archived']
 
 
 @admin.register(Student)
@@ -16,6 +63,10 @@ class StudentAdmin(admin.ModelAdmin):
     search_fields = ['full_name', 'father_phone_number']
     list_editable = ['is_exempt']
     ordering = ['full_name']
+
+    def get_search_results(self, request, queryset, search_term):
+        # Normalized, indexed search instead of icontains on each search field
+        return queryset.search(search_term), False
     
     fieldsets = (
         ('معلومات أساسية', {
@@ -37,6 +88,11 @@ class PaymentAdmin(admin.ModelAdmin):
     search_fields = ['student__full_name']
     list_editable = ['is_paid']
     ordering = ['-year', 'month', 'student__full_name']
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        return queryset.filter(student__in=Student.objects.search(search_term)), False
     
     fieldsets = (
         ('معلومات الدفع', {
@@ -50,6 +106,40 @@ class PaymentAdmin(admin.ModelAdmin):
     readonly_fields = ['paid_at']
 
 
+@admin.register(PaymentArchive)
+class PaymentArchiveAdmin(admin.ModelAdmin):
+    list_display = ['student', 'month', 'year', 'amount', 'is_paid', 'paid_at', 'archived_at']
+    list_filter = ['year', 'month', 'is_paid']
+    ordering = ['-year', 'month', 'student__full_name']
+    list_select_related = ['student']
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        return queryset.filter(student__in=Student.objects.search(search_term)), False
+
+    # Archived years are read-only
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'kind', 'status', 'rows', 'created_at', 'started_at', 'finished_at']
+    list_filter = ['status', 'kind']
+    readonly_fields = ['kind', 'params', 'file_name', 'rows', 'error', 'created_at', 'started_at', 'finished_at']
+
+    # Jobs are queued from the students list
+    def has_add_permission(self, request):
+        return False
+
+
 # Customize admin site
 admin.site.site_header = "نظام إدارة الطلاب - الأستاذ محمد علي"
 admin.site.site_title = "إدارة الطلاب"
@@ -0,0 +1,292 @@
+"""Benchmark harness driving the views through the test client.
+
+Each view is requested repeatedly against a seeded dataset, recording wall time, query
+count, rows fetched from the database and peak Python memory. Query plans of the main
+access patterns can be compared with and without the tuned indexes.
+"""
+import math
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.models import Count, Sum
+from django.db.backends.utils import CursorDebugWrapper
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .academic_years import current_year
+from .models import Grade, Payment, Student
+
+
+# Keep benchmark runs away from the project's cache directory
+BENCH_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'core-bench',
+    }
+}
+
+
+class RowCountingCursor(CursorDebugWrapper):
+    """Debug cursor that also counts every row handed back to Python"""
+
+    def __init__(self, cursor, db, counter):
+        super().__init__(cursor, db)
+        self.counter = counter
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.counter['rows'] += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self.counter['rows'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.counter['rows'] += len(rows)
+        return rows
+
+    def __iter__(self):
+        with self.db.wrap_database_errors:
+            for row in self.cursor:
+                self.counter['rows'] += 1
+                yield row
+
+
+@contextmanager
+def capture_database(conn=connection):
+    """Yield a dict holding the queries and rows fetched on `conn` inside the block"""
+    counter = {'rows': 0, 'queries': 0}
+    conn.make_debug_cursor = lambda cursor: RowCountingCursor(cursor, conn, counter)
+    try:
+        with CaptureQueriesContext(conn) as queries:
+            yield counter
+    finally:
+        del conn.make_debug_cursor
+    counter['queries'] = len(queries.captured_queries)
+
+
+@contextmanager
+def use_database(settings_dict):
+    """Point the default connection at another database inside the block"""
+    original = connections.settings[DEFAULT_DB_ALIAS]
+
+    def switch(config):
+        connections[DEFAULT_DB_ALIAS].close()
+        connections.settings[DEFAULT_DB_ALIAS] = config
+        del connections[DEFAULT_DB_ALIAS]
+
+    switch(connections.configure_settings({DEFAULT_DB_ALIAS: settings_dict})[DEFAULT_DB_ALIAS])
+    try:
+        yield connections[DEFAULT_DB_ALIAS]
+    finally:
+        switch(original)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+def _consume(response):
+    """Read the whole body so streamed responses are measured end to end"""
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    return response
+
+
+def view_scenarios():
+    """(name, request function) for every benchmarked view.
+
+    Request functions take the client and the iteration number, so detail and update
+    requests rotate over students instead of hitting one row.
+    """
+    grade_codes = [code for code, _ in Grade.GRADE_CHOICES]
+    student_ids = list(Student.objects.order_by('?').values_list('id', flat=True)[:100])
+    months = Payment.MONTHS
+    # Current state of the cells update_payment rotates over, kept up to date as it flips them
+    paid = {
+        (student_id, month): is_paid
+        for student_id, month, is_paid in Payment.objects.filter(
+            student_id__in=student_ids, year=current_year()
+        ).values_list('student_id', 'month', 'is_paid')
+    }
+
+    def dashboard(client, i):
+        return client.get(reverse('core:dashboard'))
+
+    def students_list(client, i):
+        return client.get(reverse('core:students_list'), {'grades': grade_codes})
+
+    def student_detail(client, i):
+        return client.get(reverse('core:student_detail', args=[student_ids[i % len(student_ids)]]))
+
+    def update_payment(client, i):
+        cell = (student_ids[i % len(student_ids)], months[i % len(months)])
+        # Send the opposite of the stored state so every request really flips a cell
+        paid[cell] = not paid.get(cell, False)
+        return client.post(
+            reverse('core:update_payment'),
+            {'student_id': cell[0], 'month': cell[1], 'is_paid': paid[cell]},
+            content_type='application/json',
+        )
+
+    def monthly_revenue(client, i):
+        return client.get(reverse('core:monthly_revenue'), {'month': months[i % len(months)]})
+
+    def revenue_matrix(client, i):
+        return client.get(reverse('core:revenue_matrix'), {'grades': grade_codes})
+
+    def export_students_csv(client, i):
+        return client.get(reverse('core:export_students_csv'), {'grades': grade_codes})
+
+    return [
+        ('dashboard', dashboard),
+        ('students_list', students_list),
+        ('student_detail', student_detail),
+        ('update_payment', update_payment),
+        ('monthly_revenue', monthly_revenue),
+        ('revenue_matrix', revenue_matrix),
+        ('export_students_csv', export_students_csv),
+    ]
+
+
+def run_view(request, repeat, warm_cache=False):
+    """Latency percentiles, queries, rows fetched and peak memory of one view"""
+    client = Client()
+    timings, queries, rows = [], [], []
+
+    for i in range(repeat):
+        if not warm_cache:
+            cache.clear()
+        with capture_database() as counter:
+            started = time.perf_counter()
+            response = _consume(request(client, i))
+            timings.append((time.perf_counter() - started) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError(f'{response.request["PATH_INFO"]} returned {response.status_code}')
+        queries.append(counter['queries'])
+        rows.append(counter['rows'])
+
+    # Measured apart from the timings, tracemalloc slows every allocation down
+    if not warm_cache:
+        cache.clear()
+    tracemalloc.start()
+    try:
+        _consume(request(client, repeat))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'requests': repeat,
+        'p50_ms': round(percentile(timings, 50), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'mean_ms': round(sum(timings) / len(timings), 2),
+        'queries': max(queries),
+        'rows_fetched': max(rows),
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+
+def scaling_exponents(results):
+    """How p50 latency grows between consecutive dataset sizes, per view.
+
+    An exponent near 0 means flat, near 1 means linear in the number of students.
+    """
+    by_view = {}
+    for result in results:
+        # Runs against several databases are scaled per database
+        view = result['view'] if 'database' not in result else f'{result["database"]}:{result["view"]}'
+        by_view.setdefault(view, []).append(result)
+
+    scaling = {}
+    for view, runs in by_view.items():
+        runs.sort(key=lambda run: run['students'])
+        scaling[view] = [
+            {
+                'from': small['students'],
+                'to': large['students'],
+                'p50_exponent': round(
+                    math.log(large['p50_ms'] / small['p50_ms']) / math.log(large['students'] / small['students']), 2
+                ),
+            }
+            for small, large in zip(runs, runs[1:])
+            if small['p50_ms'] > 0 and large['students'] > small['students']
+        ]
+    return scaling
+
+
+def plan_queries():
+    """Querysets of the access patterns the Payment and Student indexes are tuned for"""
+    year = current_year()
+    grade = Grade.objects.order_by('grade').first()
+    student_ids = list(Student.objects.filter(grade=grade).values_list('id', flat=True)[:50])
+    return {
+        'monthly_revenue': Payment.objects.filter(month='april', year=year, is_paid=True).values(
+            'student__grade__grade'
+        ).annotate(total_revenue=Sum('amount'), student_count=Count('student', distinct=True)),
+        'students_year_totals': Payment.objects.filter(
+            student_id__in=student_ids, year=year, is_paid=True
+        ).values('student_id').annotate(total=Sum('amount')),
+        'grade_students_by_name': Student.objects.filter(grade=grade).order_by('full_name')[:50],
+        'unpaid_in_month': Payment.objects.filter(
+            year=year, month='april', is_paid=False
+        ).values_list('student_id', flat=True),
+    }
+
+
+def tuned_indexes():
+    """(model, index) of every index declared in Meta.indexes of the core models"""
+    return [(model, index) for model in (Payment, Student) for index in model._meta.indexes]
+
+
+def _explain(queryset, label):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        # The trailing comment stops SQLite from reusing a plan prepared before the
+        # indexes were dropped
+        cursor.execute(f'{connection.ops.explain_query_prefix()} {sql} -- {label}', params)
+        return '\n'.join(' '.join(map(str, row)) for row in cursor.fetchall())
+
+
+def _plans(queries, repeat, label):
+    plans = {}
+    for name, queryset in queries.items():
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            list(queryset.all())
+            timings.append((time.perf_counter() - started) * 1000)
+        plans[name] = {'plan': _explain(queryset, label), 'p50_ms': round(percentile(timings, 50), 2)}
+    return plans
+
+
+def explain_plans(repeat=5):
+    """EXPLAIN output and p50 time of each access pattern, before and after the indexes.
+
+    The "before" side drops the indexes inside a transaction that is rolled back.
+    """
+    queries = plan_queries()
+    after = _plans(queries, repeat, 'after')
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            for model, index in tuned_indexes():
+                cursor.execute(f'DROP INDEX {connection.ops.quote_name(index.name)}')
+        before = _plans(queries, repeat, 'before')
+        transaction.set_rollback(True)
+
+    return {
+        name: {'before': before[name], 'after': after[name]}
+        for name in queries
+    }
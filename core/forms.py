@@ -1,5 +1,6 @@
 from django import forms
-from .models import Student, Grade
+from .academic_years import archived_years, current_year, known_years
+from .models import Payment, Student, Grade
 
 
 class StudentForm(forms.ModelForm):
@@ -36,4 +37,73 @@ class StudentForm(forms.ModelForm):
         # Make all fields required except is_exempt
         for field_name, field in self.fields.items():
             if field_name != 'is_exempt':
-                field.required = True
\ No newline at end of file
+                field.required = True
+
+
+class BulkEnrollmentForm(forms.Form):
+    """Form for enrolling many students of one grade at once"""
+    
+    grade = forms.ModelChoiceField(
+        queryset=Grade.objects.all(),
+        label='الصف',
+        widget=forms.Select(attrs={
+            'class': 'w-full border border-gray-300 rounded-md px-3 py-2'
+        })
+    )
+    students = forms.CharField(
+        label='الطلاب',
+        help_text='طالب في كل سطر: الاسم الكامل، رقم هاتف الأب',
+        widget=forms.Textarea(attrs={
+            'class': 'w-full border border-gray-300 rounded-md px-3 py-2',
+            'rows': 12,
+            'placeholder': 'أحمد محمد علي، 01234567890'
+        })
+    )
+    is_exempt = forms.BooleanField(
+        label='معفي من الحسابات',
+        required=False,
+        widget=forms.CheckboxInput(attrs={
+            'class': 'w-4 h-4 text-blue-600 bg-gray-100 border-gray-300 rounded focus:ring-blue-500'
+        })
+    )
+    
+    def clean_students(self):
+        """Parse one 'name, phone' pair per line (Arabic comma or tab also accepted)"""
+        name_length = Student._meta.get_field('full_name').max_length
+        phone_length = Student._meta.get_field('father_phone_number').max_length
+        
+        rows = []
+        for line_number, line in enumerate(self.cleaned_data['students'].splitlines(), start=1):
+            line = line.strip()
+            if not line:
+                continue
+            parts = [part.strip() for part in line.replace('،', ',').replace('\t', ',').rsplit(',', 1)]
+            if len(parts) != 2 or not all(parts):
+                raise forms.ValidationError(f'السطر {line_number}: يجب كتابة الاسم ثم رقم الهاتف مفصولين بفاصلة')
+            full_name, phone = parts
+            if len(full_name) > name_length or len(phone) > phone_length:
+                raise forms.ValidationError(f'السطر {line_number}: الاسم أو رقم الهاتف أطول من المسموح')
+            rows.append((full_name, phone))
+        
+        if not rows:
+            raise forms.ValidationError('يرجى إدخال طالب واحد على الأقل')
+        return rows
+
+
+class RepriceForm(forms.Form):
+    """Year and first month of the unpaid payments repriced by the GradeAdmin action"""
+    
+    year = forms.TypedChoiceField(label='السنة الدراسية', coerce=int)
+    from_month = forms.ChoiceField(
+        label='من شهر',
+        choices=Payment.MONTH_CHOICES,
+        help_text='تطبق الرسوم الحالية للصف على الأشهر غير المدفوعة من هذا الشهر حتى يونيو'
+    )
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        archived = archived_years()
+        self.fields['year'].choices = [
+            (year, f'{year}/{year + 1}') for year in known_years() if year not in archived
+        ]
+        self.fields['year'].initial = current_year()
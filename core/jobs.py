@@ -0,0 +1,150 @@
+"""Database-backed queue of background exports, drained by the run_workers command.
+
+A job is claimed with a compare-and-set UPDATE on its status, so any number of worker
+processes, on any database backend, can poll the same table without running a job twice.
+CSV and XLSX files are written under EXPORT_ROOT to a temporary name and renamed once
+complete.
+"""
+import csv
+import logging
+import os
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.utils import timezone
+
+from .academic_years import requested_year
+from .models import ExportJob, Student
+from .reports import csv_rows, xlsx_sheets
+from .routers import read_alias
+from .stats_cache import grade_scope
+from .xlsx import Workbook
+
+
+logger = logging.getLogger('core.jobs')
+
+# Pending jobs looked at per claim attempt, others may be taken by concurrent workers
+CLAIM_BATCH = 10
+
+
+def export_root():
+    return Path(settings.EXPORT_ROOT)
+
+
+def enqueue_students_export(kind, selected_grades, year):
+    """Queue the `kind` export of the students of `selected_grades` for `year`"""
+    return ExportJob.objects.create(kind=kind, params={'grades': list(selected_grades), 'year': year})
+
+
+def claim_next_job():
+    """Oldest pending job, marked running for this worker, or None when the queue is empty"""
+    pending = ExportJob.objects.filter(status=ExportJob.PENDING).order_by('created_at', 'id')
+    for job_id in pending.values_list('id', flat=True)[:CLAIM_BATCH]:
+        claimed = ExportJob.objects.filter(id=job_id, status=ExportJob.PENDING).update(
+            status=ExportJob.RUNNING, started_at=timezone.now()
+        )
+        if claimed:
+            return ExportJob.objects.get(id=job_id)
+    return None
+
+
+def run_job(job):
+    """Run a claimed job and record its outcome, errors are stored on the job, never raised"""
+    try:
+        job.file_name, job.rows = EXPORTERS[job.kind](job)
+    except Exception as e:
+        logger.exception('Export job %s failed', job.pk)
+        job.status = ExportJob.FAILED
+        job.error = str(e)
+    else:
+        job.status = ExportJob.DONE
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'file_name', 'rows', 'error', 'finished_at'])
+    return job
+
+
+def download_name(job):
+    """File name offered to the browser"""
+    return f"students_data_{job.params['year']}.{EXTENSIONS[job.kind]}"
+
+
+def _students_export(job):
+    """Students queryset, year and read database of a students export job"""
+    selected_grades = job.params.get('grades', [])
+    year = requested_year(job.params.get('year'), strict=True)
+    students_qs = Student.objects.select_related('grade').for_grades(selected_grades)
+    return students_qs, year, read_alias(grade_scope(selected_grades))
+
+
+def _file_name(job):
+    return f"students_data_{job.params.get('year')}_{job.pk}.{EXTENSIONS[job.kind]}"
+
+
+@contextmanager
+def _export_file(job, mode, **kwargs):
+    """Open the file of `job` under EXPORT_ROOT, renamed into place only once complete"""
+    root = export_root()
+    root.mkdir(parents=True, exist_ok=True)
+    partial = root / f'{_file_name(job)}.part'
+    try:
+        with open(partial, mode, **kwargs) as output:
+            yield output
+        os.replace(partial, root / _file_name(job))
+    finally:
+        partial.unlink(missing_ok=True)
+
+
+def export_students_csv(job):
+    """Write the students CSV of `job`, returns (file name, data rows)"""
+    students_qs, year, using = _students_export(job)
+    rows = -1  # Not counting the header
+    # BOM for proper Arabic display in Excel
+    with _export_file(job, 'w', encoding='utf-8-sig', newline='') as output:
+        writer = csv.writer(output)
+        # No progress writes here: on SQLite a write while the export's cursor is
+        # still open fails once another worker has committed (stale WAL snapshot)
+        for rows, row in enumerate(csv_rows(students_qs, year, using=using)):
+            writer.writerow(row)
+    return _file_name(job), rows
+
+
+def export_students_xlsx(job):
+    """Write the students workbook of `job`, one sheet per grade; returns (file name, data rows)"""
+    students_qs, year, using = _students_export(job)
+    rows = 0
+    with _export_file(job, 'wb') as output, Workbook(output) as workbook:
+        for title, widths, sheet_rows in xlsx_sheets(students_qs, year, using=using):
+            # Not counting the header and totals rows
+            rows += workbook.write_sheet(title, sheet_rows, widths) - 2
+    return _file_name(job), rows
+
+
+EXPORTERS = {
+    ExportJob.STUDENTS_CSV: export_students_csv,
+    ExportJob.STUDENTS_XLSX: export_students_xlsx,
+}
+
+EXTENSIONS = {
+    ExportJob.STUDENTS_CSV: 'csv',
+    ExportJob.STUDENTS_XLSX: 'xlsx',
+}
+
+
+def requeue_stale(seconds):
+    """Put jobs running for more than `seconds` back in the queue, their worker died"""
+    started_before = timezone.now() - timedelta(seconds=seconds)
+    return ExportJob.objects.filter(status=ExportJob.RUNNING, started_at__lt=started_before).update(
+        status=ExportJob.PENDING, started_at=None
+    )
+
+
+def purge_expired(seconds):
+    """Delete finished jobs older than `seconds` together with their files"""
+    expired = ExportJob.objects.filter(
+        status__in=[ExportJob.DONE, ExportJob.FAILED], finished_at__lt=timezone.now() - timedelta(seconds=seconds)
+    )
+    for file_name in expired.exclude(file_name='').values_list('file_name', flat=True):
+        (export_root() / file_name).unlink(missing_ok=True)
+    return expired.delete()[0]
@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from core.academic_years import current_year
+from core.sample_data import clear_students, generate_students
+
+
+class Command(BaseCommand):
+    help = 'Generate a large synthetic dataset of students and payments for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=10000, help='Number of students to create')
+        parser.add_argument(
+            '--years', type=int, nargs='+',
+            help='Academic years to create payments for (e.g. --years 2023 2024 2025), default the current one'
+        )
+        parser.add_argument('--paid-ratio', type=float, default=0.7, help='Share of paid months (0-1)')
+        parser.add_argument('--exempt-ratio', type=float, default=0.02, help='Share of exempt students (0-1)')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, the same seed gives the same data')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Students inserted per batch')
+        parser.add_argument('--clear', action='store_true', help='Delete existing students and payments first')
+
+    def handle(self, *args, **options):
+        if options['students'] < 1:
+            raise CommandError('--students must be positive')
+        for ratio in ('paid_ratio', 'exempt_ratio'):
+            if not 0 <= options[ratio] <= 1:
+                raise CommandError(f'--{ratio.replace("_", "-")} must be between 0 and 1')
+
+        options['years'] = options['years'] or [current_year()]
+
+        if options['clear']:
+            self.stdout.write('Deleting existing students...')
+            clear_students()
+
+        self.stdout.write(f'Creating {options["students"]} students for {options["years"]}...')
+        started = time.perf_counter()
+
+        created = generate_students(
+            options['students'],
+            options['years'],
+            paid_ratio=options['paid_ratio'],
+            exempt_ratio=options['exempt_ratio'],
+            seed=options['seed'],
+            batch_size=options['batch_size'],
+            progress=lambda count: self.stdout.write(f'  {count} students'),
+        )
+
+        elapsed = time.perf_counter() - started
+        payments = created * len(options['years']) * 11
+        self.stdout.write(
+            self.style.SUCCESS(f'Created {created} students and {payments} payments in {elapsed:.1f}s')
+        )
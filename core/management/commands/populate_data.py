@@ -1,4 +1,5 @@
 from django.core.management.base import BaseCommand
+from core.academic_years import current_year
 from core.models import Grade, Student, Payment
 import random
 
@@ -65,6 +66,7 @@ class Command(BaseCommand):
             }
         ]
         
+        year = current_year()
         for student_data in students_data:
             grade = Grade.objects.get(grade=student_data['grade'])
             student, created = Student.objects.get_or_create(
@@ -88,7 +90,7 @@ class Command(BaseCommand):
                     Payment.objects.create(
                         student=student,
                         month=month,
-                        year=2025,
+                        year=year,
                         amount=grade.monthly_fee,
                         is_paid=is_paid
                     )
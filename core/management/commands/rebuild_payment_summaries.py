@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from core.models import PaymentSummary
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-student payment summaries from the payments and archived payments tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=2000,
+            help='Number of summary rows inserted per statement'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding payment summaries...')
+        
+        PaymentSummary.objects.rebuild(batch_size=options['batch_size'])
+        
+        self.stdout.write(
+            self.style.SUCCESS(f'Successfully rebuilt {PaymentSummary.objects.count()} payment summaries!')
+        )
@@ -0,0 +1,70 @@
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core.academic_years import current_year
+from core.models import Grade, Payment
+from core.payments import reprice_unpaid_payments
+
+
+def _fee(value):
+    """A finite amount that fits Grade.monthly_fee"""
+    field = Grade._meta.get_field('monthly_fee')
+    try:
+        fee = Decimal(value)
+    except InvalidOperation:
+        raise CommandError(f'Invalid fee: {value}')
+    if not fee.is_finite():
+        raise CommandError(f'Invalid fee: {value}')
+    try:
+        field.run_validators(fee)
+    except ValidationError:
+        raise CommandError(
+            f'Invalid fee: {value}, at most {field.max_digits} digits with {field.decimal_places} decimal places'
+        )
+    return fee
+
+
+class Command(BaseCommand):
+    help = "Charge a grade's monthly fee for its unpaid months from a given month to June"
+
+    def add_arguments(self, parser):
+        grades = [code for code, _ in Grade.GRADE_CHOICES]
+        parser.add_argument('grades', nargs='+', choices=grades + ['all'], help='Grade codes, or all')
+        parser.add_argument(
+            '--from-month', required=True, choices=Payment.MONTHS, help='First month charged at the new fee'
+        )
+        parser.add_argument(
+            '--fee', type=_fee,
+            help="New monthly fee, saved on the grades (default: each grade's current monthly fee)"
+        )
+        parser.add_argument('--year', type=int, help='Academic year (default: the current one)')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the payments that would change')
+
+    def handle(self, *args, **options):
+        year = options['year'] or current_year()
+        grades = Grade.objects.all()
+        if 'all' not in options['grades']:
+            grades = grades.filter(grade__in=options['grades'])
+
+        fee = options['fee']
+        total = 0
+        try:
+            with transaction.atomic():
+                for grade in grades:
+                    if fee is not None and not options['dry_run']:
+                        grade.monthly_fee = fee
+                        grade.save(update_fields=['monthly_fee'])
+                    count = reprice_unpaid_payments(
+                        grade, year, options['from_month'], fee=fee, dry_run=options['dry_run']
+                    )
+                    total += count
+                    verb = 'Would reprice' if options['dry_run'] else 'Repriced'
+                    self.stdout.write(f'{verb} {count} unpaid payments of {grade}')
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f'Repriced {total} payments of {year}/{year + 1}'))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.academic_years import current_year
+from core.rollover import missing_schedule_count, roll_over, years_to_archive
+
+
+class Command(BaseCommand):
+    help = "Open the next academic year for every student and archive the closed years' payments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int, help='Year to open (default: the year after the current one)')
+        parser.add_argument(
+            '--keep', type=int, default=1,
+            help='Previous years kept in the payments table next to the new one'
+        )
+        parser.add_argument(
+            '--no-make-current', action='store_true',
+            help='Schedule the year without making it the current one'
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would change')
+
+    def handle(self, *args, **options):
+        new_year = options['year'] or current_year() + 1
+        if options['keep'] < 0:
+            raise CommandError('--keep must not be negative')
+        to_archive = years_to_archive(new_year, options['keep'])
+
+        if options['dry_run']:
+            self.stdout.write(f'{missing_schedule_count(new_year)} payments to schedule for {new_year}/{new_year + 1}')
+            self.stdout.write(f'Years to archive: {", ".join(map(str, to_archive)) or "none"}')
+            return
+
+        try:
+            result = roll_over(new_year, keep=options['keep'], make_current=not options['no_make_current'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(f'Scheduled {result["scheduled"]} payments for {new_year}/{new_year + 1}')
+        for year, moved in result['archived'].items():
+            self.stdout.write(f'Archived {moved} payments of {year}/{year + 1}')
+        self.stdout.write(self.style.SUCCESS('Rollover complete!'))
@@ -0,0 +1,127 @@
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from core.jobs import claim_next_job, purge_expired, requeue_stale, run_job
+
+
+logger = logging.getLogger('core.jobs')
+
+
+def _maintain(requeue_after):
+    """Requeue the jobs of dead workers and purge expired exports, returns both counts"""
+    return requeue_stale(requeue_after), purge_expired(settings.EXPORT_RETENTION_SECONDS)
+
+
+def _work(stop, poll_interval, once, requeue_after, maintenance_interval):
+    """Run queued jobs until `stop` is set, or the queue is empty when `once`. Returns jobs run.
+
+    Stale jobs are requeued and expired exports purged every `maintenance_interval` seconds.
+    """
+    done = 0
+    next_maintenance = time.monotonic() + maintenance_interval
+    while not stop.is_set():
+        if time.monotonic() >= next_maintenance:
+            requeued, purged = _maintain(requeue_after)
+            if requeued or purged:
+                logger.info('Requeued %s stale jobs, purged %s expired jobs', requeued, purged)
+            next_maintenance = time.monotonic() + maintenance_interval
+        job = claim_next_job()
+        if job is None:
+            if once:
+                break
+            stop.wait(poll_interval)
+            continue
+        run_job(job)
+        done += 1
+    return done
+
+
+def _run_child(stop, *args):
+    # Never share the parent's database handle across fork
+    connections.close_all()
+    # The parent handles Ctrl-C and SIGTERM by setting `stop`
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        _work(stop, *args)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Run queued background exports in a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count() or 1, help='Worker processes (default: CPU count)'
+        )
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between polls of an empty queue')
+        parser.add_argument(
+            '--requeue-after', type=int, default=3600, help='Requeue jobs running for longer, in seconds'
+        )
+        parser.add_argument(
+            '--maintenance-interval', type=float, default=300,
+            help='Seconds between requeues of stale jobs and purges of expired exports'
+        )
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        if processes < 1 or options['poll_interval'] <= 0 or options['maintenance_interval'] <= 0:
+            raise CommandError('--processes, --poll-interval and --maintenance-interval must be positive')
+
+        requeued, purged = _maintain(options['requeue_after'])
+        if requeued or purged:
+            self.stdout.write(f'Requeued {requeued} stale jobs, purged {purged} expired jobs')
+
+        if processes == 1:
+            stop = multiprocessing.Event()
+            try:
+                done = _work(stop, *self.work_args(options))
+            except KeyboardInterrupt:
+                return
+            self.stdout.write(self.style.SUCCESS(f'Ran {done} jobs'))
+            return
+
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise CommandError('run_workers needs the fork start method for more than one process')
+        self.run_pool(processes, options)
+
+    @staticmethod
+    def work_args(options):
+        return (
+            options['poll_interval'], options['once'], options['requeue_after'], options['maintenance_interval']
+        )
+
+    def run_pool(self, processes, options):
+        context = multiprocessing.get_context('fork')
+        stop = context.Event()
+        workers = [
+            context.Process(target=_run_child, args=(stop, *self.work_args(options)))
+            for _ in range(processes)
+        ]
+
+        previous = signal.signal(signal.SIGTERM, lambda *args: stop.set())
+        connections.close_all()
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f'Started {processes} workers')
+        try:
+            for worker in workers:
+                # Short timeouts keep the parent responsive to signals
+                while worker.is_alive():
+                    worker.join(timeout=1)
+        except KeyboardInterrupt:
+            stop.set()
+            for worker in workers:
+                worker.join()
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+        self.stdout.write(self.style.SUCCESS('Workers stopped'))
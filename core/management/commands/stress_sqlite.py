@@ -0,0 +1,174 @@
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections, transaction
+from django.test.utils import override_settings
+
+from core.academic_years import current_year, forget_years
+from core.bench import BENCH_CACHES, percentile, use_database
+from core.models import Grade, Payment, Student
+from core.payments import toggle_payment
+from core.reports import compute_dashboard_stats
+from core.sample_data import generate_students
+from src.database import parse_database_url
+
+
+# Stock SQLite behaviour: rollback journal, deferred transactions, the sqlite3 module's
+# 5 s busy timeout
+BASELINE = {'pragmas': {}, 'options': {}}
+
+
+def _tuned():
+    """The project's settings: SQLITE_PRAGMAS and BEGIN IMMEDIATE"""
+    return {'pragmas': settings.SQLITE_PRAGMAS, 'options': {'transaction_mode': 'IMMEDIATE'}}
+
+
+def _writer(seed, writes, student_ids, latencies):
+    """Flip random payment cells like concurrent update_payment requests"""
+    rng = random.Random(seed)
+    year = current_year()
+    students = Student.objects.select_related('grade').in_bulk(student_ids)
+    errors = 0
+    for _ in range(writes):
+        student = students[rng.choice(student_ids)]
+        started = time.perf_counter()
+        try:
+            toggle_payment(student, rng.choice(Payment.MONTHS), year, rng.random() < 0.5)
+        except OperationalError:
+            errors += 1
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+    return errors
+
+
+def _reader(reads, in_transaction, latencies):
+    """Dashboard totals, read from the database (not the cache) while the writers run.
+
+    `in_transaction` reads inside an atomic block, like the admin's change forms: with
+    BEGIN IMMEDIATE that block queues for the write lock too.
+    """
+    grade_codes = [code for code, _ in Grade.GRADE_CHOICES]
+    year = current_year()
+    errors = 0
+    for _ in range(reads):
+        started = time.perf_counter()
+        try:
+            if in_transaction:
+                with transaction.atomic():
+                    compute_dashboard_stats(grade_codes, year)
+            else:
+                compute_dashboard_stats(grade_codes, year)
+        except OperationalError:
+            errors += 1
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+    return errors
+
+
+def _run_child(results, kind, target, *args):
+    """Run `target` in a forked process and report (kind, latencies, errors) to the parent"""
+    # Never share the parent's SQLite handle across fork
+    connections.close_all()
+    latencies, errors = [], None
+    try:
+        errors = target(*args, latencies)
+    finally:
+        connections.close_all()
+        # Always report, the parent waits for one result per process
+        results.put((kind, latencies, 1 if errors is None else errors))
+
+
+class Command(BaseCommand):
+    help = 'Hammer a scratch SQLite database with concurrent payment writers, stock versus tuned settings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent writer processes')
+        parser.add_argument('--writes', type=int, default=200, help='Payment updates per writer')
+        parser.add_argument(
+            '--readers', type=int, default=2,
+            help='Concurrent dashboard reader processes, run once in autocommit and once inside transactions'
+        )
+        parser.add_argument('--students', type=int, default=2000, help='Students in the scratch database')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['writes'] < 1 or options['readers'] < 0:
+            raise CommandError('--workers and --writes must be positive, --readers not negative')
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise CommandError('stress_sqlite needs the fork start method')
+
+        runs = {name: self.run(config, options) for name, config in (('stock', BASELINE), ('tuned', _tuned()))}
+
+        columns = [
+            'config', 'writes_per_s', 'write_p50_ms', 'write_p99_ms', 'write_errors',
+            'read_p50_ms', 'read_p99_ms', 'tx_read_p50_ms', 'tx_read_p99_ms', 'read_errors',
+        ]
+        widths = [max(len(column), 12) for column in columns]
+        self.stdout.write('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+        for name, run in runs.items():
+            row = [name] + [str(run[column]) for column in columns[1:]]
+            self.stdout.write('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+        stock, tuned = runs['stock']['writes_per_s'], runs['tuned']['writes_per_s']
+        if stock:
+            self.stdout.write(self.style.SUCCESS(f'\nWrite throughput: {tuned / stock:.1f}x with the tuned settings'))
+
+    def run(self, config, options):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'stress.sqlite3')
+            database = parse_database_url(f'sqlite:///{path}')
+            database['OPTIONS'] = dict(config['options'])
+            database['TEST'] = {'NAME': path}
+
+            with use_database(database) as connection, \
+                    override_settings(CACHES=BENCH_CACHES, SQLITE_PRAGMAS=config['pragmas']):
+                connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+                forget_years()
+                try:
+                    generate_students(options['students'], [current_year()], seed=0)
+                    student_ids = list(Student.objects.values_list('id', flat=True))
+                    return self.hammer(student_ids, options)
+                finally:
+                    connection.creation.destroy_test_db(path, verbosity=0)
+                    forget_years()
+
+    def hammer(self, student_ids, options):
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=_run_child, args=(results, 'write', _writer, seed, options['writes'], student_ids)
+            )
+            for seed in range(options['workers'])
+        ] + [
+            context.Process(target=_run_child, args=(results, kind, _reader, options['writes'], kind == 'tx_read'))
+            for kind in ('read', 'tx_read')
+            for _ in range(options['readers'])
+        ]
+
+        connections.close_all()
+        started = time.perf_counter()
+        for process in processes:
+            process.start()
+        collected = [results.get() for _ in processes]
+        elapsed = time.perf_counter() - started
+        for process in processes:
+            process.join()
+
+        latencies = {
+            name: [ms for kind, timings, _ in collected if kind == name for ms in timings]
+            for name in ('write', 'read', 'tx_read')
+        }
+        run = {
+            'writes_per_s': round(len(latencies['write']) / elapsed, 1),
+            'write_errors': sum(errors for kind, _, errors in collected if kind == 'write'),
+            'read_errors': sum(errors for kind, _, errors in collected if kind != 'write'),
+        }
+        for name, timings in latencies.items():
+            run[f'{name}_p50_ms'] = round(percentile(timings, 50), 2) if timings else None
+            run[f'{name}_p99_ms'] = round(percentile(timings, 99), 2) if timings else None
+        return run
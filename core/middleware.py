@@ -0,0 +1,146 @@
+"""Per-request SQL instrumentation.
+
+Enabled with the QUERY_INSTRUMENTATION setting. Every request gets a Server-Timing
+header with its query count and database/view time, and a JSON log line on the
+`core.instrumentation` logger with the slowest statements and any SQL shape repeated
+often enough to look like an N+1 pattern.
+"""
+import json
+import logging
+import re
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+
+logger = logging.getLogger('core.instrumentation')
+
+# Statements listed in the log line, slowest first
+SLOW_QUERY_COUNT = 3
+
+# Executions of the same SQL shape in one request that count as a suspected N+1
+N_PLUS_ONE_THRESHOLD = 5
+
+_IN_LIST = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_SPACE = re.compile(r'\s+')
+
+
+def sql_shape(sql):
+    """SQL with literals and IN lists collapsed, so repeated lookups compare equal"""
+    shape = _STRING.sub('?', sql)
+    shape = _NUMBER.sub('?', shape)
+    shape = _IN_LIST.sub('(...)', shape)
+    return _SPACE.sub(' ', shape).strip()
+
+
+class QueryRecorder:
+    """Execute wrapper timing every statement run on a connection"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'ms': (time.perf_counter() - started) * 1000,
+                'alias': context['connection'].alias,
+            })
+
+    @property
+    def db_time(self):
+        return sum(query['ms'] for query in self.queries)
+
+    def slowest(self, count=SLOW_QUERY_COUNT):
+        return sorted(self.queries, key=lambda query: query['ms'], reverse=True)[:count]
+
+    def repeated_shapes(self, threshold=N_PLUS_ONE_THRESHOLD):
+        shapes = Counter(sql_shape(query['sql']) for query in self.queries)
+        return {shape: count for shape, count in shapes.most_common() if count >= threshold}
+
+
+class QueryInstrumentationMiddleware:
+    """Report query count, database time and suspected N+1 patterns of every request"""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'QUERY_INSTRUMENTATION', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.threshold = getattr(settings, 'QUERY_INSTRUMENTATION_N_PLUS_ONE', N_PLUS_ONE_THRESHOLD)
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        wrapped = list(connections.all())
+        for connection in wrapped:
+            connection.execute_wrappers.append(recorder)
+
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        except Exception:
+            self._uninstall(wrapped, recorder)
+            raise
+        view_time = (time.perf_counter() - started) * 1000
+
+        if response.streaming:
+            # Queries keep running while the body streams, log once it is exhausted
+            response['Server-Timing'] = self.server_timing(recorder, view_time)
+            response.streaming_content = self._finish_stream(
+                response.streaming_content, request, response, recorder, wrapped, started
+            )
+            return response
+
+        self._uninstall(wrapped, recorder)
+        response['Server-Timing'] = self.server_timing(recorder, view_time)
+        self.log(request, response, recorder, view_time)
+        return response
+
+    def _finish_stream(self, content, request, response, recorder, wrapped, started):
+        try:
+            yield from content
+        finally:
+            self._uninstall(wrapped, recorder)
+            self.log(request, response, recorder, (time.perf_counter() - started) * 1000)
+
+    @staticmethod
+    def _uninstall(wrapped, recorder):
+        for connection in wrapped:
+            if recorder in connection.execute_wrappers:
+                connection.execute_wrappers.remove(recorder)
+
+    def server_timing(self, recorder, view_time):
+        metrics = [
+            f'db;dur={recorder.db_time:.1f};desc="{len(recorder.queries)} queries"',
+            f'view;dur={view_time:.1f}',
+        ]
+        if recorder.queries:
+            metrics.append(f'db-slowest;dur={recorder.slowest(1)[0]["ms"]:.1f}')
+        repeated = recorder.repeated_shapes(self.threshold)
+        if repeated:
+            metrics.append(f'n-plus-one;desc="{len(repeated)} repeated shapes"')
+        return ', '.join(metrics)
+
+    def log(self, request, response, recorder, view_time):
+        repeated = recorder.repeated_shapes(self.threshold)
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'view_ms': round(view_time, 2),
+            'db_ms': round(recorder.db_time, 2),
+            'queries': len(recorder.queries),
+            'slowest': [
+                {'sql': query['sql'], 'ms': round(query['ms'], 2), 'alias': query['alias']}
+                for query in recorder.slowest()
+            ],
+            'n_plus_one': [{'sql': shape, 'count': count} for shape, count in repeated.items()],
+        }
+        logger.log(logging.WARNING if repeated else logging.INFO, json.dumps(record, ensure_ascii=False))
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Case, Count, Q, Sum, Value, When
+
+
+MONTHS = ['august', 'september', 'october', 'november', 'december',
+          'january', 'february', 'march', 'april', 'may', 'june']
+
+
+def build_payment_summaries(apps, schema_editor):
+    """Fill the summary table from existing payments"""
+    Payment = apps.get_model('core', 'Payment')
+    PaymentSummary = apps.get_model('core', 'PaymentSummary')
+    db = schema_editor.connection.alias
+
+    paid = Q(is_paid=True)
+    paid_bits = Case(
+        *[When(paid & Q(month=month), then=Value(1 << i)) for i, month in enumerate(MONTHS)],
+        default=Value(0),
+    )
+    rows = Payment.objects.using(db).order_by().values('student_id', 'year').annotate(
+        payment_count=Count('id'),
+        paid_count=Count('id', filter=paid),
+        paid_amount=Sum('amount', filter=paid),
+        pending_amount=Sum('amount', filter=~paid),
+        paid_months=Sum(paid_bits),
+    )
+
+    batch = []
+    for row in rows.iterator(chunk_size=2000):
+        row['paid_amount'] = row['paid_amount'] or 0
+        row['pending_amount'] = row['pending_amount'] or 0
+        batch.append(PaymentSummary(**row))
+        if len(batch) >= 2000:
+            PaymentSummary.objects.using(db).bulk_create(batch)
+            batch = []
+    PaymentSummary.objects.using(db).bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_auto_20250808_1117'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField(verbose_name='السنة')),
+                ('payment_count', models.PositiveSmallIntegerField(default=0, verbose_name='عدد الدفعات')),
+                ('paid_count', models.PositiveSmallIntegerField(default=0, verbose_name='عدد الأشهر المدفوعة')),
+                ('paid_amount', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='المبلغ المدفوع')),
+                ('pending_amount', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='المبلغ المعلق')),
+                ('paid_months', models.IntegerField(default=0, verbose_name='الأشهر المدفوعة')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_summaries', to='core.student')),
+            ],
+            options={
+                'verbose_name': 'ملخص مدفوعات',
+                'verbose_name_plural': 'ملخصات المدفوعات',
+                'unique_together': {('student', 'year')},
+            },
+        ),
+        migrations.RunPython(build_payment_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_paymentsummary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['year', 'month', 'is_paid', 'student', 'amount'], name='payment_period_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['student', 'year', 'is_paid', 'amount'], name='payment_student_year_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['grade', 'full_name'], name='student_grade_name_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:30
+
+from django.db import migrations, models
+
+from core.search import install_search_index, remove_search_index, student_search_key
+
+
+def backfill_search_keys(apps, schema_editor):
+    Student = apps.get_model('core', 'Student')
+    students = list(
+        Student.objects.using(schema_editor.connection.alias).only('id', 'full_name', 'father_phone_number')
+    )
+    for student in students:
+        student.search_key = student_search_key(student.full_name, student.father_phone_number)
+    Student.objects.using(schema_editor.connection.alias).bulk_update(students, ['search_key'], batch_size=1000)
+
+
+def create_search_index(apps, schema_editor):
+    install_search_index(schema_editor.connection)
+
+
+def drop_search_index(apps, schema_editor):
+    remove_search_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_performance_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='student',
+            name='search_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=150),
+        ),
+        migrations.RunPython(backfill_search_keys, migrations.RunPython.noop),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:21
+
+import core.academic_years
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def create_academic_years(apps, schema_editor):
+    """One row per year that has payments, the latest marked current"""
+    db = schema_editor.connection.alias
+    AcademicYear = apps.get_model('core', 'AcademicYear')
+    Payment = apps.get_model('core', 'Payment')
+
+    years = set(Payment.objects.using(db).values_list('year', flat=True).distinct())
+    if not years:
+        years = {core.academic_years.academic_year_of(timezone.localdate())}
+    current = max(years)
+    AcademicYear.objects.using(db).bulk_create([
+        AcademicYear(year=year, is_current=year == current) for year in sorted(years)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_student_search_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AcademicYear',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField(unique=True, verbose_name='السنة الدراسية')),
+                ('is_current', models.BooleanField(default=False, verbose_name='السنة الحالية')),
+            ],
+            options={
+                'verbose_name': 'سنة دراسية',
+                'verbose_name_plural': 'السنوات الدراسية',
+                'ordering': ['-year'],
+            },
+        ),
+        # Python-side default only, state change so SQLite doesn't rebuild the payments table
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AlterField(
+                model_name='payment',
+                name='year',
+                field=models.IntegerField(default=core.academic_years.current_year, verbose_name='السنة'),
+            ),
+        ]),
+        migrations.AddIndex(
+            model_name='paymentsummary',
+            index=models.Index(fields=['year', 'student'], name='summary_year_student_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='academicyear',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_current', True)), fields=('is_current',), name='single_current_academic_year'),
+        ),
+        migrations.RunPython(create_academic_years, migrations.RunPython.noop),
+    ]
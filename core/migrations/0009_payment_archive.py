@@ -0,0 +1,41 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_academic_year'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='academicyear',
+            name='is_archived',
+            field=models.BooleanField(default=False, verbose_name='مؤرشفة'),
+        ),
+        migrations.CreateModel(
+            name='PaymentArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.CharField(choices=[('august', 'أغسطس'), ('september', 'سبتمبر'), ('october', 'أكتوبر'), ('november', 'نوفمبر'), ('december', 'ديسمبر'), ('january', 'يناير'), ('february', 'فبراير'), ('march', 'مارس'), ('april', 'أبريل'), ('may', 'مايو'), ('june', 'يونيو')], max_length=10, verbose_name='الشهر')),
+                ('year', models.IntegerField(verbose_name='السنة')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='المبلغ')),
+                ('is_paid', models.BooleanField(default=False, verbose_name='مدفوع')),
+                ('paid_at', models.DateTimeField(blank=True, null=True, verbose_name='تاريخ الدفع')),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(verbose_name='تاريخ الأرشفة')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_payments', to='core.student')),
+            ],
+            options={
+                'verbose_name': 'دفعة مؤرشفة',
+                'verbose_name_plural': 'الدفعات المؤرشفة',
+                'ordering': ['year', 'month'],
+                'indexes': [models.Index(fields=['year', 'month', 'is_paid', 'student', 'amount'], name='archive_period_idx')],
+                'unique_together': {('student', 'month', 'year')},
+            },
+        ),
+    ]
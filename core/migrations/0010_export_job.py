@@ -0,0 +1,34 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_payment_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('students_csv', 'بيانات الطلاب (CSV)')], max_length=20, verbose_name='النوع')),
+                ('params', models.JSONField(default=dict, verbose_name='المعاملات')),
+                ('status', models.CharField(choices=[('pending', 'في الانتظار'), ('running', 'قيد التنفيذ'), ('done', 'مكتمل'), ('failed', 'فشل')], default='pending', max_length=10, verbose_name='الحالة')),
+                ('file_name', models.CharField(blank=True, max_length=255, verbose_name='الملف')),
+                ('rows', models.PositiveIntegerField(default=0, verbose_name='عدد الصفوف')),
+                ('error', models.TextField(blank=True, verbose_name='الخطأ')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'مهمة تصدير',
+                'verbose_name_plural': 'مهام التصدير',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'created_at'], name='export_job_queue_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_export_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exportjob',
+            name='kind',
+            field=models.CharField(choices=[('students_csv', 'بيانات الطلاب (CSV)'), ('students_xlsx', 'بيانات الطلاب (Excel)')], max_length=20, verbose_name='النوع'),
+        ),
+    ]
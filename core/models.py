@@ -1,6 +1,19 @@
-from django.db import models
+from decimal import Decimal
+
+from django.db import connections, models, transaction
+from django.db.models import Case, Count, F, FilteredRelation, Q, Sum, Value, When
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
+from .academic_years import archived_years, current_year
+from .search import FTS_TABLE, MIN_TRIGRAM_LENGTH, fts_phrase, search_term, student_search_key, uses_fts
+from .stats_cache import invalidate_grades
+
+
+def _zero_amount():
+    return Value(Decimal('0.00'), output_field=models.DecimalField(max_digits=12, decimal_places=2))
+
 
 class Grade(models.Model):
     GRADE_CHOICES = [
@@ -29,51 +42,180 @@ class Grade(models.Model):
     def grade_name(self):
         return dict(self.GRADE_CHOICES)[self.grade]
 
+
+class AcademicYear(models.Model):
+    """Academic year running from August of `year` to June of the next year"""
+    year = models.PositiveSmallIntegerField(unique=True, verbose_name="السنة الدراسية")
+    is_current = models.BooleanField(default=False, verbose_name="السنة الحالية")
+    # Payments of archived years live in PaymentArchive and are read-only
+    is_archived = models.BooleanField(default=False, verbose_name="مؤرشفة")
+
+    class Meta:
+        ordering = ['-year']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['is_current'], condition=Q(is_current=True), name='single_current_academic_year'
+            ),
+        ]
+        verbose_name = "سنة دراسية"
+        verbose_name_plural = "السنوات الدراسية"
+
+    def __str__(self):
+        return f"{self.year}/{self.year + 1}"
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            if self.is_current:
+                AcademicYear.objects.filter(is_current=True).exclude(pk=self.pk).update(is_current=False)
+            super().save(*args, **kwargs)
+
+class StudentQuerySet(models.QuerySet):
+    def for_grades(self, grades):
+        """Restrict to the selected grade codes (empty or 'all' keeps every grade)"""
+        if grades and 'all' not in grades:
+            return self.filter(grade__grade__in=grades)
+        return self
+
+    def search(self, query):
+        """Students whose normalized name or phone digits contain the normalized query"""
+        term = search_term(query)
+        if not term:
+            return self
+        if len(term) >= MIN_TRIGRAM_LENGTH and uses_fts(connections[self.db]):
+            return self.filter(pk__in=RawSQL(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [fts_phrase(term)]
+            ))
+        # pg_trgm serves LIKE directly, short terms on SQLite fall back to a scan
+        return self.filter(search_key__contains=term)
+
+    def with_payment_matrix(self, year):
+        """Annotate the paid flag of every month and the yearly totals.
+
+        Reads the student's PaymentSummary row for the year through a single LEFT JOIN,
+        students without payments get zeros.
+        """
+        summary = self.annotate(
+            year_summary=FilteredRelation(
+                'payment_summaries', condition=Q(payment_summaries__year=year)
+            ),
+        ).annotate(
+            paid_mask=Coalesce(F('year_summary__paid_months'), 0),
+        )
+
+        month_flags = {
+            f'paid_{month}': F('paid_mask').bitand(Payment.month_bit(month))
+            for month in Payment.MONTHS
+        }
+        return summary.annotate(
+            **month_flags,
+            paid_months=Coalesce(F('year_summary__paid_count'), 0),
+            total_paid=Coalesce(F('year_summary__paid_amount'), _zero_amount()),
+            total_pending=Coalesce(F('year_summary__pending_amount'), _zero_amount()),
+        )
+
+    def filter_payment_status(self, status, month='all'):
+        """Keep students with the given payment status for one month or the whole year.
+
+        Expects `with_payment_matrix` annotations.
+        """
+        if status == 'all':
+            return self
+        if month in Payment.MONTHS:
+            # Partial doesn't make sense for a single month, treat it as unpaid
+            if status == 'paid':
+                return self.filter(**{f'paid_{month}__gt': 0})
+            return self.filter(**{f'paid_{month}': 0})
+
+        total_months = len(Payment.MONTHS)
+        if status == 'paid':
+            return self.filter(paid_months=total_months)
+        if status == 'partial':
+            return self.filter(paid_months__gt=0, paid_months__lt=total_months)
+        if status == 'unpaid':
+            return self.filter(paid_months=0)
+        return self.none()
+
+
 class Student(models.Model):
     full_name = models.CharField(max_length=100, verbose_name="الاسم الكامل")
     grade = models.ForeignKey(Grade, on_delete=models.CASCADE, verbose_name="الصف")
     father_phone_number = models.CharField(max_length=20, verbose_name="رقم هاتف الأب")
     is_exempt = models.BooleanField(default=False, verbose_name="معفي من الحسابات")
+    # Normalized name and phone digits, see core.search
+    search_key = models.CharField(max_length=150, blank=True, default='', editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = StudentQuerySet.as_manager()
+
     def __str__(self):
         return self.full_name
 
+    def refresh_search_key(self):
+        """Recompute search_key, needed before bulk_create which skips save()"""
+        self.search_key = student_search_key(self.full_name, self.father_phone_number)
+
+    def save(self, *args, **kwargs):
+        self.refresh_search_key()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'full_name', 'father_phone_number'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'search_key'}
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the loaded grade so moving a student also refreshes the old grade's stats
+        instance._loaded_grade_id = instance.__dict__.get('grade_id')
+        return instance
+
     class Meta:
         ordering = ['full_name']
+        indexes = [
+            # Students of a grade in name order, as listed by students_list
+            models.Index(fields=['grade', 'full_name'], name='student_grade_name_idx'),
+        ]
         verbose_name = "طالب"
         verbose_name_plural = "الطلاب"
     
     @property
     def total_payments(self):
         """Calculate total amount paid by student"""
-        return self.payments.filter(is_paid=True).aggregate(
-            total=models.Sum('amount')
+        return self.payment_summaries.aggregate(
+            total=models.Sum('paid_amount')
         )['total'] or 0
     
     @property
     def pending_payments(self):
         """Calculate pending payment amount"""
-        return self.payments.filter(is_paid=False).aggregate(
-            total=models.Sum('amount')
+        return self.payment_summaries.aggregate(
+            total=models.Sum('pending_amount')
         )['total'] or 0
     
     @property
     def payment_completion_percentage(self):
         """Calculate payment completion percentage"""
-        total_months = 11  # August to June
-        paid_months = self.payments.filter(is_paid=True, year=2025).count()
-        return (paid_months / total_months) * 100 if total_months > 0 else 0
-    
-    @property
-    def payment_completion_percentage(self):
-        """Calculate payment completion percentage"""
-        total_payments = self.payments.count()
-        paid_payments = self.payments.filter(is_paid=True).count()
-        if total_payments == 0:
+        totals = self.payment_summaries.aggregate(
+            payments=models.Sum('payment_count'), paid=models.Sum('paid_count')
+        )
+        if not totals['payments']:
             return 0
-        return round((paid_payments / total_payments) * 100, 2)
+        return round((totals['paid'] / totals['payments']) * 100, 2)
+
+
+class PaymentQuerySet(models.QuerySet):
+    def delete(self):
+        """Delete payments and refresh the summaries of the students and years they belonged to"""
+        with transaction.atomic(using=self.db):
+            keys = set(self.order_by().values_list('student_id', 'year').distinct())
+            result = super().delete()
+            if keys:
+                student_ids, years = map(set, zip(*keys))
+                PaymentSummary.objects.rebuild(student_ids=student_ids, years=years)
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
 
 
 class Payment(models.Model):
@@ -83,24 +225,56 @@ class Payment(models.Model):
         ('february', 'فبراير'), ('march', 'مارس'), ('april', 'أبريل'), 
         ('may', 'مايو'), ('june', 'يونيو'),
     ]
+    # Academic-year order (August to June), used as the column order of the payment matrix
+    MONTHS = [month for month, _ in MONTH_CHOICES]
 
     student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='payments')
     month = models.CharField(max_length=10, choices=MONTH_CHOICES, verbose_name="الشهر")
-    year = models.IntegerField(default=2025, verbose_name="السنة")
+    year = models.IntegerField(default=current_year, verbose_name="السنة")
     amount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="المبلغ")
     is_paid = models.BooleanField(default=False, verbose_name="مدفوع")
     paid_at = models.DateTimeField(blank=True, null=True, verbose_name="تاريخ الدفع")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = PaymentQuerySet.as_manager()
+
     class Meta:
         unique_together = ('student', 'month', 'year')
         ordering = ['year', 'month']
+        # Trailing columns are keys rather than INCLUDE so the indexes cover their queries
+        # on SQLite too
+        indexes = [
+            # Revenue or outstanding payments of one month: filter on the period and status,
+            # join on student, sum the amount
+            models.Index(fields=['year', 'month', 'is_paid', 'student', 'amount'], name='payment_period_idx'),
+            # Paid/pending totals of a set of students for one year
+            models.Index(fields=['student', 'year', 'is_paid', 'amount'], name='payment_student_year_idx'),
+        ]
         verbose_name = "دفعة"
         verbose_name_plural = "الدفعات"
 
     def __str__(self):
         return f"{self.student.full_name} - {self.get_month_display()} {self.year}"
+
+    @classmethod
+    def month_bit(cls, month):
+        """Bit of a month in PaymentSummary.paid_months"""
+        return 1 << cls.MONTHS.index(month)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the loaded owner and year so a moved payment also refreshes the old summary
+        instance._loaded_student_id = instance.__dict__.get('student_id')
+        instance._loaded_year = instance.__dict__.get('year')
+        return instance
+
+    def _summary_keys(self):
+        """Student ids and years of the summaries this payment counts in, before and after edits"""
+        student_ids = {self.student_id, getattr(self, '_loaded_student_id', None)} - {None}
+        years = {self.year, getattr(self, '_loaded_year', None)} - {None}
+        return {'student_ids': student_ids, 'years': years}
     
     def save(self, *args, **kwargs):
         if not self.amount:
@@ -109,4 +283,178 @@ class Payment(models.Model):
             self.paid_at = timezone.now()
         elif not self.is_paid:
             self.paid_at = None
-        super().save(*args, **kwargs)
\ No newline at end of file
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            PaymentSummary.objects.rebuild(**self._summary_keys())
+        self._loaded_student_id = self.student_id
+        self._loaded_year = self.year
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            result = super().delete(*args, **kwargs)
+            PaymentSummary.objects.rebuild(**self._summary_keys())
+        return result
+
+
+class PaymentArchive(models.Model):
+    """Payment of an archived academic year, moved out of Payment by the rollover_year command.
+
+    Append-only: rows are copied in by core.rollover.archive_year and never edited, so
+    Payment only holds the years still being worked on.
+    """
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='archived_payments')
+    month = models.CharField(max_length=10, choices=Payment.MONTH_CHOICES, verbose_name="الشهر")
+    year = models.IntegerField(verbose_name="السنة")
+    amount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="المبلغ")
+    is_paid = models.BooleanField(default=False, verbose_name="مدفوع")
+    paid_at = models.DateTimeField(blank=True, null=True, verbose_name="تاريخ الدفع")
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(verbose_name="تاريخ الأرشفة")
+
+    class Meta:
+        unique_together = ('student', 'month', 'year')
+        ordering = ['year', 'month']
+        indexes = [
+            # Revenue of one archived month, same shape as payment_period_idx
+            models.Index(fields=['year', 'month', 'is_paid', 'student', 'amount'], name='archive_period_idx'),
+        ]
+        verbose_name = "دفعة مؤرشفة"
+        verbose_name_plural = "الدفعات المؤرشفة"
+
+    def __str__(self):
+        return f"{self.student.full_name} - {self.get_month_display()} {self.year}"
+
+
+def _summary_rows(payments):
+    """Per student and year PaymentSummary values of a Payment or PaymentArchive queryset"""
+    paid = Q(is_paid=True)
+    paid_bits = Case(
+        *[When(paid & Q(month=month), then=Value(Payment.month_bit(month))) for month in Payment.MONTHS],
+        default=Value(0),
+    )
+    return payments.order_by().values('student_id', 'year').annotate(
+        payment_count=Count('id'),
+        paid_count=Count('id', filter=paid),
+        paid_amount=Coalesce(Sum('amount', filter=paid), _zero_amount()),
+        pending_amount=Coalesce(Sum('amount', filter=~paid), _zero_amount()),
+        paid_months=Sum(paid_bits),
+    )
+
+
+class PaymentSummaryQuerySet(models.QuerySet):
+    def rebuild(self, student_ids=None, years=None, batch_size=2000):
+        """Recompute summaries from Payment and PaymentArchive, for the given students and
+        years or for everything.
+
+        One grouped query per table, then the old rows are replaced in the same transaction.
+        A year lives entirely in one of the two tables, so their rows never overlap. The
+        archive is skipped when none of the given years is archived.
+        """
+        sources = [Payment.objects.all()]
+        summaries = self.model.objects.all()
+        if years is None or set(years) & archived_years():
+            sources.append(PaymentArchive.objects.all())
+        if student_ids is not None:
+            student_ids = list(student_ids)
+            sources = [source.filter(student_id__in=student_ids) for source in sources]
+            summaries = summaries.filter(student_id__in=student_ids)
+        if years is not None:
+            years = list(years)
+            sources = [source.filter(year__in=years) for source in sources]
+            summaries = summaries.filter(year__in=years)
+
+        with transaction.atomic(using=self.db):
+            # Dashboard revenue is read from the summaries
+            grades = Grade.objects.using(self.db)
+            if student_ids is not None:
+                grades = grades.filter(student__id__in=student_ids).distinct()
+            invalidate_grades(grades.values_list('grade', flat=True), using=self.db)
+
+            summaries.delete()
+            batch = []
+            for source in sources:
+                for row in _summary_rows(source).iterator(chunk_size=batch_size):
+                    batch.append(self.model(**row))
+                    if len(batch) >= batch_size:
+                        self.model.objects.bulk_create(batch)
+                        batch = []
+            self.model.objects.bulk_create(batch)
+
+
+class PaymentSummary(models.Model):
+    """Denormalized payment totals of one student for one academic year.
+
+    Kept in sync by Payment.save/delete and PaymentQuerySet.delete; code writing payments
+    in bulk must call PaymentSummary.objects.rebuild() for the students it touched.
+    """
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='payment_summaries')
+    year = models.IntegerField(verbose_name="السنة")
+    payment_count = models.PositiveSmallIntegerField(default=0, verbose_name="عدد الدفعات")
+    paid_count = models.PositiveSmallIntegerField(default=0, verbose_name="عدد الأشهر المدفوعة")
+    paid_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name="المبلغ المدفوع")
+    pending_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name="المبلغ المعلق")
+    # Bit i is set when Payment.MONTHS[i] is paid
+    paid_months = models.IntegerField(default=0, verbose_name="الأشهر المدفوعة")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = PaymentSummaryQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('student', 'year')
+        indexes = [
+            # Year-scoped totals (dashboard) read only the selected year's rows
+            models.Index(fields=['year', 'student'], name='summary_year_student_idx'),
+        ]
+        verbose_name = "ملخص مدفوعات"
+        verbose_name_plural = "ملخصات المدفوعات"
+
+    def __str__(self):
+        return f"{self.student.full_name} - {self.year}"
+
+class ExportJob(models.Model):
+    """Export run in the background by the run_workers command.
+
+    Web requests only enqueue the job, a worker claims it, writes the file under
+    EXPORT_ROOT and records where it is; the status endpoint is polled until it is done.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'في الانتظار'),
+        (RUNNING, 'قيد التنفيذ'),
+        (DONE, 'مكتمل'),
+        (FAILED, 'فشل'),
+    ]
+
+    STUDENTS_CSV = 'students_csv'
+    STUDENTS_XLSX = 'students_xlsx'
+    KIND_CHOICES = [
+        (STUDENTS_CSV, 'بيانات الطلاب (CSV)'),
+        (STUDENTS_XLSX, 'بيانات الطلاب (Excel)'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, verbose_name="النوع")
+    params = models.JSONField(default=dict, verbose_name="المعاملات")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, verbose_name="الحالة")
+    # Relative to EXPORT_ROOT, set once the file is complete
+    file_name = models.CharField(max_length=255, blank=True, verbose_name="الملف")
+    rows = models.PositiveIntegerField(default=0, verbose_name="عدد الصفوف")
+    error = models.TextField(blank=True, verbose_name="الخطأ")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            # Workers claim the oldest pending job
+            models.Index(fields=['status', 'created_at'], name='export_job_queue_idx'),
+        ]
+        verbose_name = "مهمة تصدير"
+        verbose_name_plural = "مهام التصدير"
+
+    def __str__(self):
+        return f"{self.get_kind_display()} #{self.pk} - {self.get_status_display()}"
@@ -0,0 +1,306 @@
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .academic_years import current_year, writable_year
+from .models import Payment, PaymentSummary, Student, _zero_amount
+from .stats_cache import invalidate_grades
+
+
+# Largest number of changes accepted by one batch update
+MAX_BATCH_CHANGES = 5000
+
+# Rows per INSERT statement for bulk writes
+BULK_BATCH_SIZE = 1000
+
+
+def enroll_students(students, year=None):
+    """Save new students and their unpaid August-June schedule in one transaction.
+
+    `students` are unsaved Student instances with their grade set, `year` defaults to the
+    current academic year. Students, payments and summary rows each go in with bulk INSERTs,
+    so enrolling a whole class costs a handful of statements instead of a dozen commits per
+    student.
+    """
+    year = year or current_year()
+    students = list(students)
+    for student in students:
+        student.refresh_search_key()
+    with transaction.atomic():
+        if connection.features.can_return_rows_from_bulk_insert:
+            Student.objects.bulk_create(students, batch_size=BULK_BATCH_SIZE)
+        else:
+            # The primary keys are needed for the payment rows
+            for student in students:
+                student.save()
+
+        Payment.objects.bulk_create([
+            Payment(
+                student=student,
+                month=month,
+                year=year,
+                amount=student.grade.monthly_fee,
+                is_paid=False,
+            )
+            for student in students
+            for month in Payment.MONTHS
+        ], batch_size=BULK_BATCH_SIZE)
+
+        PaymentSummary.objects.bulk_create([
+            PaymentSummary(
+                student=student,
+                year=year,
+                payment_count=len(Payment.MONTHS),
+                pending_amount=student.grade.monthly_fee * len(Payment.MONTHS),
+            )
+            for student in students
+        ], batch_size=BULK_BATCH_SIZE)
+
+        invalidate_grades({student.grade.grade for student in students})
+    return students
+
+
+def parse_payment_changes(changes, default_year=None):
+    """Validate raw {student_id, month, year, is_paid} dicts, year defaulting to the current one.
+
+    Returns a dict keyed by (student_id, month, year) so the last change of a cell wins.
+    Raises ValueError with a user-facing message on invalid input.
+    """
+    if not isinstance(changes, list) or not changes:
+        raise ValueError('يجب إرسال قائمة تغييرات غير فارغة')
+    if len(changes) > MAX_BATCH_CHANGES:
+        raise ValueError(f'الحد الأقصى للتغييرات في الطلب الواحد هو {MAX_BATCH_CHANGES}')
+
+    default_year = default_year or current_year()
+    parsed = {}
+    for change in changes:
+        if not isinstance(change, dict):
+            raise ValueError('صيغة التغيير غير صحيحة')
+        try:
+            student_id = int(change.get('student_id'))
+        except (TypeError, ValueError):
+            raise ValueError('رقم الطالب غير صحيح')
+        year = writable_year(change.get('year', default_year))
+        month = change.get('month')
+        if month not in Payment.MONTHS:
+            raise ValueError(f'شهر غير معروف: {month}')
+        parsed[(student_id, month, year)] = bool(change.get('is_paid', False))
+    return parsed
+
+
+def apply_payment_changes(changes):
+    """Apply parsed payment changes in one transaction with bulk statements.
+
+    Existing payments are updated with one bulk UPDATE, missing ones are inserted with one
+    bulk INSERT (amount taken from the grade fee), then the summaries of the touched students
+    are rebuilt once. Returns the new summary rows of the touched (student, year) pairs.
+    """
+    student_ids = {student_id for student_id, _, _ in changes}
+    years = {year for _, _, year in changes}
+    now = timezone.now()
+
+    with transaction.atomic():
+        students = Student.objects.select_related('grade').in_bulk(student_ids)
+        missing = student_ids - set(students)
+        if missing:
+            raise ValueError(f'طلاب غير موجودين: {", ".join(map(str, sorted(missing)))}')
+
+        existing = {
+            (payment.student_id, payment.month, payment.year): payment
+            for payment in Payment.objects.filter(student_id__in=student_ids, year__in=years)
+        }
+
+        to_update, to_create = [], []
+        for key, is_paid in changes.items():
+            student_id, month, year = key
+            payment = existing.get(key)
+            if payment is None:
+                to_create.append(Payment(
+                    student_id=student_id,
+                    month=month,
+                    year=year,
+                    amount=students[student_id].grade.monthly_fee,
+                    is_paid=is_paid,
+                    paid_at=now if is_paid else None,
+                ))
+            elif payment.is_paid != is_paid:
+                payment.is_paid = is_paid
+                payment.paid_at = now if is_paid else None
+                payment.updated_at = now
+                to_update.append(payment)
+
+        Payment.objects.bulk_update(to_update, ['is_paid', 'paid_at', 'updated_at'], batch_size=500)
+        Payment.objects.bulk_create(to_create, batch_size=500)
+        PaymentSummary.objects.rebuild(student_ids=student_ids, years=years)
+
+        summaries = PaymentSummary.objects.filter(student_id__in=student_ids, year__in=years)
+        return list(summaries.values('student_id', 'year', 'paid_amount', 'pending_amount', 'paid_count'))
+
+
+def supports_upsert(conn=connection):
+    """INSERT ... ON CONFLICT DO UPDATE ... RETURNING is available on this backend"""
+    if conn.vendor == 'postgresql':
+        return True
+    if conn.vendor == 'sqlite':
+        return conn.Database.sqlite_version_info >= (3, 35)
+    return False
+
+
+def toggle_payment(student, month, year, is_paid):
+    """Set one payment cell and return (payment amount, student's paid total for the year).
+
+    `student` must come with its grade loaded. On PostgreSQL and SQLite this runs two
+    upserts and no reads: the payment row is inserted or flipped in place, and the
+    summary row is adjusted by the resulting delta, returning the new total. A cell already
+    in the requested state costs the upsert and one read, and writes nothing else.
+    """
+    if not supports_upsert():
+        return _toggle_payment_orm(student, month, year, is_paid)
+
+    ops = connection.ops
+    payment_table = ops.quote_name(Payment._meta.db_table)
+    summary_table = ops.quote_name(PaymentSummary._meta.db_table)
+    now = ops.adapt_datetimefield_value(timezone.now())
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # Only touch the row when the flag actually changes, so RETURNING tells us
+            # whether (and how) the totals moved
+            cursor.execute(
+                f"""
+                INSERT INTO {payment_table}
+                    (student_id, month, year, amount, is_paid, paid_at, created_at, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (student_id, month, year) DO UPDATE SET
+                    is_paid = excluded.is_paid,
+                    paid_at = excluded.paid_at,
+                    updated_at = excluded.updated_at
+                WHERE {payment_table}.is_paid <> excluded.is_paid
+                RETURNING amount, created_at = updated_at
+                """,
+                [
+                    student.id, month, year,
+                    ops.adapt_decimalfield_value(student.grade.monthly_fee),
+                    is_paid, now if is_paid else None, now, now,
+                ],
+            )
+            changed = cursor.fetchone()
+            if changed is None:
+                # Already in the requested state: the totals didn't move
+                return _unchanged_payment(student, month, year)
+
+            amount, created = Decimal(str(changed[0])), bool(changed[1])
+            count_delta = 1 if created else 0
+            if is_paid:
+                paid_count_delta, paid_delta = 1, amount
+                pending_delta = Decimal('0') if created else -amount
+            else:
+                paid_count_delta = 0 if created else -1
+                paid_delta = Decimal('0') if created else -amount
+                pending_delta = amount
+
+            bit = Payment.month_bit(month)
+            cursor.execute(
+                f"""
+                INSERT INTO {summary_table}
+                    (student_id, year, payment_count, paid_count, paid_amount, pending_amount,
+                     paid_months, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (student_id, year) DO UPDATE SET
+                    payment_count = {summary_table}.payment_count + %s,
+                    paid_count = {summary_table}.paid_count + %s,
+                    paid_amount = {summary_table}.paid_amount + %s,
+                    pending_amount = {summary_table}.pending_amount + %s,
+                    paid_months = ({summary_table}.paid_months | %s) & %s,
+                    updated_at = excluded.updated_at
+                RETURNING paid_amount
+                """,
+                [
+                    # Values for a student without a summary row yet
+                    student.id, year, count_delta, max(paid_count_delta, 0),
+                    ops.adapt_decimalfield_value(max(paid_delta, Decimal('0'))),
+                    ops.adapt_decimalfield_value(max(pending_delta, Decimal('0'))),
+                    bit if is_paid else 0, now,
+                    # Deltas for an existing one
+                    count_delta, paid_count_delta,
+                    ops.adapt_decimalfield_value(paid_delta),
+                    ops.adapt_decimalfield_value(pending_delta),
+                    bit if is_paid else 0, -1 if is_paid else ~bit,
+                ],
+            )
+            total_paid = Decimal(str(cursor.fetchone()[0]))
+
+        invalidate_grades([student.grade.grade])
+
+    return amount, total_paid
+
+
+def _unchanged_payment(student, month, year):
+    """(payment amount, student's paid total) of a cell left as it was, in one query"""
+    total_paid = PaymentSummary.objects.filter(student=student, year=year).values('paid_amount')[:1]
+    return Payment.objects.filter(student=student, month=month, year=year).values_list(
+        'amount', Coalesce(Subquery(total_paid), _zero_amount())
+    ).get()
+
+
+def _toggle_payment_orm(student, month, year, is_paid):
+    """Portable fallback for backends without ON CONFLICT ... RETURNING"""
+    with transaction.atomic():
+        payment, created = Payment.objects.select_for_update().get_or_create(
+            student=student,
+            month=month,
+            year=year,
+            defaults={
+                'amount': student.grade.monthly_fee,
+                'is_paid': is_paid
+            }
+        )
+        if not created and payment.is_paid != is_paid:
+            payment.is_paid = is_paid
+            payment.save()
+
+        total_paid = PaymentSummary.objects.filter(
+            student=student, year=year
+        ).values_list('paid_amount', flat=True).first() or 0
+    return payment.amount, total_paid
+
+
+def repriceable_payments(grade, year, from_month):
+    """Unpaid payments of `grade` in `year` from `from_month` to June"""
+    if from_month not in Payment.MONTHS:
+        raise ValueError(f'شهر غير معروف: {from_month}')
+    months = Payment.MONTHS[Payment.MONTHS.index(from_month):]
+    return Payment.objects.filter(student__grade=grade, year=year, month__in=months, is_paid=False)
+
+
+def reprice_unpaid_payments(grade, year, from_month, fee=None, dry_run=False):
+    """Charge `fee` (the grade's monthly fee by default) for the unpaid months of a grade.
+
+    Paid months keep the amount they were paid at. One UPDATE sets the payments, a second
+    one recomputes the pending totals of the grade's summaries in the database, so the cost
+    doesn't depend on the number of students. Returns the number of payments whose amount
+    changes; `dry_run` only counts them.
+    """
+    year = writable_year(year)
+    fee = grade.monthly_fee if fee is None else Decimal(fee)
+    if fee < 0:
+        raise ValueError('لا يمكن أن تكون الرسوم الشهرية سالبة')
+    payments = repriceable_payments(grade, year, from_month).exclude(amount=fee)
+    if dry_run:
+        return payments.count()
+
+    with transaction.atomic():
+        repriced = payments.update(amount=fee, updated_at=timezone.now())
+        if repriced:
+            pending = Payment.objects.filter(
+                student=OuterRef('student'), year=year, is_paid=False
+            ).order_by().values('student').annotate(total=Sum('amount')).values('total')
+            PaymentSummary.objects.filter(student__grade=grade, year=year).update(
+                pending_amount=Coalesce(Subquery(pending), _zero_amount()),
+                updated_at=timezone.now(),
+            )
+            invalidate_grades([grade.grade])
+    return repriced
@@ -0,0 +1,384 @@
+import base64
+import json
+from decimal import Decimal
+from functools import reduce
+from itertools import groupby
+from operator import or_
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Case, Count, Q, Sum, Value, When
+
+from .models import Grade, Payment, PaymentSummary, Student
+from .rollover import payments_of_year
+from .routers import read_alias
+from .stats_cache import cached_stats, stats_etag
+from .xlsx import BoldRow
+
+
+MONTHS = Payment.MONTHS
+MONTH_NAMES = dict(Payment.MONTH_CHOICES)
+
+# ORDER BY for each sort option of the students table; id keeps the order total
+SORT_ORDERINGS = {
+    'name': ('full_name', 'id'),
+    'grade': ('grade__grade', 'full_name', 'id'),
+    'payments': ('-total_paid', 'full_name', 'id'),
+}
+
+# Rows rendered per window of the students table
+STUDENTS_PAGE_SIZE = 50
+
+# Rows fetched per round trip when streaming exports through a server-side cursor
+EXPORT_CHUNK_SIZE = 2000
+
+
+def payment_matrix(students_qs, year):
+    """Students annotated with their monthly paid flags and totals for one academic year"""
+    return students_qs.with_payment_matrix(year)
+
+
+def filtered_matrix(students_qs, year, payment_status='all', month='all', sort_by='name'):
+    """Payment matrix with the status filter and sort applied by the database"""
+    return payment_matrix(students_qs, year).filter_payment_status(
+        payment_status, month
+    ).order_by(*SORT_ORDERINGS.get(sort_by, SORT_ORDERINGS['name']))
+
+
+def matrix_totals(students):
+    """Student count, paid months and non-exempt paid total over a (filtered) matrix"""
+    totals = students.order_by().aggregate(
+        student_count=Count('id'),
+        paid_months=Sum('paid_months'),
+        total_paid=Sum('total_paid', filter=Q(is_exempt=False)),
+    )
+    return {
+        'student_count': totals['student_count'],
+        'paid_months': totals['paid_months'] or 0,
+        'total_paid': float(totals['total_paid'] or 0),
+    }
+
+
+def _sort_value(student, field):
+    return reduce(getattr, field.lstrip('-').split('__'), student)
+
+
+def encode_cursor(student, sort_by):
+    """Opaque cursor holding the sort key of the last row of a window"""
+    values = [str(_sort_value(student, field)) for field in SORT_ORDERINGS[sort_by]]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def _cursor_value(field, value):
+    """A cursor value converted to the type of its sort field, ValueError when malformed"""
+    if not isinstance(value, str):
+        raise ValueError(value)
+    name = field.lstrip('-')
+    if name == 'id':
+        return int(value)
+    if name == 'total_paid':
+        try:
+            amount = Decimal(value)
+        except ArithmeticError:
+            raise ValueError(value)
+        if not amount.is_finite():
+            raise ValueError(value)
+        return amount
+    return value
+
+
+def decode_cursor(cursor, sort_by):
+    """Sort key stored in a cursor, or None when the cursor is malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != len(SORT_ORDERINGS[sort_by]):
+        return None
+    try:
+        return [_cursor_value(field, value) for field, value in zip(SORT_ORDERINGS[sort_by], values)]
+    except ValueError:
+        return None
+
+
+def keyset_window(students, sort_by='name', cursor=None, size=STUDENTS_PAGE_SIZE):
+    """One window of rows after `cursor`, seeking on the sort key instead of an OFFSET.
+
+    Returns the rows and the cursor of the next window (None on the last one).
+    """
+    if sort_by not in SORT_ORDERINGS:
+        sort_by = 'name'
+    fields = SORT_ORDERINGS[sort_by]
+
+    if cursor:
+        values = decode_cursor(cursor, sort_by)
+        if values is None:
+            raise ValueError('invalid cursor')
+        # (a, b, c) > (x, y, z) spelled out as a OR-chain so every backend can use it
+        conditions = []
+        for i, field in enumerate(fields):
+            name = field.lstrip('-')
+            lookup = '__lt' if field.startswith('-') else '__gt'
+            equal = {f.lstrip('-'): value for f, value in zip(fields[:i], values)}
+            conditions.append(Q(**equal, **{name + lookup: values[i]}))
+        students = students.filter(reduce(or_, conditions))
+
+    rows = list(students.order_by(*fields)[:size + 1])
+    next_cursor = encode_cursor(rows[size - 1], sort_by) if len(rows) > size else None
+    return rows[:size], next_cursor
+
+
+def month_flags(student):
+    """Paid/unpaid flag of every month for a student annotated by `payment_matrix`"""
+    return {month: bool(getattr(student, f'paid_{month}')) for month in MONTHS}
+
+
+def completion_percentage(paid_months):
+    """Share of the academic year's months that are paid"""
+    return round((paid_months / len(MONTHS)) * 100, 2)
+
+
+def year_payment_status(paid_months):
+    """Year-wide payment status: paid, partial or unpaid"""
+    if paid_months == len(MONTHS):
+        return 'paid'
+    if paid_months > 0:
+        return 'partial'
+    return 'unpaid'
+
+
+def matrix_row(student):
+    """Row used by the students table for one annotated student"""
+    return {
+        'student': student,
+        'payments': month_flags(student),
+        'total_paid': float(student.total_paid),
+        'completion_percentage': completion_percentage(student.paid_months),
+        'payment_status': year_payment_status(student.paid_months),
+        'paid_months': student.paid_months,
+    }
+
+
+def csv_rows(students_qs, year, using=None):
+    """Header plus one row per student, fetched in chunks so memory stays flat.
+
+    Read from the `using` database, the students queryset's own by default.
+    """
+    yield ['الاسم', 'الصف', 'الهاتف', 'إجمالي المدفوعات'] + [MONTH_NAMES[month] for month in MONTHS]
+
+    if using is not None:
+        students_qs = students_qs.using(using)
+    for student in payment_matrix(students_qs, year).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        row = [
+            student.full_name,
+            student.grade.grade_name,
+            student.father_phone_number,
+            student.total_paid,
+        ]
+        row.extend('مدفوع' if is_paid else 'غير مدفوع' for is_paid in month_flags(student).values())
+        yield row
+
+
+def _matrix_chunks(students_qs, year):
+    """Students annotated by `payment_matrix` in lists of EXPORT_CHUNK_SIZE"""
+    chunk = []
+    for student in payment_matrix(students_qs, year).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        chunk.append(student)
+        if len(chunk) == EXPORT_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _matrix_details(students_qs, year, using):
+    """(student, details) of every student annotated by `payment_matrix`.
+
+    `details` maps (student id, month) to the amount, paid flag and payment date, read
+    with one query per chunk of students.
+    """
+    payments = payments_of_year(year).using(using)
+    for chunk in _matrix_chunks(students_qs, year):
+        details = {
+            (student_id, month): (amount, is_paid, paid_at)
+            for student_id, month, amount, is_paid, paid_at in payments.filter(
+                student_id__in=[student.id for student in chunk]
+            ).order_by().values_list('student_id', 'month', 'amount', 'is_paid', 'paid_at')
+        }
+        for student in chunk:
+            yield student, details
+
+
+def _grade_sheet_rows(students):
+    """Header, one row per student and the per-month totals of one grade's sheet.
+
+    `students` are (student, details) pairs of `_matrix_details`. Month cells hold the
+    paid amount, or غير مدفوع, next to the payment date.
+    """
+    header = ['الاسم', 'الهاتف']
+    for month in MONTHS:
+        header += [MONTH_NAMES[month], f'تاريخ دفع {MONTH_NAMES[month]}']
+    yield BoldRow(header + ['إجمالي المدفوعات', 'إجمالي المعلق'])
+
+    month_totals = dict.fromkeys(MONTHS, Decimal(0))
+    total_paid = total_pending = Decimal(0)
+    for student, details in students:
+        row = [student.full_name, student.father_phone_number]
+        for month in MONTHS:
+            detail = details.get((student.id, month))
+            if detail is None:
+                row += [None, None]
+            elif detail[1]:
+                row += [detail[0], detail[2]]
+                month_totals[month] += detail[0]
+            else:
+                row += ['غير مدفوع', None]
+        row += [student.total_paid, student.total_pending]
+        total_paid += student.total_paid
+        total_pending += student.total_pending
+        yield row
+
+    totals = ['الإجمالي', None]
+    for month in MONTHS:
+        totals += [month_totals[month], None]
+    yield BoldRow(totals + [total_paid, total_pending])
+
+
+def xlsx_sheets(students_qs, year, using=None):
+    """(title, widths, rows) of one sheet per grade, for core.xlsx.
+
+    The students of every grade come from one pass over the payment matrix, ordered by
+    grade, so the number of queries doesn't depend on the number of grades. Each sheet's
+    rows must be consumed before asking for the next sheet. Read from the `using`
+    database, the students queryset's own by default.
+    """
+    using = using or students_qs.db
+    grade_order = Case(
+        *[When(grade__grade=code, then=Value(index)) for index, (code, _) in enumerate(Grade.GRADE_CHOICES)]
+    )
+    students_qs = students_qs.using(using).select_related('grade').order_by(grade_order, 'full_name', 'id')
+    widths = [30, 14] + [12, 17] * len(MONTHS) + [16, 16]
+    for grade_name, students in groupby(
+        _matrix_details(students_qs, year, using), key=lambda item: item[0].grade.grade_name
+    ):
+        yield grade_name, widths, _grade_sheet_rows(students)
+
+
+def compute_dashboard_stats(grade_codes, year, using=DEFAULT_DB_ALIAS):
+    """The dashboard_stats of `grade_codes`, always read from the database"""
+    grade_stats = list(
+        Student.objects.using(using).filter(grade__grade__in=grade_codes).values(
+            'grade__grade'
+        ).annotate(
+            student_count=Count('id')
+        ).order_by('grade__grade')
+    )
+    
+    # Exclude exempt students from revenue calculations
+    totals = PaymentSummary.objects.using(using).filter(
+        year=year, student__grade__grade__in=grade_codes, student__is_exempt=False
+    ).aggregate(total_paid=Sum('paid_amount'), total_pending=Sum('pending_amount'))
+    
+    return {
+        'total_students': sum(stat['student_count'] for stat in grade_stats),
+        'total_paid': totals['total_paid'] or 0,
+        'total_pending': totals['total_pending'] or 0,
+        'grade_stats': grade_stats,
+    }
+
+
+def dashboard_stats(selected_grades, year, using=None):
+    """Student count, revenue totals of one academic year and per-grade counts, cached per grade set.
+
+    Computed on the `using` database, by default the one `read_alias` picks for the grades.
+    """
+    return cached_stats(
+        f'dashboard:{year}', selected_grades,
+        lambda grade_codes: compute_dashboard_stats(grade_codes, year, using or read_alias(grade_codes)),
+    )
+
+
+def cached_grades():
+    """Every grade, cached until any grade changes"""
+    return cached_stats('grades', ['all'], lambda grade_codes: list(Grade.objects.all()))
+
+
+def _revenue_cells(grade_codes, years, using):
+    """{year: {grade: {month: {'revenue', 'payers'}}}} with one grouped query per payments table"""
+    by_table = {}
+    for year in years:
+        by_table.setdefault(payments_of_year(year).model, []).append(year)
+
+    cells = {year: {code: {} for code in grade_codes} for year in years}
+    for model, table_years in by_table.items():
+        rows = model.objects.using(using).filter(
+            year__in=table_years, is_paid=True, student__grade__grade__in=grade_codes
+        ).values('year', 'student__grade__grade', 'month').annotate(
+            revenue=Sum('amount'),
+            # A student has one payment per month and year, so payments are payers
+            payers=Count('id'),
+        ).order_by()
+        for row in rows:
+            cells[row['year']][row['student__grade__grade']][row['month']] = {
+                'revenue': float(row['revenue']),
+                'payers': row['payers'],
+            }
+    return cells
+
+
+def _percent_change(current, previous):
+    if not previous:
+        return None
+    return round((current - previous) / previous * 100, 1)
+
+
+def _compute_revenue_matrix(grade_codes, year, compare_year, using):
+    years = [year] if compare_year is None else [year, compare_year]
+    cells = _revenue_cells(grade_codes, years, using)
+    empty = {'revenue': 0.0, 'payers': 0}
+
+    grades = {}
+    totals = {month: dict(empty) for month in MONTHS}
+    for code in grade_codes:
+        grades[code] = {}
+        for month in MONTHS:
+            cell = dict(cells[year][code].get(month, empty))
+            totals[month]['revenue'] += cell['revenue']
+            totals[month]['payers'] += cell['payers']
+            if compare_year is not None:
+                previous = cells[compare_year][code].get(month, empty)
+                cell['previous_revenue'] = previous['revenue']
+                cell['previous_payers'] = previous['payers']
+                cell['change'] = _percent_change(cell['revenue'], previous['revenue'])
+            grades[code][month] = cell
+
+    if compare_year is not None:
+        for month in MONTHS:
+            previous = sum(cells[compare_year][code].get(month, empty)['revenue'] for code in grade_codes)
+            totals[month]['previous_revenue'] = previous
+            totals[month]['change'] = _percent_change(totals[month]['revenue'], previous)
+
+    return {
+        'year': year,
+        'compare_year': compare_year,
+        'months': MONTHS,
+        'grades': grades,
+        'totals': totals,
+    }
+
+
+def revenue_matrix_etag(selected_grades, year, compare_year=None):
+    return stats_etag(f'revenue:{year}:{compare_year}', selected_grades)
+
+
+def revenue_matrix(selected_grades, year, compare_year=None, using=None):
+    """Paid revenue and payer count of every grade and month of a year, cached per grade set.
+
+    With `compare_year`, every cell also carries that year's figures and the percent change.
+    Computed on the `using` database, by default the one `read_alias` picks for the grades.
+    """
+    return cached_stats(
+        f'revenue:{year}:{compare_year}', selected_grades,
+        lambda grade_codes: _compute_revenue_matrix(
+            grade_codes, year, compare_year, using or read_alias(grade_codes)
+        ),
+    )
@@ -0,0 +1,118 @@
+"""Academic year rollover: schedule the new year, archive the closed ones.
+
+Payment only keeps the years still being worked on. Older years are copied to
+PaymentArchive and deleted from Payment with two set-based statements per year, their
+PaymentSummary rows stay as they are since the archived payments are unchanged.
+"""
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .academic_years import archived_years
+from .models import AcademicYear, Payment, PaymentArchive, PaymentSummary, Student
+
+
+# Payment columns copied as they are into PaymentArchive
+ARCHIVED_COLUMNS = ['student_id', 'month', 'year', 'amount', 'is_paid', 'paid_at', 'created_at', 'updated_at']
+
+
+def payments_of_year(year):
+    """Payments of one academic year, from the archive when the year is archived"""
+    model = PaymentArchive if year in archived_years() else Payment
+    return model.objects.filter(year=year)
+
+
+def years_to_archive(new_year, keep=1):
+    """Years with payments in Payment older than `new_year`, minus the `keep` latest ones"""
+    older = sorted(
+        Payment.objects.filter(year__lt=new_year).order_by().values_list('year', flat=True).distinct(),
+        reverse=True,
+    )
+    return sorted(older[keep:])
+
+
+def missing_schedule_count(year):
+    """Payments schedule_year(year) would insert"""
+    expected = Student.objects.count() * len(Payment.MONTHS)
+    return expected - Payment.objects.filter(year=year).count()
+
+
+def schedule_year(year):
+    """Insert the unpaid August-June payments of `year` for every student in one statement.
+
+    Payments that already exist are left alone, so the command can be re-run safely.
+    Returns the number of inserted payments.
+    """
+    ops = connection.ops
+    payment_table = ops.quote_name(Payment._meta.db_table)
+    student_table = ops.quote_name(Student._meta.db_table)
+    grade_table = ops.quote_name(Student._meta.get_field('grade').related_model._meta.db_table)
+    months = ' UNION ALL '.join(['SELECT %s AS month'] * len(Payment.MONTHS))
+    now = ops.adapt_datetimefield_value(timezone.now())
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {payment_table}
+                    (student_id, month, year, amount, is_paid, paid_at, created_at, updated_at)
+                SELECT s.id, m.month, %s, g.monthly_fee, %s, NULL, %s, %s
+                FROM {student_table} s
+                JOIN {grade_table} g ON g.id = s.grade_id
+                CROSS JOIN ({months}) m
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {payment_table} p
+                    WHERE p.student_id = s.id AND p.month = m.month AND p.year = %s
+                )
+                """,
+                [year, False, now, now, *Payment.MONTHS, year],
+            )
+            inserted = cursor.rowcount
+        PaymentSummary.objects.rebuild(years=[year])
+    return inserted
+
+
+def archive_year(year):
+    """Move the payments of `year` to PaymentArchive and mark the year archived.
+
+    Returns the number of moved payments.
+    """
+    ops = connection.ops
+    payment_table = ops.quote_name(Payment._meta.db_table)
+    archive_table = ops.quote_name(PaymentArchive._meta.db_table)
+    columns = ', '.join(ARCHIVED_COLUMNS)
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {archive_table} ({columns}, archived_at)
+                SELECT {columns}, %s FROM {payment_table} WHERE year = %s
+                """,
+                [ops.adapt_datetimefield_value(timezone.now()), year],
+            )
+            moved = cursor.rowcount
+            # Raw DELETE: the summaries stay valid, the ORM delete would rebuild them
+            cursor.execute(f'DELETE FROM {payment_table} WHERE year = %s', [year])
+
+        academic_year, _ = AcademicYear.objects.get_or_create(year=year)
+        academic_year.is_archived = True
+        academic_year.save()
+    return moved
+
+
+def roll_over(new_year, keep=1, make_current=True):
+    """Open `new_year` and archive every older year but the `keep` latest ones.
+
+    Returns {'scheduled': inserted payments, 'archived': {year: moved payments}}.
+    """
+    with transaction.atomic():
+        academic_year, _ = AcademicYear.objects.get_or_create(year=new_year)
+        if academic_year.is_archived:
+            raise ValueError(f'السنة {academic_year} مؤرشفة')
+        if make_current and not academic_year.is_current:
+            academic_year.is_current = True
+            academic_year.save()
+
+        scheduled = schedule_year(new_year)
+        archived = {year: archive_year(year) for year in years_to_archive(new_year, keep)}
+    return {'scheduled': scheduled, 'archived': archived}
@@ -0,0 +1,186 @@
+"""Synthetic students and payments for load testing.
+
+Everything goes in through batched INSERTs inside one transaction, so hundreds of thousands
+of students with their full payment history load in seconds.
+"""
+import random
+from datetime import datetime
+from datetime import timezone as dt_timezone
+from decimal import Decimal
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .academic_years import forget_years
+from .models import AcademicYear, Grade, Payment, PaymentSummary, Student
+from .stats_cache import invalidate_grades
+
+
+MALE_NAMES = [
+    'أحمد', 'محمد', 'محمود', 'مصطفى', 'علي', 'حسن', 'حسين', 'عمر', 'يوسف', 'إبراهيم',
+    'خالد', 'عبدالله', 'عبدالرحمن', 'كريم', 'طارق', 'سامي', 'هشام', 'وليد', 'ياسر', 'أيمن',
+    'إسلام', 'زياد', 'مروان', 'آدم', 'سيف', 'حمزة', 'أنس', 'بلال', 'عمرو', 'شريف',
+]
+FEMALE_NAMES = [
+    'فاطمة', 'مريم', 'نورا', 'سارة', 'آية', 'هدى', 'منى', 'ياسمين', 'رحمة', 'ملك',
+    'جنى', 'حبيبة', 'سلمى', 'دينا', 'رنا', 'نور', 'هبة', 'إيمان', 'أسماء', 'زينب',
+    'شهد', 'ندى', 'لمياء', 'رقية', 'خديجة', 'عائشة', 'بسمة', 'هالة', 'دعاء', 'مي',
+]
+FAMILY_NAMES = [
+    'السيد', 'عبدالعزيز', 'الشربيني', 'النجار', 'حسانين', 'عبدالحميد', 'المصري', 'الشافعي',
+    'سليمان', 'عثمان', 'منصور', 'رمضان', 'الجمال', 'فرج', 'شحاتة', 'عبدالفتاح', 'البنا',
+    'الحسيني', 'زكي', 'بدوي', 'صالح', 'مرسي', 'الدسوقي', 'عطية', 'جاد', 'خليل',
+]
+# Egyptian mobile prefixes
+PHONE_PREFIXES = ['010', '011', '012', '015']
+
+PAYMENT_COLUMNS = ['student_id', 'month', 'year', 'amount', 'is_paid', 'paid_at', 'created_at', 'updated_at']
+SUMMARY_COLUMNS = [
+    'student_id', 'year', 'payment_count', 'paid_count', 'paid_amount', 'pending_amount',
+    'paid_months', 'updated_at',
+]
+
+# Calendar month of each academic month, August and later belong to the first calendar year
+CALENDAR_MONTHS = {
+    'august': 8, 'september': 9, 'october': 10, 'november': 11, 'december': 12,
+    'january': 1, 'february': 2, 'march': 3, 'april': 4, 'may': 5, 'june': 6,
+}
+
+
+def random_full_name(rng):
+    first = rng.choice(MALE_NAMES + FEMALE_NAMES)
+    return f'{first} {rng.choice(MALE_NAMES)} {rng.choice(FAMILY_NAMES)}'
+
+
+def random_phone(rng):
+    return rng.choice(PHONE_PREFIXES) + ''.join(rng.choice('0123456789') for _ in range(8))
+
+
+def paid_at_pool(rng, years, size=64):
+    """Random payment times within each (month, year), already adapted for the database.
+
+    Drawing from a small pool keeps the per-row cost of a million payments down.
+    """
+    pool = {}
+    for year in years:
+        for month, calendar_month in CALENDAR_MONTHS.items():
+            calendar_year = year if calendar_month >= 8 else year + 1
+            pool[month, year] = [
+                connection.ops.adapt_datetimefield_value(datetime(
+                    calendar_year, calendar_month, rng.randint(1, 28),
+                    rng.randint(8, 20), rng.randrange(0, 60, 5), tzinfo=dt_timezone.utc,
+                ))
+                for _ in range(size)
+            ]
+    return pool
+
+
+def _insert_rows(model, columns, rows):
+    """executemany() of prepared row tuples on the raw DB-API cursor.
+
+    Skips bulk_create's per-field preparation and the DEBUG query log, which dominate
+    at a million rows.
+    """
+    ops = connection.ops
+    placeholder = '?' if connection.Database.paramstyle == 'qmark' else '%s'
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        ops.quote_name(model._meta.db_table),
+        ', '.join(ops.quote_name(column) for column in columns),
+        ', '.join([placeholder] * len(columns)),
+    )
+
+    connection.ensure_connection()
+    cursor = connection.connection.cursor()
+    try:
+        cursor.executemany(sql, rows)
+    finally:
+        cursor.close()
+
+
+def ensure_grades(default_fee=Decimal('500.00')):
+    """Grade rows for every choice, created once"""
+    Grade.objects.bulk_create(
+        [Grade(grade=code, monthly_fee=default_fee) for code, _ in Grade.GRADE_CHOICES],
+        ignore_conflicts=True,
+    )
+    return list(Grade.objects.all())
+
+
+def ensure_academic_years(years):
+    """AcademicYear rows for the generated years, created once"""
+    AcademicYear.objects.bulk_create([AcademicYear(year=year) for year in years], ignore_conflicts=True)
+    forget_years()
+
+
+def clear_students():
+    """Empty the student, payment and summary tables in one flush"""
+    tables = [model._meta.db_table for model in (PaymentSummary, Payment, Student)]
+    connection.ops.execute_sql_flush(
+        connection.ops.sql_flush(no_style(), tables, allow_cascade=True)
+    )
+    invalidate_grades(code for code, _ in Grade.GRADE_CHOICES)
+
+
+def generate_students(count, years, paid_ratio=0.7, exempt_ratio=0.02, seed=0,
+                      batch_size=2000, progress=None):
+    """Create `count` students spread over every grade with payments for each of `years`.
+
+    Deterministic for a given seed. `progress(created)` is called after every batch.
+    """
+    rng = random.Random(seed)
+    grades = ensure_grades()
+    ensure_academic_years(years)
+    months = Payment.MONTHS
+    paid_times = paid_at_pool(rng, years)
+
+    with transaction.atomic():
+        created = 0
+        while created < count:
+            size = min(batch_size, count - created)
+            students = [
+                Student(
+                    full_name=random_full_name(rng),
+                    father_phone_number=random_phone(rng),
+                    grade=rng.choice(grades),
+                    is_exempt=rng.random() < exempt_ratio,
+                )
+                for _ in range(size)
+            ]
+            for student in students:
+                student.refresh_search_key()
+            Student.objects.bulk_create(students)
+
+            ops = connection.ops
+            now = ops.adapt_datetimefield_value(timezone.now())
+            payment_rows, summary_rows = [], []
+            for student in students:
+                fee = student.grade.monthly_fee
+                db_fee = ops.adapt_decimalfield_value(fee)
+                for year in years:
+                    paid_mask = paid_count = 0
+                    for i, month in enumerate(months):
+                        is_paid = rng.random() < paid_ratio
+                        if is_paid:
+                            paid_mask |= 1 << i
+                            paid_count += 1
+                        payment_rows.append((
+                            student.id, month, year, db_fee, is_paid,
+                            rng.choice(paid_times[month, year]) if is_paid else None, now, now,
+                        ))
+                    summary_rows.append((
+                        student.id, year, len(months), paid_count,
+                        ops.adapt_decimalfield_value(fee * paid_count),
+                        ops.adapt_decimalfield_value(fee * (len(months) - paid_count)),
+                        paid_mask, now,
+                    ))
+
+            _insert_rows(Payment, PAYMENT_COLUMNS, payment_rows)
+            _insert_rows(PaymentSummary, SUMMARY_COLUMNS, summary_rows)
+
+            created += size
+            if progress:
+                progress(created)
+
+        invalidate_grades(grade.grade for grade in grades)
+    return created
@@ -0,0 +1,138 @@
+"""Normalized student search.
+
+Student.search_key holds the student's name with Arabic spelling variants folded and the
+father's phone number reduced to ASCII digits. Searches are normalized the same way and
+matched as substrings through a trigram index: pg_trgm on PostgreSQL, an FTS5 table with
+the trigram tokenizer on SQLite.
+"""
+import re
+import sqlite3
+import unicodedata
+from functools import lru_cache
+
+
+STUDENT_TABLE = 'core_student'
+PG_TRIGRAM_INDEX = 'student_search_key_trgm'
+FTS_TABLE = 'core_student_search'
+FTS_TRIGGERS = {
+    'core_student_search_ai': f"""
+        CREATE TRIGGER core_student_search_ai AFTER INSERT ON {STUDENT_TABLE} BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, search_key) VALUES (new.id, new.search_key);
+        END
+    """,
+    'core_student_search_ad': f"""
+        CREATE TRIGGER core_student_search_ad AFTER DELETE ON {STUDENT_TABLE} BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, search_key) VALUES ('delete', old.id, old.search_key);
+        END
+    """,
+    'core_student_search_au': f"""
+        CREATE TRIGGER core_student_search_au AFTER UPDATE OF search_key ON {STUDENT_TABLE} BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, search_key) VALUES ('delete', old.id, old.search_key);
+            INSERT INTO {FTS_TABLE}(rowid, search_key) VALUES (new.id, new.search_key);
+        END
+    """,
+}
+
+# The trigram tokenizer only indexes substrings of three characters or more
+MIN_TRIGRAM_LENGTH = 3
+
+# Harakat, Quranic marks and superscript alef
+_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed]')
+_TATWEEL = '\u0640'
+_LETTER_VARIANTS = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ة': 'ه',
+    'ى': 'ي',
+})
+# Arabic-Indic and Extended (Persian) digits
+_DIGITS = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '0123456789' * 2)
+_NON_DIGITS = re.compile('[^0-9]')
+_PHONE_PUNCTUATION = re.compile(r'[\s+\-().]')
+
+
+def normalize_text(text):
+    """Fold Arabic letter variants, drop diacritics and tatweel, lowercase, single spaces"""
+    text = unicodedata.normalize('NFKC', text or '')
+    text = _DIACRITICS.sub('', text).replace(_TATWEEL, '')
+    text = text.translate(_LETTER_VARIANTS).translate(_DIGITS).casefold()
+    return ' '.join(text.split())
+
+
+def phone_digits(phone):
+    """ASCII digits of a phone number, whatever digits and separators it was typed with"""
+    return _NON_DIGITS.sub('', (phone or '').translate(_DIGITS))
+
+
+def student_search_key(full_name, phone):
+    return f'{normalize_text(full_name)} {phone_digits(phone)}'.strip()
+
+
+def search_term(query):
+    """Normalized form of a search box entry: digits for phone numbers, folded text otherwise"""
+    compact = _PHONE_PUNCTUATION.sub('', (query or '').translate(_DIGITS))
+    if compact.isdigit():
+        return compact
+    return normalize_text(query)
+
+
+def fts_phrase(term):
+    """FTS5 phrase matching `term` literally"""
+    return '"' + term.replace('"', '""') + '"'
+
+
+@lru_cache(maxsize=None)
+def fts_trigram_available():
+    """The SQLite library has FTS5 with the trigram tokenizer (3.34+)"""
+    try:
+        probe = sqlite3.connect(':memory:')
+    except sqlite3.Error:
+        return False
+    try:
+        probe.execute("CREATE VIRTUAL TABLE probe USING fts5(value, tokenize='trigram')")
+        return True
+    except sqlite3.Error:
+        return False
+    finally:
+        probe.close()
+
+
+def uses_fts(connection):
+    return connection.vendor == 'sqlite' and fts_trigram_available()
+
+
+def install_search_index(connection):
+    """Create the trigram index of Student.search_key when the backend has one. Idempotent."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {PG_TRIGRAM_INDEX} ON {STUDENT_TABLE} '
+                f'USING gin (search_key gin_trgm_ops)'
+            )
+        elif uses_fts(connection):
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s",
+                [STUDENT_TABLE],
+            )
+            if set(FTS_TRIGGERS) <= {name for name, in cursor.fetchall()}:
+                return
+            # Triggers go missing when a migration rebuilds the student table,
+            # recreate them and re-index from the table
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5('
+                f"search_key, content='{STUDENT_TABLE}', content_rowid='id', tokenize='trigram')"
+            )
+            for name, sql in FTS_TRIGGERS.items():
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+                cursor.execute(sql)
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def remove_search_index(connection):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'DROP INDEX IF EXISTS {PG_TRIGRAM_INDEX}')
+        elif connection.vendor == 'sqlite':
+            for name in FTS_TRIGGERS:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+            cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from .academic_years import forget_years
+from .models import AcademicYear, Grade, Student
+from .search import STUDENT_TABLE, install_search_index
+from .stats_cache import invalidate_grades
+
+
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+def invalidate_student_stats(sender, instance, using, **kwargs):
+    """Student counts changed for the student's grade (and the old one if it moved)"""
+    grade_ids = {instance.grade_id, getattr(instance, '_loaded_grade_id', None)} - {None}
+    invalidate_grades(
+        Grade.objects.using(using).filter(id__in=grade_ids).values_list('grade', flat=True),
+        using=using,
+    )
+    instance._loaded_grade_id = instance.grade_id
+
+
+@receiver(post_save, sender=Grade)
+@receiver(post_delete, sender=Grade)
+def invalidate_grade_stats(sender, instance, using, **kwargs):
+    invalidate_grades([instance.grade], using=using)
+
+
+@receiver(post_migrate)
+def ensure_search_index(sender, using, **kwargs):
+    """Restore the SQLite search triggers after a migration rebuilt the student table"""
+    if sender.name != 'core':
+        return
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if STUDENT_TABLE not in connection.introspection.table_names(cursor):
+            return
+        columns = {column.name for column in connection.introspection.get_table_description(cursor, STUDENT_TABLE)}
+    if 'search_key' in columns:
+        install_search_index(connection)
+
+
+@receiver(post_save, sender=AcademicYear)
+@receiver(post_delete, sender=AcademicYear)
+def refresh_current_year(sender, **kwargs):
+    forget_years()
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    """Apply settings.SQLITE_PRAGMAS to every new SQLite connection"""
+    if connection.vendor != 'sqlite':
+        return
+    # On the raw connection so the statements stay out of the query log
+    for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+        connection.connection.execute(f'PRAGMA {name} = {value}')
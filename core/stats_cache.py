@@ -0,0 +1,100 @@
+"""Versioned cache for dashboard statistics.
+
+Every grade has a version token in the cache. Cached statistics are stored under a key
+built from the tokens of the grades they cover, so replacing the token of one grade
+(after a write touching it commits) makes every entry involving that grade unreachable
+while entries for other grade sets stay warm. Tokens start with the time they were made,
+which tells the replica router how recently a grade was written.
+"""
+import hashlib
+import time
+import uuid
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+
+
+# Cached entries are invalidated explicitly, the timeout only bounds memory use
+STATS_TIMEOUT = 60 * 60 * 24
+
+
+def _new_token():
+    # Milliseconds, rounded down
+    return f'{int(time.time() * 1000)}:{uuid.uuid4().hex}'
+
+
+def _token_time(token):
+    stamp, _, _ = token.partition(':')
+    try:
+        return int(stamp) / 1000
+    except ValueError:
+        return 0.0
+
+
+def grade_scope(selected_grades):
+    """Sorted grade codes covered by a grades filter (empty or 'all' means every grade)"""
+    if not selected_grades or 'all' in selected_grades:
+        Grade = apps.get_model('core', 'Grade')
+        return sorted(code for code, _ in Grade.GRADE_CHOICES)
+    return sorted(set(selected_grades))
+
+
+def _version_key(grade_code):
+    return f'core:stats-version:{grade_code}'
+
+
+def grade_versions(grade_codes):
+    """Current version token of each grade, creating tokens that don't exist yet"""
+    keys = {_version_key(code): code for code in grade_codes}
+    found = cache.get_many(keys)
+    # A missing token may have been evicted right after a write, so it counts as new
+    missing = {key: _new_token() for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        found.update(missing)
+    return {code: found[key] for key, code in keys.items()}
+
+
+def changed_within(grade_codes, seconds):
+    """Some grade in the scope was written to (or lost its token) within the last `seconds`"""
+    versions = grade_versions(grade_codes)
+    # After the lookup, which may create tokens stamped now
+    cutoff = time.time() - seconds
+    return any(_token_time(token) > cutoff for token in versions.values())
+
+
+def scope_token(grade_codes):
+    """Token that changes whenever any grade in the scope is invalidated"""
+    versions = grade_versions(grade_codes)
+    raw = '|'.join(f'{code}={versions[code]}' for code in grade_codes)
+    return hashlib.md5(raw.encode()).hexdigest()
+
+
+def cached_stats(name, selected_grades, compute):
+    """Return `compute(grade_codes)` for the grade scope, from the cache when still valid"""
+    grade_codes = grade_scope(selected_grades)
+    key = f'core:stats:{name}:{scope_token(grade_codes)}'
+    stats = cache.get(key)
+    if stats is None:
+        stats = compute(grade_codes)
+        cache.set(key, stats, timeout=STATS_TIMEOUT)
+    return stats
+
+
+def stats_etag(name, selected_grades):
+    """ETag of `cached_stats(name, selected_grades, ...)`, changing whenever its entry does"""
+    token = scope_token(grade_scope(selected_grades))
+    return hashlib.md5(f'{name}:{token}'.encode()).hexdigest()
+
+
+def invalidate_grades(grade_codes, using=None):
+    """Drop cached statistics of the given grades once the current transaction commits"""
+    grade_codes = set(grade_codes) - {None}
+    if not grade_codes:
+        return
+
+    def bump():
+        cache.set_many({_version_key(code): _new_token() for code in grade_codes}, timeout=None)
+
+    transaction.on_commit(bump, using=using)
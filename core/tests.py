@@ -1,3 +1,1174 @@
-from django.test import TestCase
+import base64
+import json
+import math
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
+from xml.etree import ElementTree
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import Count, Sum
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from src.database import parse_database_url
+
+from .academic_years import current_year, forget_years
+from .bench import view_scenarios
+from .jobs import claim_next_job, enqueue_students_export, purge_expired, requeue_stale, run_job
+from .management.commands.run_workers import _work
+from .middleware import QueryInstrumentationMiddleware, sql_shape
+from .models import AcademicYear, ExportJob, Grade, Payment, PaymentArchive, PaymentSummary, Student
+from .payments import reprice_unpaid_payments, toggle_payment
+from .reports import MONTHS, SORT_ORDERINGS, filtered_matrix, keyset_window, month_flags
+from .rollover import roll_over
+from .routers import PrimaryReplicaRouter, read_alias
+from .sample_data import generate_students
+from .stats_cache import invalidate_grades
+from .xlsx import column_letter
+
+
+# Most queries one request to each URL may run, whatever the number of students
+QUERY_BUDGETS = {
+    'dashboard': 3,
+    'dashboard_cached': 0,
+    'dashboard_stats': 2,
+    'grade_selection': 1,
+    'students_list': 4,
+    'students_rows': 3,
+    # Validator lookup, student with its summary, payments
+    'student_detail': 3,
+    'payment_history': 4,
+    'update_payment': 6,
+    'update_payments': 13,
+    'monthly_revenue': 1,
+    'revenue_matrix': 1,
+    'revenue_matrix_not_modified': 0,
+    # Revalidations answered with 304
+    'dashboard_not_modified': 0,
+    'dashboard_stats_not_modified': 0,
+    'students_list_not_modified': 0,
+    'student_detail_not_modified': 1,
+    'monthly_revenue_not_modified': 0,
+    'export_students_csv': 1,
+    # Students of every grade, then the payments of each chunk of EXPORT_CHUNK_SIZE students
+    'export_students_xlsx': 2,
+    'start_export': 1,
+    'export_job_status': 1,
+    'download_export': 1,
+    'add_student_form': 1,
+    'add_student': 10,
+    'bulk_add_students_form': 1,
+    'bulk_add_students': 10,
+    'update_student_form': 2,
+    'update_student': 5,
+    'delete_student_form': 2,
+    'delete_student': 12,
+}
+
+# Slowest acceptable request, in seconds, on the mid-sized dataset
+WALL_TIME_CEILINGS = {
+    'dashboard': 0.5,
+    'students_list': 1.5,
+    'students_rows': 1.0,
+    'student_detail': 0.5,
+    'export_students_csv': 2.0,
+}
+
+ALL_GRADES = [code for code, _ in Grade.GRADE_CHOICES]
+
+# Keep test runs away from the project's cache directory and a running server's version tokens
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'core-tests',
+    }
+}
+
+
+def fetch(client, method, url, data=None):
+    """Send a request and read the whole body, streamed or not"""
+    if method == 'post_json':
+        response = client.post(url, json.dumps(data), content_type='application/json')
+    else:
+        response = getattr(client, method)(url, data)
+    if response.streaming:
+        response.content_bytes = b''.join(response.streaming_content)
+    return response
+
+
+def read_workbook(content):
+    """{sheet title: rows of cell values} of an XLSX file, numbers as floats"""
+    namespace = {'x': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+    with zipfile.ZipFile(BytesIO(content)) as workbook:
+        titles = [sheet.get('name') for sheet in ElementTree.fromstring(
+            workbook.read('xl/workbook.xml')
+        ).iterfind('x:sheets/x:sheet', namespace)]
+        sheets = {}
+        for index, title in enumerate(titles, start=1):
+            rows = []
+            root = ElementTree.fromstring(workbook.read(f'xl/worksheets/sheet{index}.xml'))
+            for row in root.iterfind('x:sheetData/x:row', namespace):
+                cells = {}
+                for cell in row:
+                    column = cell.get('r').rstrip('0123456789')
+                    if cell.get('t') == 'inlineStr':
+                        cells[column] = cell.find('x:is/x:t', namespace).text
+                    else:
+                        cells[column] = float(cell.find('x:v', namespace).text)
+                rows.append(cells)
+            sheets[title] = rows
+    return sheets
+
+
+class SeededDataMixin:
+    """Students with a full year of payments generated once per test class"""
+    student_count = None
+
+    @classmethod
+    def setUpTestData(cls):
+        forget_years()
+        generate_students(cls.student_count, [current_year()], seed=1)
+        cls.student = Student.objects.select_related('grade').order_by('id').first()
+        cls.grade = cls.student.grade
+
+    def setUp(self):
+        cache.clear()
+        # Load the current-year pointer outside the measured requests
+        forget_years()
+        current_year()
+
+
+class QueryBudgetMixin(SeededDataMixin):
+    """Query budget of every URL in core/urls.py.
+
+    The same tests run on datasets of different sizes, so a budget only holds when the
+    number of queries does not grow with the number of students.
+    """
+
+    def assertQueryBudget(self, name, method, url, data=None, status=200):
+        with CaptureQueriesContext(connection) as queries:
+            response = fetch(self.client, method, url, data)
+        self.assertEqual(response.status_code, status)
+        budget = QUERY_BUDGETS[name]
+        self.assertLessEqual(
+            len(queries), budget,
+            f'{name} ran {len(queries)} queries, budget is {budget}:\n'
+            + '\n'.join(query['sql'] for query in queries.captured_queries)
+        )
+        return response
+
+    def test_dashboard(self):
+        self.assertQueryBudget('dashboard', 'get', reverse('core:dashboard'))
+        self.assertQueryBudget('dashboard_cached', 'get', reverse('core:dashboard'))
+        self.assertQueryBudget('dashboard', 'get', reverse('core:dashboard'), {'grades': ['grade7', 'grade9']})
+
+    def test_dashboard_stats(self):
+        response = self.assertQueryBudget('dashboard_stats', 'get', reverse('core:dashboard_stats'))
+        self.assertEqual(response.json()['data']['total_students'], self.student_count)
+
+    def test_grade_selection(self):
+        self.assertQueryBudget('grade_selection', 'get', reverse('core:grade_selection'))
+
+    def test_students_list(self):
+        url = reverse('core:students_list')
+        for params in [
+            {'grades': 'all'},
+            {'grades': ALL_GRADES, 'sort': 'payments'},
+            {'grades': 'grade7', 'payment_status': 'partial', 'sort': 'grade'},
+            {'grades': 'all', 'payment_status': 'unpaid', 'month': 'october'},
+            {'grades': 'all', 'search': self.student.full_name.split()[0]},
+        ]:
+            with self.subTest(params=params):
+                self.assertQueryBudget('students_list', 'get', url, params)
+
+    def test_students_rows(self):
+        response = self.client.get(reverse('core:students_list'), {'grades': 'all'})
+        cursor = response.context['next_cursor']
+        response = self.assertQueryBudget(
+            'students_rows', 'get', reverse('core:students_rows'), {'grades': 'all', 'cursor': cursor}
+        )
+        self.assertTrue(response.json()['success'])
+
+    def test_student_detail(self):
+        self.assertQueryBudget('student_detail', 'get', reverse('core:student_detail', args=[self.student.id]))
+
+    def test_payment_history(self):
+        self.assertQueryBudget('payment_history', 'get', reverse('core:payment_history', args=[self.student.id]))
+
+    def test_update_payment(self):
+        for is_paid in (True, False):
+            response = self.assertQueryBudget('update_payment', 'post_json', reverse('core:update_payment'), {
+                'student_id': self.student.id, 'month': 'march', 'is_paid': is_paid,
+            })
+            self.assertTrue(response.json()['success'])
+
+    def test_update_payments(self):
+        student_ids = Student.objects.order_by('id').values_list('id', flat=True)[:25]
+        changes = [
+            {'student_id': student_id, 'month': month, 'is_paid': True}
+            for student_id in student_ids
+            for month in ('august', 'june')
+        ]
+        response = self.assertQueryBudget(
+            'update_payments', 'post_json', reverse('core:update_payments'), {'changes': changes}
+        )
+        self.assertTrue(response.json()['success'])
+
+    def test_monthly_revenue(self):
+        self.assertQueryBudget('monthly_revenue', 'get', reverse('core:monthly_revenue'), {'month': 'october'})
+
+    def test_revenue_matrix(self):
+        url = reverse('core:revenue_matrix')
+        response = self.assertQueryBudget('revenue_matrix', 'get', url, {'grades': 'all'})
+        self.assertEqual(len(response.json()['data']['grades']), len(ALL_GRADES))
+        self.client.defaults['HTTP_IF_NONE_MATCH'] = response['ETag']
+        self.assertQueryBudget('revenue_matrix_not_modified', 'get', url, {'grades': 'all'}, status=304)
+
+    def test_not_modified(self):
+        requests = [
+            ('dashboard', reverse('core:dashboard'), None),
+            ('dashboard_stats', reverse('core:dashboard_stats'), {'grades': 'grade7'}),
+            ('students_list', reverse('core:students_list'), {'grades': 'all'}),
+            ('student_detail', reverse('core:student_detail', args=[self.student.id]), None),
+            ('monthly_revenue', reverse('core:monthly_revenue'), {'month': 'may'}),
+        ]
+        for name, url, data in requests:
+            with self.subTest(name):
+                etag = fetch(self.client, 'get', url, data)['ETag']
+                self.client.defaults['HTTP_IF_NONE_MATCH'] = etag
+                self.assertQueryBudget(f'{name}_not_modified', 'get', url, data, status=304)
+                del self.client.defaults['HTTP_IF_NONE_MATCH']
+
+    def test_export_students_csv(self):
+        response = self.assertQueryBudget(
+            'export_students_csv', 'get', reverse('core:export_students_csv'), {'grades': 'all'}
+        )
+        # BOM line plus header, then one line per student
+        self.assertEqual(response.content_bytes.decode().count('\n'), self.student_count + 1)
+
+    def test_export_students_xlsx(self):
+        response = self.assertQueryBudget(
+            'export_students_xlsx', 'get', reverse('core:export_students_xlsx'), {'grades': 'all'}
+        )
+        sheets = read_workbook(response.content_bytes)
+        # Header and totals rows around each grade's students
+        self.assertEqual(sum(len(rows) - 2 for rows in sheets.values()), self.student_count)
+
+    def test_export_students_xlsx_chunks(self):
+        # One payments query per chunk of students, whatever the number of grades
+        with mock.patch('core.reports.EXPORT_CHUNK_SIZE', 25), CaptureQueriesContext(connection) as queries:
+            response = fetch(self.client, 'get', reverse('core:export_students_xlsx'), {'grades': 'all'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1 + math.ceil(self.student_count / 25))
+
+    def test_background_export(self):
+        with tempfile.TemporaryDirectory() as root, override_settings(EXPORT_ROOT=root):
+            response = self.assertQueryBudget(
+                'start_export', 'post_json', reverse('core:start_export'), {'grades': ['all'], 'year': current_year()}
+            )
+            job = response.json()['data']
+            run_job(claim_next_job())
+
+            response = self.assertQueryBudget('export_job_status', 'get', job['status_url'])
+            download_url = response.json()['data']['download_url']
+            response = self.assertQueryBudget('download_export', 'get', download_url)
+            streamed = fetch(self.client, 'get', reverse('core:export_students_csv'), {'grades': 'all'})
+            self.assertEqual(response.content_bytes, streamed.content_bytes)
+
+    def test_add_student(self):
+        url = reverse('core:add_student')
+        self.assertQueryBudget('add_student_form', 'get', url)
+        self.assertQueryBudget('add_student', 'post', url, {
+            'full_name': 'طالب جديد', 'father_phone_number': '01000000000', 'grade': self.grade.id,
+        }, status=302)
+
+    def test_bulk_add_students(self):
+        url = reverse('core:bulk_add_students')
+        self.assertQueryBudget('bulk_add_students_form', 'get', url)
+        lines = '\n'.join(f'طالب جديد {i}، 011{i:08d}' for i in range(40))
+        self.assertQueryBudget('bulk_add_students', 'post', url, {'grade': self.grade.id, 'students': lines}, status=302)
+        self.assertEqual(PaymentSummary.objects.filter(student__full_name__startswith='طالب جديد').count(), 40)
+
+    def test_update_student(self):
+        url = reverse('core:update_student', args=[self.student.id])
+        self.assertQueryBudget('update_student_form', 'get', url)
+        self.assertQueryBudget('update_student', 'post', url, {
+            'full_name': self.student.full_name, 'father_phone_number': '01200000000', 'grade': self.grade.id,
+        }, status=302)
+
+    def test_delete_student(self):
+        url = reverse('core:delete_student', args=[self.student.id])
+        self.assertQueryBudget('delete_student_form', 'get', url)
+        self.assertQueryBudget('delete_student', 'post', url, status=302)
+        self.assertFalse(Payment.objects.filter(student_id=self.student.id).exists())
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SmallDatasetQueryBudgetTests(QueryBudgetMixin, TestCase):
+    student_count = 60
+
+
+@override_settings(CACHES=TEST_CACHES)
+class MidDatasetQueryBudgetTests(QueryBudgetMixin, TestCase):
+    student_count = 1500
+
+
+@override_settings(CACHES=TEST_CACHES)
+class WallTimeCeilingTests(SeededDataMixin, TestCase):
+    """Matrix, export and dashboard requests stay under a fixed time on the mid-sized dataset"""
+    student_count = 1500
+
+    def assertFasterThan(self, name, url, data=None, attempts=3):
+        # Best of a few attempts, so one slow run on a busy machine doesn't fail the build
+        timings = []
+        for _ in range(attempts):
+            cache.clear()
+            started = time.perf_counter()
+            response = fetch(self.client, 'get', url, data)
+            timings.append(time.perf_counter() - started)
+            self.assertEqual(response.status_code, 200)
+        self.assertLess(
+            min(timings), WALL_TIME_CEILINGS[name],
+            f'{name} took {min(timings):.3f}s, ceiling is {WALL_TIME_CEILINGS[name]}s'
+        )
+
+    def test_dashboard(self):
+        self.assertFasterThan('dashboard', reverse('core:dashboard'))
+
+    def test_students_list(self):
+        self.assertFasterThan('students_list', reverse('core:students_list'), {'grades': 'all', 'sort': 'payments'})
+        self.assertFasterThan('students_list', reverse('core:students_list'), {
+            'grades': 'all', 'payment_status': 'unpaid', 'month': 'march',
+        })
+
+    def test_students_rows(self):
+        response = self.client.get(reverse('core:students_list'), {'grades': 'all'})
+        self.assertFasterThan('students_rows', reverse('core:students_rows'), {
+            'grades': 'all', 'cursor': response.context['next_cursor'],
+        })
+
+    def test_student_detail(self):
+        self.assertFasterThan('student_detail', reverse('core:student_detail', args=[self.student.id]))
+
+    def test_export_students_csv(self):
+        self.assertFasterThan('export_students_csv', reverse('core:export_students_csv'), {'grades': 'all'})
+
+
+@override_settings(CACHES=TEST_CACHES)
+class PaymentSummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        forget_years()
+        cls.year = current_year()
+        generate_students(12, [cls.year - 1, cls.year], paid_ratio=0.5, seed=10)
+        cls.student = Student.objects.order_by('id').first()
+
+    def assertSummariesMatchPayments(self):
+        """Every summary row equals the totals and paid-months bitmask of its Payment rows"""
+        expected = {}
+        for payment in Payment.objects.all():
+            row = expected.setdefault((payment.student_id, payment.year), {
+                'payment_count': 0, 'paid_count': 0, 'paid_amount': Decimal('0'),
+                'pending_amount': Decimal('0'), 'paid_months': 0,
+            })
+            row['payment_count'] += 1
+            if payment.is_paid:
+                row['paid_count'] += 1
+                row['paid_amount'] += payment.amount
+                row['paid_months'] |= Payment.month_bit(payment.month)
+            else:
+                row['pending_amount'] += payment.amount
+        summaries = {
+            (row.pop('student_id'), row.pop('year')): row
+            for row in PaymentSummary.objects.values(
+                'student_id', 'year', 'payment_count', 'paid_count', 'paid_amount', 'pending_amount', 'paid_months'
+            )
+        }
+        self.assertEqual(summaries, expected)
+
+    def payment(self, **filters):
+        return Payment.objects.filter(student=self.student, **filters).order_by('id').first()
+
+    def test_save(self):
+        previous_year = PaymentSummary.objects.get(student=self.student, year=self.year - 1).id
+
+        payment = self.payment(year=self.year, is_paid=False)
+        payment.is_paid = True
+        payment.save()
+        self.assertSummariesMatchPayments()
+
+        payment.amount = Decimal('123.45')
+        payment.save()
+        self.assertSummariesMatchPayments()
+        # Only the saved payment's year is rebuilt
+        self.assertTrue(PaymentSummary.objects.filter(id=previous_year).exists())
+
+        payment = self.payment(year=self.year - 1, month='may')
+        Payment.objects.filter(student=self.student, year=self.year - 2).delete()
+        payment.year = self.year - 2
+        payment.save()
+        self.assertSummariesMatchPayments()
+
+    def test_delete(self):
+        self.payment(year=self.year, is_paid=True).delete()
+        self.assertSummariesMatchPayments()
+
+        Payment.objects.filter(student=self.student, year=self.year - 1).delete()
+        self.assertFalse(PaymentSummary.objects.filter(student=self.student, year=self.year - 1).exists())
+        Payment.objects.filter(month='june', is_paid=True).delete()
+        self.assertSummariesMatchPayments()
+
+    def test_rebuild_command(self):
+        PaymentSummary.objects.filter(student=self.student).delete()
+        PaymentSummary.objects.update(paid_months=0, paid_amount=0)
+        call_command('rebuild_payment_summaries', stdout=StringIO())
+        self.assertSummariesMatchPayments()
+
+
+@override_settings(CACHES=TEST_CACHES)
+class PaymentMatrixTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        forget_years()
+        cls.year = current_year()
+        generate_students(30, [cls.year - 1, cls.year], paid_ratio=0.5, seed=9)
+        cls.paid, cls.unpaid = Student.objects.order_by('id')[:2]
+        Payment.objects.filter(student=cls.paid, year=cls.year).update(is_paid=True, paid_at=timezone.now())
+        Payment.objects.filter(student=cls.unpaid, year=cls.year).update(is_paid=False, paid_at=None)
+        PaymentSummary.objects.rebuild()
+        cls.without_payments = Student.objects.create(
+            full_name='طالب بدون دفعات', grade=cls.paid.grade, father_phone_number='01000000000'
+        )
+
+    def expected(self, student):
+        """Paid months and paid total of `student` in the current year, from its Payment rows"""
+        payments = Payment.objects.filter(student=student, year=self.year)
+        paid = payments.filter(is_paid=True)
+        return {
+            'months': {month: paid.filter(month=month).exists() for month in MONTHS},
+            'total_paid': paid.aggregate(total=Sum('amount'))['total'] or Decimal('0'),
+            'total_pending': payments.filter(is_paid=False).aggregate(total=Sum('amount'))['total'] or Decimal('0'),
+        }
+
+    def test_matches_the_payments(self):
+        students = Student.objects.with_payment_matrix(self.year)
+        self.assertEqual(students.count(), Student.objects.count())
+        for student in students:
+            with self.subTest(student=student.id):
+                expected = self.expected(student)
+                self.assertEqual(month_flags(student), expected['months'])
+                self.assertEqual(student.paid_months, sum(expected['months'].values()))
+                self.assertEqual(student.total_paid, expected['total_paid'])
+                self.assertEqual(student.total_pending, expected['total_pending'])
+
+    def test_other_years_are_left_out(self):
+        Payment.objects.filter(student=self.unpaid, year=self.year - 1).update(is_paid=True)
+        PaymentSummary.objects.rebuild(student_ids=[self.unpaid.id])
+        student = Student.objects.with_payment_matrix(self.year).get(id=self.unpaid.id)
+        self.assertEqual((student.paid_months, student.total_paid), (0, 0))
+        self.assertFalse(any(month_flags(student).values()))
+
+    def test_student_without_payments(self):
+        student = Student.objects.with_payment_matrix(self.year).get(id=self.without_payments.id)
+        self.assertEqual((student.paid_months, student.total_paid, student.total_pending), (0, 0, 0))
+
+    def test_payment_status_filters(self):
+        paid_months = {student.id: sum(self.expected(student)['months'].values()) for student in Student.objects.all()}
+        paid_in_october = set(Payment.objects.filter(year=self.year, month='october', is_paid=True).values_list(
+            'student_id', flat=True
+        ))
+        expected = {
+            ('paid', 'all'): {id for id, count in paid_months.items() if count == len(MONTHS)},
+            ('partial', 'all'): {id for id, count in paid_months.items() if 0 < count < len(MONTHS)},
+            ('unpaid', 'all'): {id for id, count in paid_months.items() if count == 0},
+            ('paid', 'october'): paid_in_october,
+            ('unpaid', 'october'): set(paid_months) - paid_in_october,
+            ('partial', 'october'): set(paid_months) - paid_in_october,
+        }
+        self.assertIn(self.paid.id, expected['paid', 'all'])
+        self.assertTrue(expected['partial', 'all'])
+        self.assertIn(self.without_payments.id, expected['unpaid', 'all'])
+        for (status, month), ids in expected.items():
+            with self.subTest(status=status, month=month):
+                students = filtered_matrix(Student.objects.all(), self.year, status, month)
+                self.assertEqual(set(students.values_list('id', flat=True)), ids)
+
+    def test_sort_orderings(self):
+        students = list(Student.objects.select_related('grade'))
+        totals = {student.id: self.expected(student)['total_paid'] for student in students}
+        expected = {
+            'name': sorted(students, key=lambda student: (student.full_name, student.id)),
+            'grade': sorted(students, key=lambda student: (student.grade.grade, student.full_name, student.id)),
+            'payments': sorted(students, key=lambda student: (-totals[student.id], student.full_name, student.id)),
+        }
+        self.assertEqual(set(expected), set(SORT_ORDERINGS))
+        for sort_by, ordered in expected.items():
+            with self.subTest(sort_by=sort_by):
+                students = filtered_matrix(Student.objects.all(), self.year, sort_by=sort_by)
+                self.assertEqual(list(students.values_list('id', flat=True)), [student.id for student in ordered])
+
+    def test_keyset_windows_cover_every_student(self):
+        for sort_by in SORT_ORDERINGS:
+            with self.subTest(sort_by=sort_by):
+                students = filtered_matrix(Student.objects.all(), self.year, sort_by=sort_by)
+                seen, cursor = [], None
+                while True:
+                    window, cursor = keyset_window(students, sort_by, cursor, size=7)
+                    seen += [student.id for student in window]
+                    if cursor is None:
+                        break
+                self.assertEqual(seen, list(students.values_list('id', flat=True)))
+
+    def test_malformed_cursors(self):
+        def cursor(values):
+            return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+        for sort_by, values in [
+            ('payments', ['abc', 'x', '1']),
+            ('payments', ['NaN', 'x', '1']),
+            ('payments', ['Infinity', 'x', '1']),
+            ('payments', ['100', 'x', 'one']),
+            ('payments', [100, 'x', 1]),
+            ('name', ['x', '1.5']),
+            ('name', ['x']),
+            ('grade', None),
+        ]:
+            with self.subTest(sort_by=sort_by, values=values):
+                response = self.client.get(reverse('core:students_rows'), {
+                    'grades': 'all', 'sort': sort_by, 'cursor': cursor(values),
+                })
+                self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('core:students_rows'), {'grades': 'all', 'cursor': 'not base64!'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BenchScenarioTests(TestCase):
+    def test_update_payment_flips_a_cell_every_request(self):
+        forget_years()
+        generate_students(5, [current_year()], paid_ratio=0.5, seed=11)
+        update_payment = dict(view_scenarios())['update_payment']
+        # Twice over every (student, month) cell the scenario rotates through
+        for i in range(2 * 5 * len(Payment.MONTHS)):
+            before = Payment.objects.filter(is_paid=True).count()
+            response = update_payment(self.client, i)
+            self.assertTrue(response.json()['success'])
+            self.assertNotEqual(Payment.objects.filter(is_paid=True).count(), before, f'request {i} changed nothing')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class CsrfProtectionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        forget_years()
+        generate_students(3, [current_year()], seed=6)
+
+    def setUp(self):
+        self.client = Client(enforce_csrf_checks=True)
+
+    def test_post_endpoints_require_the_token(self):
+        for url, data in [
+            (reverse('core:update_payments'), {'changes': []}),
+            (reverse('core:start_export'), {'grades': ['all'], 'year': current_year()}),
+        ]:
+            with self.subTest(url=url):
+                response = self.client.post(url, json.dumps(data), content_type='application/json')
+                self.assertEqual(response.status_code, 403)
+        self.assertFalse(ExportJob.objects.exists())
+
+    def test_token_header_is_accepted(self):
+        self.client.get(reverse('core:students_list'), {'grades': 'all'})
+        response = self.client.post(
+            reverse('core:start_export'), json.dumps({'grades': ['all'], 'year': current_year()}),
+            content_type='application/json', HTTP_X_CSRFTOKEN=self.client.cookies['csrftoken'].value,
+        )
+        self.assertTrue(response.json()['success'])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TogglePaymentTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        forget_years()
+        generate_students(1, [current_year()], paid_ratio=0.5, seed=7)
+        cls.student = Student.objects.select_related('grade').get()
+
+    def test_cell_already_in_the_requested_state(self):
+        year = current_year()
+        payment = Payment.objects.filter(student=self.student, year=year, is_paid=True).first()
+        summary = PaymentSummary.objects.get(student=self.student, year=year)
+
+        amount, total_paid = toggle_payment(self.student, payment.month, year, True)
+        self.assertEqual((amount, total_paid), (payment.amount, summary.paid_amount))
+        self.assertEqual(PaymentSummary.objects.get(student=self.student, year=year).updated_at, summary.updated_at)
+
+        # No summary row is made up for a student whose payments didn't change
+        summary.delete()
+        amount, total_paid = toggle_payment(self.student, payment.month, year, True)
+        self.assertEqual((amount, total_paid), (payment.amount, 0))
+        self.assertFalse(PaymentSummary.objects.exists())
+
+
+@override_settings(CACHES=TEST_CACHES)
+class QueryInstrumentationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        forget_years()
+        generate_students(3, [current_year()], seed=8)
+
+    @override_settings(QUERY_INSTRUMENTATION=True)
+    def test_server_timing_and_log_record(self):
+        with CaptureQueriesContext(connection) as queries, self.assertLogs('core.instrumentation', 'INFO') as logs:
+            response = self.client.get(reverse('core:grade_selection'))
+
+        self.assertRegex(response['Server-Timing'], rf'^db;dur=[\d.]+;desc="{len(queries)} queries", view;dur=[\d.]+')
+        [line] = logs.records
+        record = json.loads(line.getMessage())
+        self.assertEqual(record['path'], reverse('core:grade_selection'))
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['queries'], len(queries))
+        self.assertGreater(record['queries'], 0)
+        self.assertEqual(len(record['slowest']), min(len(queries), 3))
+        self.assertEqual({query['alias'] for query in record['slowest']}, {'default'})
+        self.assertEqual(record['n_plus_one'], [])
+
+    @override_settings(QUERY_INSTRUMENTATION=True, QUERY_INSTRUMENTATION_N_PLUS_ONE=3)
+    def test_repeated_queries_are_flagged(self):
+        def view(request):
+            # One grade lookup per student, the textbook N+1
+            return HttpResponse(', '.join(student.grade.grade_name for student in Student.objects.all()))
+
+        middleware = QueryInstrumentationMiddleware(view)
+        with self.assertLogs('core.instrumentation', 'WARNING') as logs:
+            response = middleware(RequestFactory().get('/students/'))
+
+        self.assertIn('n-plus-one;desc="1 repeated shapes"', response['Server-Timing'])
+        [line] = logs.records
+        self.assertEqual(line.levelname, 'WARNING')
+        [repeated] = json.loads(line.getMessage())['n_plus_one']
+        self.assertEqual(repeated['count'], Student.objects.count())
+        self.assertIn('"core_grade"', repeated['sql'])
+
+    @override_settings(QUERY_INSTRUMENTATION=False)
+    def test_disabled(self):
+        with self.assertNoLogs('core.instrumentation'):
+            response = self.client.get(reverse('core:grade_selection'))
+        self.assertNotIn('Server-Timing', response)
+
+
+class SqlShapeTests(SimpleTestCase):
+    def test_literals_and_in_lists_collapse(self):
+        shapes = {
+            sql_shape('SELECT * FROM "core_payment" WHERE "student_id" IN (%s, %s, %s) AND "year" = 2025'),
+            sql_shape('SELECT * FROM "core_payment" WHERE "student_id" IN (%s)  AND "year" = 2026'),
+            sql_shape('SELECT * FROM "core_payment"\nWHERE "student_id" IN (%s,%s) AND "year" = 7'),
+        }
+        self.assertEqual(shapes, {'SELECT * FROM "core_payment" WHERE "student_id" IN (...) AND "year" = ?'})
+        self.assertEqual(
+            sql_shape("SELECT 1 FROM \"core_student\" WHERE \"full_name\" = 'O''Brien'"),
+            sql_shape("SELECT 2 FROM \"core_student\" WHERE \"full_name\" = 'أحمد'"),
+        )
+
+    def test_tables_stay_apart(self):
+        self.assertNotEqual(
+            sql_shape('SELECT * FROM "core_payment" WHERE "id" = %s'),
+            sql_shape('SELECT * FROM "core_student" WHERE "id" = %s'),
+        )
+
+
+@override_settings(CACHES=TEST_CACHES)
+class StudentSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        grade = Grade.objects.create(grade='grade7')
+        cls.ahmed = Student.objects.create(full_name='أحمد محمود السيد', father_phone_number='0100 123 4567', grade=grade)
+        cls.fatma = Student.objects.create(full_name='فاطمة مصطفى', father_phone_number='٠١١٢٣٤٥٦٧٨٩', grade=grade)
+        cls.mona = Student.objects.create(full_name='منى عليّ', father_phone_number='01512345678', grade=grade)
+
+    def assertFound(self, query, *students):
+        self.assertEqual(set(Student.objects.search(query)), set(students), query)
+
+    def test_letter_variants(self):
+        self.assertFound('احمد', self.ahmed)
+        self.assertFound('إحمد', self.ahmed)
+        self.assertFound('فاطمه', self.fatma)
+        self.assertFound('مني علي', self.mona)
+
+    def test_diacritics_and_tatweel(self):
+        self.assertFound('أَحْمَد', self.ahmed)
+        self.assertFound('محـــمود', self.ahmed)
+
+    def test_phone_digits(self):
+        self.assertFound('01001234567', self.ahmed)
+        self.assertFound('٠١٠٠-١٢٣', self.ahmed)
+        self.assertFound('0112345', self.fatma)
+
+    def test_short_terms(self):
+        self.assertFound('من', self.mona)
+
+    def test_updates_reach_the_index(self):
+        self.mona.full_name = 'منة الله'
+        self.mona.save()
+        self.assertFound('منى')
+        self.assertFound('منه', self.mona)
+        self.fatma.delete()
+        self.assertFound('فاطمة')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class AcademicYearTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        forget_years()
+        cls.previous = current_year() - 1
+        generate_students(20, [cls.previous, current_year()], paid_ratio=0.5, seed=2)
+        cls.student = Student.objects.order_by('id').first()
+
+    def setUp(self):
+        cache.clear()
+        forget_years()
+
+    def test_current_year_pointer(self):
+        AcademicYear.objects.create(year=current_year() + 1, is_current=True)
+        self.assertEqual(current_year(), AcademicYear.objects.get(is_current=True).year)
+        self.assertEqual(AcademicYear.objects.filter(is_current=True).count(), 1)
+
+    def test_views_are_scoped_by_year(self):
+        for year in (self.previous, current_year()):
+            with self.subTest(year=year):
+                expected = PaymentSummary.objects.filter(year=year, student__is_exempt=False).aggregate(
+                    total=Sum('paid_amount')
+                )['total']
+                response = self.client.get(reverse('core:dashboard_stats'), {'year': year})
+                self.assertEqual(response.json()['data']['total_paid'], float(expected))
+
+                response = self.client.get(reverse('core:student_detail', args=[self.student.id]), {'year': year})
+                self.assertEqual({payment.year for payment in response.context['payments']}, {year})
+
+    def test_update_payment_year(self):
+        url = reverse('core:update_payment')
+        response = fetch(self.client, 'post_json', url, {
+            'student_id': self.student.id, 'month': 'may', 'year': self.previous, 'is_paid': True,
+        })
+        self.assertTrue(response.json()['success'])
+        self.assertTrue(Payment.objects.get(student=self.student, month='may', year=self.previous).is_paid)
+
+        response = fetch(self.client, 'post_json', url, {
+            'student_id': self.student.id, 'month': 'may', 'year': 1990, 'is_paid': True,
+        })
+        self.assertFalse(response.json()['success'])
+        self.assertFalse(Payment.objects.filter(year=1990).exists())
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RolloverTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        forget_years()
+        cls.first = current_year() - 1
+        generate_students(15, [cls.first, current_year()], paid_ratio=0.5, seed=3)
+        cls.student = Student.objects.order_by('id').first()
+
+    def setUp(self):
+        cache.clear()
+        forget_years()
+
+    def summaries(self):
+        return set(PaymentSummary.objects.values_list(
+            'student_id', 'year', 'payment_count', 'paid_count', 'paid_amount', 'pending_amount', 'paid_months'
+        ))
+
+    def test_roll_over(self):
+        before = self.summaries()
+        first_year_payments = Payment.objects.filter(year=self.first).count()
+        new_year = current_year() + 1
+
+        result = roll_over(new_year, keep=1)
+
+        self.assertEqual(result['scheduled'], Student.objects.count() * len(Payment.MONTHS))
+        self.assertEqual(result['archived'], {self.first: first_year_payments})
+        self.assertEqual(current_year(), new_year)
+        self.assertEqual(sorted(Payment.objects.order_by().values_list('year', flat=True).distinct()), [new_year - 1, new_year])
+        self.assertEqual(PaymentArchive.objects.filter(year=self.first).count(), first_year_payments)
+        self.assertTrue(AcademicYear.objects.get(year=self.first).is_archived)
+
+        # Summaries of the archived year survive, including a full rebuild
+        self.assertLess(before, self.summaries())
+        PaymentSummary.objects.rebuild()
+        self.assertLess(before, self.summaries())
+
+        # Running it again changes nothing
+        self.assertEqual(roll_over(new_year, keep=1), {'scheduled': 0, 'archived': {}})
+
+    def test_archived_year_is_read_only(self):
+        roll_over(current_year() + 1, keep=1)
+
+        response = fetch(self.client, 'post_json', reverse('core:update_payment'), {
+            'student_id': self.student.id, 'month': 'may', 'year': self.first, 'is_paid': True,
+        })
+        self.assertFalse(response.json()['success'])
+        self.assertFalse(Payment.objects.filter(year=self.first).exists())
+
+        response = self.client.get(reverse('core:student_detail', args=[self.student.id]), {'year': self.first})
+        self.assertEqual(len(response.context['payments']), len(Payment.MONTHS))
+
+        expected = PaymentArchive.objects.filter(year=self.first, month='april', is_paid=True).aggregate(
+            total=Sum('amount')
+        )['total']
+        response = self.client.get(reverse('core:monthly_revenue'), {'month': 'april', 'year': self.first})
+        self.assertEqual(sum(item['revenue'] for item in response.json()['data'].values()), float(expected))
+
+        response = self.client.get(reverse('core:payment_history', args=[self.student.id]))
+        self.assertEqual([entry['year'] for entry in response.context['history']], [
+            current_year(), current_year() - 1, self.first,
+        ])
+        self.assertTrue(response.context['history'][-1]['is_archived'])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RevenueMatrixTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        forget_years()
+        cls.previous = current_year() - 1
+        generate_students(20, [cls.previous, current_year()], paid_ratio=0.5, seed=4)
+        cls.student = Student.objects.select_related('grade').order_by('id').first()
+
+    def setUp(self):
+        cache.clear()
+        forget_years()
+
+    def test_matches_monthly_revenue(self):
+        response = self.client.get(reverse('core:revenue_matrix'), {'compare': self.previous})
+        data = response.json()['data']
+        for year, key in ((current_year(), 'revenue'), (self.previous, 'previous_revenue')):
+            for month in Payment.MONTHS:
+                with self.subTest(year=year, month=month):
+                    expected = self.client.get(
+                        reverse('core:monthly_revenue'), {'month': month, 'year': year}
+                    ).json()['data']
+                    for grade, cells in data['grades'].items():
+                        self.assertEqual(cells[month][key], expected.get(grade, {}).get('revenue', 0))
+
+    def test_unknown_compare_year(self):
+        response = self.client.get(reverse('core:revenue_matrix'), {'compare': 1990})
+        self.assertEqual(response.status_code, 400)
+
+    def test_etag_changes_with_payments(self):
+        urls = [
+            reverse('core:revenue_matrix'),
+            reverse('core:dashboard'),
+            f"{reverse('core:students_list')}?grades={self.student.grade.grade}",
+            reverse('core:student_detail', args=[self.student.id]),
+        ]
+        etags = {url: self.client.get(url)['ETag'] for url in urls}
+        for url, etag in etags.items():
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        paid = Payment.objects.get(student=self.student, month='march', year=current_year()).is_paid
+        # Cached statistics are invalidated on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            fetch(self.client, 'post_json', reverse('core:update_payment'), {
+                'student_id': self.student.id, 'month': 'march', 'is_paid': not paid,
+            })
+        for url, etag in etags.items():
+            with self.subTest(url):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response['ETag'], etag)
+
+
+class DatabaseUrlTests(SimpleTestCase):
+    def test_postgres(self):
+        config = parse_database_url(
+            'postgres://user:p%40ss@db:5432/students?sslmode=require&connect_timeout=5', conn_max_age=60
+        )
+        self.assertEqual(config['ENGINE'], 'django.db.backends.postgresql')
+        self.assertEqual(
+            [config[key] for key in ('NAME', 'USER', 'PASSWORD', 'HOST', 'PORT', 'CONN_MAX_AGE')],
+            ['students', 'user', 'p@ss', 'db', '5432', 60],
+        )
+        self.assertEqual(config['OPTIONS'], {'sslmode': 'require', 'connect_timeout': 5})
+
+    def test_pool_replaces_persistent_connections(self):
+        config = parse_database_url('postgres://user@db/students', conn_max_age=60, pool=True)
+        self.assertEqual((config['CONN_MAX_AGE'], config['OPTIONS']), (0, {'pool': True}))
+
+    def test_sqlite(self):
+        base_dir = Path('/srv/app')
+        self.assertEqual(parse_database_url('sqlite:///db.sqlite3', base_dir=base_dir)['NAME'], '/srv/app/db.sqlite3')
+        self.assertEqual(parse_database_url('sqlite:////data/db.sqlite3', base_dir=base_dir)['NAME'], '/data/db.sqlite3')
+        self.assertEqual(parse_database_url('sqlite://:memory:')['NAME'], ':memory:')
+        with self.assertRaises(ValueError):
+            parse_database_url('mysql://user@db/students')
+
+
+@skipUnless(connection.vendor == 'sqlite', 'SQLite tuning')
+class SqliteTuningTests(TestCase):
+    def test_connection_settings(self):
+        with connection.cursor() as cursor:
+            for name in ('synchronous', 'busy_timeout', 'cache_size'):
+                cursor.execute(f'PRAGMA {name}')
+                expected = {'synchronous': 1}.get(name, settings.SQLITE_PRAGMAS[name])
+                self.assertEqual(cursor.fetchone()[0], expected, name)
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+
+
+@override_settings(CACHES=TEST_CACHES, REPLICA_DATABASE_ALIAS='replica', REPLICA_LAG_SECONDS=60)
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_read_alias(self):
+        # Unknown versions count as fresh writes
+        self.assertEqual(read_alias(['grade7']), 'default')
+        with override_settings(REPLICA_LAG_SECONDS=0):
+            self.assertEqual(read_alias(['grade7', 'grade8']), 'replica')
+        with override_settings(REPLICA_DATABASE_ALIAS=None, REPLICA_LAG_SECONDS=0):
+            self.assertEqual(read_alias(['grade7']), 'default')
+
+    def test_recent_writes_read_from_primary(self):
+        with override_settings(REPLICA_LAG_SECONDS=0):
+            self.assertEqual(read_alias(['grade7', 'grade8']), 'replica')
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_grades(['grade8'])
+        self.assertEqual(read_alias(['grade7', 'grade8']), 'default')
+        self.assertEqual(read_alias(['grade7']), 'default')
+
+    def test_router(self):
+        router = PrimaryReplicaRouter()
+        self.assertEqual(router.db_for_write(Payment), 'default')
+        self.assertIsNone(router.db_for_read(Payment))
+        self.assertFalse(router.allow_migrate('replica', 'core'))
+        self.assertIsNone(router.allow_migrate('default', 'core'))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ExportJobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        forget_years()
+        generate_students(12, [current_year()], seed=4)
+
+    def setUp(self):
+        cache.clear()
+        forget_years()
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        settings_override = override_settings(EXPORT_ROOT=self.root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_jobs_are_claimed_once_in_order(self):
+        first = enqueue_students_export(ExportJob.STUDENTS_CSV, ['all'], current_year())
+        second = enqueue_students_export(ExportJob.STUDENTS_CSV, ['grade7'], current_year())
+
+        self.assertEqual(claim_next_job().id, first.id)
+        self.assertEqual(claim_next_job().id, second.id)
+        self.assertIsNone(claim_next_job())
+        self.assertEqual(ExportJob.objects.filter(status=ExportJob.RUNNING).count(), 2)
+
+    def test_run_workers_once(self):
+        job = enqueue_students_export(ExportJob.STUDENTS_CSV, ['grade7'], current_year())
+        call_command('run_workers', processes=1, once=True, stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.DONE)
+        self.assertEqual(job.rows, Student.objects.filter(grade__grade='grade7').count())
+        lines = (Path(self.root.name) / job.file_name).read_text(encoding='utf-8-sig').splitlines()
+        self.assertEqual(len(lines), job.rows + 1)
+        self.assertEqual(list(Path(self.root.name).iterdir()), [Path(self.root.name) / job.file_name])
+
+    def test_xlsx_export(self):
+        first, second = [
+            code for code, _ in Grade.GRADE_CHOICES if Student.objects.filter(grade__grade=code).exists()
+        ][:2]
+        Payment.objects.filter(student__grade__grade=second, month='may').update(is_paid=False, paid_at=None)
+        paid = Payment.objects.filter(student__grade__grade=second, month='april')
+        paid.update(is_paid=True, paid_at=datetime(2026, 4, 5, 10, 30, tzinfo=dt_timezone.utc))
+        PaymentSummary.objects.rebuild()
+
+        job = enqueue_students_export(ExportJob.STUDENTS_XLSX, [second, first], current_year())
+        run_job(claim_next_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.DONE, job.error)
+        self.assertEqual(job.rows, Student.objects.filter(grade__grade__in=[first, second]).count())
+
+        response = self.client.get(reverse('core:download_export', args=[job.id]))
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="students_data_{current_year()}.xlsx"')
+        sheets = read_workbook(b''.join(response.streaming_content))
+        # One sheet per grade, in the grades' order
+        names = dict(Grade.GRADE_CHOICES)
+        self.assertEqual(list(sheets), [names[first], names[second]])
+
+        header, *students, totals = sheets[names[second]]
+        # Months in pairs of amount and payment date, after the name and phone
+        april = column_letter(2 + 2 * MONTHS.index('april'))
+        april_paid_at = column_letter(3 + 2 * MONTHS.index('april'))
+        may = column_letter(2 + 2 * MONTHS.index('may'))
+        self.assertEqual(header[april], 'أبريل')
+        self.assertEqual(totals[april], float(paid.aggregate(total=Sum('amount'))['total']))
+        self.assertEqual({row[may] for row in students}, {'غير مدفوع'})
+        # 2026-04-05 10:30 UTC as an Excel serial date
+        self.assertEqual({row[april_paid_at] for row in students}, {46117 + 10.5 / 24})
+
+    def test_failed_job(self):
+        job = ExportJob.objects.create(kind=ExportJob.STUDENTS_CSV, params={'grades': [], 'year': 1900})
+        with self.assertLogs('core.jobs', 'ERROR'):
+            run_job(claim_next_job())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.FAILED)
+        self.assertIn('1900', job.error)
+        response = self.client.get(reverse('core:download_export', args=[job.id]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_start_export_rejects_unknown_year(self):
+        response = fetch(self.client, 'post_json', reverse('core:start_export'), {'grades': ['all'], 'year': 1900})
+        self.assertFalse(response.json()['success'])
+        self.assertFalse(ExportJob.objects.exists())
+
+    def test_requeue_and_purge(self):
+        job = enqueue_students_export(ExportJob.STUDENTS_CSV, ['all'], current_year())
+        claim_next_job()
+        self.assertEqual(requeue_stale(60), 0)
+        ExportJob.objects.filter(id=job.id).update(started_at=job.created_at - timedelta(hours=2))
+        self.assertEqual(requeue_stale(60), 1)
+
+        run_job(claim_next_job())
+        job.refresh_from_db()
+        path = Path(self.root.name) / job.file_name
+        self.assertTrue(path.exists())
+        self.assertEqual(purge_expired(60), 0)
+        ExportJob.objects.filter(id=job.id).update(finished_at=job.finished_at - timedelta(hours=2))
+        self.assertEqual(purge_expired(60), 1)
+        self.assertFalse(path.exists())
+
+    def test_workers_maintain_the_queue_while_running(self):
+        expired = enqueue_students_export(ExportJob.STUDENTS_CSV, ['all'], current_year())
+        run_job(claim_next_job())
+        expired.refresh_from_db()
+        ExportJob.objects.filter(id=expired.id).update(finished_at=expired.finished_at - timedelta(days=2))
+        stale = enqueue_students_export(ExportJob.STUDENTS_CSV, ['all'], current_year())
+        claim_next_job()
+        ExportJob.objects.filter(id=stale.id).update(started_at=stale.created_at - timedelta(hours=2))
+
+        # A worker loop that has been running long past its start-up maintenance
+        with self.assertLogs('core.jobs', 'INFO'):
+            done = _work(threading.Event(), 0.01, True, requeue_after=60, maintenance_interval=0)
+
+        self.assertEqual(done, 1)
+        self.assertFalse(ExportJob.objects.filter(id=expired.id).exists())
+        self.assertFalse((Path(self.root.name) / expired.file_name).exists())
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, ExportJob.DONE)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RepricingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        forget_years()
+        cls.previous = current_year() - 1
+        generate_students(30, [cls.previous, current_year()], paid_ratio=0.5, seed=5)
+        cls.grade = Grade.objects.annotate(students=Count('student')).filter(students__gt=0).first()
+
+    def setUp(self):
+        cache.clear()
+        forget_years()
+
+    def summaries(self):
+        return set(PaymentSummary.objects.values_list(
+            'student_id', 'year', 'payment_count', 'paid_count', 'paid_amount', 'pending_amount', 'paid_months'
+        ))
+
+    def amounts(self, **filters):
+        payments = Payment.objects.filter(student__grade=self.grade, year=current_year(), **filters)
+        return set(payments.values_list('amount', flat=True))
+
+    def test_reprice_unpaid_payments(self):
+        later = Payment.MONTHS[Payment.MONTHS.index('january'):]
+        earlier = Payment.MONTHS[:Payment.MONTHS.index('january')]
+        paid_before = self.amounts(is_paid=True)
+        earlier_before = self.amounts(is_paid=False, month__in=earlier)
+        expected = Payment.objects.filter(
+            student__grade=self.grade, year=current_year(), month__in=later, is_paid=False
+        ).count()
+        self.assertGreater(expected, 0)
+
+        self.assertEqual(
+            reprice_unpaid_payments(self.grade, current_year(), 'january', fee='725', dry_run=True), expected
+        )
+        self.assertEqual(self.amounts(is_paid=False, month__in=later), {self.grade.monthly_fee})
+
+        # Same statements whatever the number of students
+        with self.assertNumQueries(4), self.captureOnCommitCallbacks(execute=True):
+            repriced = reprice_unpaid_payments(self.grade, current_year(), 'january', fee='725')
+        self.assertEqual(repriced, expected)
+        self.assertEqual(self.amounts(is_paid=False, month__in=later), {Decimal('725')})
+        self.assertEqual(self.amounts(is_paid=False, month__in=earlier), earlier_before)
+        self.assertEqual(self.amounts(is_paid=True), paid_before)
+        self.assertFalse(Payment.objects.filter(year=self.previous, amount=Decimal('725')).exists())
+
+        # The summaries match a rebuild from the payments
+        after = self.summaries()
+        PaymentSummary.objects.rebuild()
+        self.assertEqual(after, self.summaries())
+
+        # Nothing left to change
+        self.assertEqual(reprice_unpaid_payments(self.grade, current_year(), 'january', fee='725', dry_run=True), 0)
+
+    def test_archived_year_is_rejected(self):
+        roll_over(current_year() + 1, keep=0)
+        with self.assertRaises(ValueError):
+            reprice_unpaid_payments(self.grade, self.previous, 'august')
+
+    def test_reprice_fees_command(self):
+        call_command(
+            'reprice_fees', self.grade.grade, '--from-month', 'may', '--fee', '640', '--dry-run', stdout=StringIO()
+        )
+        self.grade.refresh_from_db()
+        self.assertNotEqual(self.grade.monthly_fee, Decimal('640'))
+        self.assertNotIn(Decimal('640'), self.amounts())
+
+        call_command('reprice_fees', self.grade.grade, '--from-month', 'may', '--fee', '640', stdout=StringIO())
+        self.grade.refresh_from_db()
+        self.assertEqual(self.grade.monthly_fee, Decimal('640'))
+        self.assertEqual(self.amounts(is_paid=False, month__in=['may', 'june']), {Decimal('640')})
+
+    def test_reprice_fees_rejects_invalid_fees(self):
+        fee = self.grade.monthly_fee
+        for value in ['NaN', 'Infinity', '-Infinity', '12345678901', '1.234', 'abc']:
+            with self.subTest(value=value), self.assertRaisesMessage(CommandError, 'Invalid fee'):
+                call_command('reprice_fees', self.grade.grade, '--from-month', 'may', f'--fee={value}', stdout=StringIO())
+        self.grade.refresh_from_db()
+        self.assertEqual(self.grade.monthly_fee, fee)
+
+    def test_admin_action(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        Grade.objects.filter(id=self.grade.id).update(monthly_fee=Decimal('810'))
+        url = reverse('admin:core_grade_changelist')
+        data = {'action': 'reprice_unpaid', '_selected_action': [self.grade.id]}
+
+        response = self.client.post(url, data)
+        self.assertTemplateUsed(response, 'admin/core/grade/reprice.html')
+        unpaid = Payment.objects.filter(student__grade=self.grade, year=current_year(), is_paid=False)
+        self.assertEqual(response.context['grades'], [(self.grade, unpaid.count())])
+
+        response = self.client.post(url, {**data, 'year': current_year(), 'from_month': 'august', 'apply': '1'})
+        self.assertRedirects(response, url)
+        self.assertEqual(self.amounts(is_paid=False), {Decimal('810')})
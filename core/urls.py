@@ -8,11 +8,20 @@ urlpatterns = [
     path('students/select-grade/', views.grade_selection, name='grade_selection'),
     path('students/', views.students_list, name='students_list'),
     path('students/<int:student_id>/', views.student_detail, name='student_detail'),
+    path('students/<int:student_id>/history/', views.payment_history, name='payment_history'),
     path('students/add/', views.add_student, name='add_student'),
+    path('students/add/bulk/', views.bulk_add_students, name='bulk_add_students'),
     path('students/<int:student_id>/update/', views.update_student, name='update_student'),
     path('students/<int:student_id>/delete/', views.delete_student, name='delete_student'),
+    path('api/students/rows/', views.students_rows, name='students_rows'),
     path('api/update-payment/', views.update_payment, name='update_payment'),
+    path('api/update-payments/', views.update_payments, name='update_payments'),
     path('api/monthly-revenue/', views.monthly_revenue, name='monthly_revenue'),
+    path('api/revenue-matrix/', views.get_revenue_matrix, name='revenue_matrix'),
     path('api/dashboard-stats/', views.get_dashboard_stats, name='dashboard_stats'),
     path('export/students-csv/', views.export_students_csv, name='export_students_csv'),
+    path('export/students-xlsx/', views.export_students_xlsx, name='export_students_xlsx'),
+    path('api/exports/', views.start_export, name='start_export'),
+    path('api/exports/<int:job_id>/', views.export_job_status, name='export_job_status'),
+    path('exports/<int:job_id>/download/', views.download_export, name='download_export'),
 ]
\ No newline at end of file
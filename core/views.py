@@ -1,211 +1,192 @@
 from django.shortcuts import render, get_object_or_404, redirect
+from django.template.loader import render_to_string
 from django.urls import reverse
-from django.http import JsonResponse, HttpResponse
+from django.http import FileResponse, Http404, JsonResponse, StreamingHttpResponse
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
-from django.db.models import Count, Sum, Q
+from django.views.decorators.http import condition
+from django.db.models import Count, Sum
 from django.contrib import messages
-from .models import Student, Grade, Payment
-from .forms import StudentForm
+from .academic_years import archived_years, current_year, known_years, requested_year, writable_year
+from .models import ExportJob, Student, Grade, Payment, PaymentArchive, PaymentSummary
+from .forms import BulkEnrollmentForm, StudentForm
+from .jobs import download_name, enqueue_students_export, export_root
+from .payments import apply_payment_changes, enroll_students, parse_payment_changes, toggle_payment
+from .reports import (
+    MONTHS, MONTH_NAMES, cached_grades, completion_percentage, csv_rows, dashboard_stats,
+    filtered_matrix, keyset_window, matrix_row, matrix_totals, payment_matrix, revenue_matrix,
+    revenue_matrix_etag, xlsx_sheets,
+)
+from .rollover import payments_of_year
+from .routers import read_alias
+from .stats_cache import grade_scope, stats_etag
+from .xlsx import stream_workbook
 import json
 import csv
 
 
+def _every_grade(request, *args, **kwargs):
+    return ['all']
+
+
+def _selected_grades(request, *args, **kwargs):
+    return request.GET.getlist('grades', [])
+
+
+def _student_grade(request, student_id):
+    grade = Student.objects.filter(id=student_id).values_list('grade__grade', flat=True).first()
+    return None if grade is None else [grade]
+
+
+def conditional_on_grades(grades_of):
+    """Answer revalidations with 304 until data of the request's grades or the years change.
+
+    The ETag combines the URL, the academic years and the stats cache version tokens of
+    the grades returned by `grades_of(request, *args, **kwargs)`, so checking it costs cache
+    reads and at most one indexed lookup.
+    """
+    def etag(request, *args, **kwargs):
+        grades = grades_of(request, *args, **kwargs)
+        if grades is None:
+            return None
+        years = f'{current_year()}:{known_years()}:{sorted(archived_years())}'
+        return stats_etag(f'{request.get_full_path()}:{years}', grades)
+
+    def decorator(view):
+        return cache_control(private=True, no_cache=True)(condition(etag_func=etag)(view))
+    return decorator
+
+
+# The dashboard lists every grade, not only the selected ones
+@conditional_on_grades(_every_grade)
 def dashboard(request):
     """Dashboard view with statistics"""
     # Get filter parameters
     selected_grades = request.GET.getlist('grades', [])
+    year = requested_year(request.GET.get('year'))
     
-    # Base queryset
-    students_qs = Student.objects.all()
-    if selected_grades and 'all' not in selected_grades:
-        students_qs = students_qs.filter(grade__grade__in=selected_grades)
-    
-    # Statistics
-    total_students = students_qs.count()
-    
-    # Exclude exempt students from revenue calculations
-    non_exempt_students = students_qs.filter(is_exempt=False)
-    total_paid = Payment.objects.filter(
-        student__in=non_exempt_students, is_paid=True
-    ).aggregate(total=Sum('amount'))['total'] or 0
-    
-    total_pending = Payment.objects.filter(
-        student__in=non_exempt_students, is_paid=False
-    ).aggregate(total=Sum('amount'))['total'] or 0
-    
-    # Grade statistics
-    grade_stats = students_qs.values(
-        'grade__grade'
-    ).annotate(
-        student_count=Count('id')
-    ).order_by('grade__grade')
+    # Statistics, served from the cache until a write touches one of the selected grades
+    stats = dashboard_stats(selected_grades, year)
     
     # All grades for filter
-    all_grades = Grade.objects.all()
+    grades = cached_grades()
+    academic_years = known_years()
     
     context = {
-        'total_students': total_students,
-        'total_paid': total_paid,
-        'total_pending': total_pending,
-        'total_grades': all_grades.count(),
-        'grade_stats': grade_stats,
-        'all_grades': all_grades,
+        'total_students': stats['total_students'],
+        'total_paid': stats['total_paid'],
+        'total_pending': stats['total_pending'],
+        'total_grades': len(grades),
+        'grade_stats': stats['grade_stats'],
+        'all_grades': grades,
         'selected_grades': selected_grades,
+        'year': year,
+        # Revenue cards compare with the previous year when there is one
+        'compare_year': year - 1 if year - 1 in academic_years else None,
+        'academic_years': academic_years,
     }
     
     return render(request, 'core/dashboard.html', context)
 
 
+@conditional_on_grades(_selected_grades)
 def get_dashboard_stats(request):
     """AJAX endpoint to get updated dashboard statistics"""
     selected_grades = request.GET.getlist('grades', [])
+    year = requested_year(request.GET.get('year'))
     
-    # Base queryset
-    students_qs = Student.objects.all()
-    if selected_grades and 'all' not in selected_grades:
-        students_qs = students_qs.filter(grade__grade__in=selected_grades)
-    
-    # Statistics
-    total_students = students_qs.count()
-    total_paid = Payment.objects.filter(
-        student__in=students_qs, is_paid=True
-    ).aggregate(total=Sum('amount'))['total'] or 0
-    
-    total_pending = Payment.objects.filter(
-        student__in=students_qs, is_paid=False
-    ).aggregate(total=Sum('amount'))['total'] or 0
+    stats = dashboard_stats(selected_grades, year)
     
     return JsonResponse({
         'success': True,
         'data': {
-            'total_students': total_students,
-            'total_paid': float(total_paid),
-            'total_pending': float(total_pending),
+            'total_students': stats['total_students'],
+            'total_paid': float(stats['total_paid']),
+            'total_pending': float(stats['total_pending']),
         }
     })
 
 
+def _grade_selection_context(**extra):
+    """Grades with their student counts for the grade selection page, counted in one query"""
+    all_grades = list(Grade.objects.annotate(student_count=Count('student')).order_by('grade'))
+    return {
+        'all_grades': all_grades,
+        'total_students': sum(grade.student_count for grade in all_grades),
+        **extra,
+    }
+
+
 def grade_selection(request):
     """Grade selection view - required before accessing student list"""
-    all_grades = Grade.objects.all().order_by('grade')
-    
-    context = {
-        'all_grades': all_grades,
+    return render(request, 'core/grade_selection.html', _grade_selection_context())
+
+
+def _student_filters(request):
+    """Filter parameters shared by the students table and its row windows"""
+    return {
+        'selected_grades': request.GET.getlist('grades', []),
+        'payment_status': request.GET.get('payment_status', 'all'),  # all, paid, unpaid, partial
+        'month_filter': request.GET.get('month', 'all'),  # specific month or all
+        'search_query': request.GET.get('search', '').strip(),
+        'sort_by': request.GET.get('sort', 'name'),  # name, grade, payments
+        'year': requested_year(request.GET.get('year')),
     }
+
+
+def _filtered_students(filters):
+    """Students queryset for the given filters (search, grades), before the payment matrix"""
+    students_qs = Student.objects.select_related('grade').for_grades(filters['selected_grades'])
     
-    return render(request, 'core/grade_selection.html', context)
+    # Apply search filter
+    if filters['search_query']:
+        students_qs = students_qs.search(filters['search_query'])
+    return students_qs
+
+
+def _matrix_rows(students, month_filter):
+    rows = []
+    for student in students:
+        row = matrix_row(student)
+        # Month-specific payment status when a month is selected
+        if month_filter in MONTHS:
+            row['payment_status'] = 'paid' if row['payments'][month_filter] else 'unpaid'
+        rows.append(row)
+    return rows
 
 
+@conditional_on_grades(_selected_grades)
 def students_list(request):
     """Students list view with payment tracking and business filters"""
     # Get filter parameters
-    selected_grades = request.GET.getlist('grades', [])
-    payment_status = request.GET.get('payment_status', 'all')  # all, paid, unpaid, partial
-    month_filter = request.GET.get('month', 'all')  # specific month or all
-    search_query = request.GET.get('search', '').strip()
-    sort_by = request.GET.get('sort', 'name')  # name, grade, payments
+    filters = _student_filters(request)
+    selected_grades = filters['selected_grades']
+    search_query = filters['search_query']
     
     # Require grade selection - redirect if no grades selected
     if not selected_grades or (len(selected_grades) == 1 and selected_grades[0] == ''):
-        return render(request, 'core/grade_selection.html', {
-            'all_grades': Grade.objects.all().order_by('grade'),
-            'error_message': 'يرجى اختيار صف واحد على الأقل لعرض قائمة الطلاب'
-        })
+        return render(request, 'core/grade_selection.html', _grade_selection_context(
+            error_message='يرجى اختيار صف واحد على الأقل لعرض قائمة الطلاب'
+        ))
     
     # Base queryset
-    students_qs = Student.objects.select_related('grade').prefetch_related('payments')
-    if selected_grades and 'all' not in selected_grades:
-        students_qs = students_qs.filter(grade__grade__in=selected_grades)
-    
-    # Apply search filter
-    if search_query:
-        students_qs = students_qs.filter(
-            Q(full_name__icontains=search_query) | 
-            Q(father_phone_number__icontains=search_query)
-        )
+    students_qs = _filtered_students(filters)
     
     # Check if any students exist for selected grades (only redirect if no grades selected, not for search results)
     if not students_qs.exists() and not search_query:
-        return render(request, 'core/grade_selection.html', {
-            'all_grades': Grade.objects.all().order_by('grade'),
-            'error_message': f'لا يوجد طلاب في الصفوف المحددة',
-            'selected_grades': selected_grades
-        })
-    
-    # Get all students with their payment data
-    students_data = []
-    months = ['august', 'september', 'october', 'november', 'december', 
-              'january', 'february', 'march', 'april', 'may', 'june']
-    
-    # Initialize totals
-    total_paid_amount = 0
-    
-    for student in students_qs:
-        # Get payment status for each month
-        payments = {}
-        student_paid = 0
-        paid_months = 0
-        
-        for month in months:
-            payment = student.payments.filter(month=month, year=2025).first()
-            if payment:
-                payments[month] = payment.is_paid
-                if payment.is_paid:
-                    student_paid += float(payment.amount)
-                    # Only include in total if student is not exempt
-                    if not student.is_exempt:
-                        total_paid_amount += float(payment.amount)
-                    paid_months += 1
-            else:
-                payments[month] = False
-        
-        # Calculate payment completion percentage
-        completion_percentage = (paid_months / len(months)) * 100 if months else 0
-        
-        # Determine payment status for filtering based on selected month
-        if month_filter != 'all' and month_filter in months:
-            # Month-specific payment status
-            student_payment_status = 'paid' if payments.get(month_filter, False) else 'unpaid'
-            
-            # Apply payment status filter for specific month
-            if payment_status != 'all':
-                if payment_status == 'paid' and not payments.get(month_filter, False):
-                    continue
-                elif payment_status == 'unpaid' and payments.get(month_filter, False):
-                    continue
-                elif payment_status == 'partial':
-                    # For month-specific filtering, partial doesn't make sense, treat as unpaid
-                    if payments.get(month_filter, False):
-                        continue
-        else:
-            # Year-wide payment status (when no specific month is selected)
-            student_payment_status = 'unpaid'
-            if paid_months == len(months):
-                student_payment_status = 'paid'
-            elif paid_months > 0:
-                student_payment_status = 'partial'
-            
-            # Apply payment status filter for entire year
-            if payment_status != 'all':
-                if payment_status != student_payment_status:
-                    continue
-        
-        students_data.append({
-            'student': student,
-            'payments': payments,
-            'total_paid': student_paid,
-            'completion_percentage': completion_percentage,
-            'payment_status': student_payment_status,
-            'paid_months': paid_months,
-        })
-    
-    # Apply sorting
-    if sort_by == 'name':
-        students_data.sort(key=lambda x: x['student'].full_name)
-    elif sort_by == 'grade':
-        students_data.sort(key=lambda x: x['student'].grade.grade)
-    elif sort_by == 'payments':
-        students_data.sort(key=lambda x: x['total_paid'], reverse=True)
+        return render(request, 'core/grade_selection.html', _grade_selection_context(
+            error_message='لا يوجد طلاب في الصفوف المحددة',
+            selected_grades=selected_grades
+        ))
+    
+    # Matching students with their payment data, filtered and sorted in SQL.
+    # Only the first window is rendered, the rest is loaded by students_rows while scrolling.
+    students = filtered_matrix(
+        students_qs, filters['year'], payment_status=filters['payment_status'],
+        month=filters['month_filter'], sort_by=filters['sort_by']
+    )
+    first_window, next_cursor = keyset_window(students, filters['sort_by'])
+    totals = matrix_totals(students)
     
     # All grades for filter
     all_grades = Grade.objects.all()
@@ -219,58 +200,124 @@ def students_list(request):
             if grade.grade in selected_grades:
                 selected_grade_names.append(grade.grade_name)
     
-    # Month names for display
-    month_names = {
-        'august': 'أغسطس', 'september': 'سبتمبر', 'october': 'أكتوبر',
-        'november': 'نوفمبر', 'december': 'ديسمبر', 'january': 'يناير',
-        'february': 'فبراير', 'march': 'مارس', 'april': 'أبريل',
-        'may': 'مايو', 'june': 'يونيو'
-    }
-    
     context = {
-        'students_data': students_data,
-        'months': months,
-        'month_names': month_names,
+        'students_data': _matrix_rows(first_window, filters['month_filter']),
+        'next_cursor': next_cursor,
+        'student_count': totals['student_count'],
+        'paid_months_count': totals['paid_months'],
+        'months': MONTHS,
+        'month_names': MONTH_NAMES,
         'all_grades': all_grades,
         'selected_grades': selected_grades,
         'selected_grade_names': selected_grade_names,
-        'total_paid_amount': total_paid_amount,
-        'payment_status': payment_status,
-        'month_filter': month_filter,
+        'total_paid_amount': totals['total_paid'],
+        'payment_status': filters['payment_status'],
+        'month_filter': filters['month_filter'],
         'search_query': search_query,
-        'sort_by': sort_by,
+        'sort_by': filters['sort_by'],
+        'year': filters['year'],
+        'read_only': filters['year'] in archived_years(),
+        'academic_years': known_years(),
     }
     
     return render(request, 'core/students_list.html', context)
 
 
-def student_detail(request, student_id):
-    """Student detail view"""
-    student = get_object_or_404(Student, id=student_id)
+def students_rows(request):
+    """AJAX endpoint returning the window of student rows after a cursor"""
+    filters = _student_filters(request)
+    students = filtered_matrix(
+        _filtered_students(filters), filters['year'], payment_status=filters['payment_status'],
+        month=filters['month_filter'], sort_by=filters['sort_by']
+    )
+    
+    try:
+        window, next_cursor = keyset_window(
+            students, filters['sort_by'], cursor=request.GET.get('cursor')
+        )
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'مؤشر الصفحة غير صالح'}, status=400)
     
-    # Get all payments for this student
-    payments = student.payments.filter(year=2025).order_by('month')
+    students_data = _matrix_rows(window, filters['month_filter'])
+    html = render_to_string('core/student_rows.html', {
+        'students_data': students_data,
+        'months': MONTHS,
+        'year': filters['year'],
+        'read_only': filters['year'] in archived_years(),
+    }, request=request)
     
-    # Calculate statistics
-    total_paid = payments.filter(is_paid=True).aggregate(
-        total=Sum('amount')
-    )['total'] or 0
+    return JsonResponse({
+        'success': True,
+        'data': {
+            'html': html,
+            'next_cursor': next_cursor,
+            'rows': [
+                {
+                    'id': row['student'].id,
+                    'full_name': row['student'].full_name,
+                    'grade': row['student'].grade.grade,
+                    'is_exempt': row['student'].is_exempt,
+                    'payments': row['payments'],
+                    'total_paid': row['total_paid'],
+                    'payment_status': row['payment_status'],
+                }
+                for row in students_data
+            ],
+        }
+    })
+
+
+@conditional_on_grades(_student_grade)
+def student_detail(request, student_id):
+    """Student detail view"""
+    year = requested_year(request.GET.get('year'))
+    student = get_object_or_404(
+        payment_matrix(Student.objects.select_related('grade'), year), id=student_id
+    )
     
-    total_pending = payments.filter(is_paid=False).aggregate(
-        total=Sum('amount')
-    )['total'] or 0
+    # Get this year's payments for this student, archived years included
+    payments = payments_of_year(year).filter(student=student).order_by('month')
     
     context = {
         'student': student,
         'payments': payments,
-        'total_paid': total_paid,
-        'total_pending': total_pending,
-        'completion_percentage': student.payment_completion_percentage,
+        'total_paid': student.total_paid,
+        'total_pending': student.total_pending,
+        'completion_percentage': completion_percentage(student.paid_months),
+        'year': year,
+        'academic_years': known_years(),
     }
     
     return render(request, 'core/student_detail.html', context)
 
 
+def payment_history(request, student_id):
+    """Read-only payment history of a student over every academic year"""
+    student = get_object_or_404(Student.objects.select_related('grade'), id=student_id)
+    
+    # Current years from Payment, archived ones from PaymentArchive
+    payments_by_year = {}
+    for model in (Payment, PaymentArchive):
+        for payment in model.objects.filter(student=student):
+            payments_by_year.setdefault(payment.year, {})[payment.month] = payment
+    summaries = {
+        summary.year: summary for summary in PaymentSummary.objects.filter(student=student)
+    }
+    archived = archived_years()
+    
+    history = [
+        {
+            'year': year,
+            'is_archived': year in archived,
+            'months': [(MONTH_NAMES[month], payments_by_year[year].get(month)) for month in MONTHS],
+            'summary': summaries.get(year),
+        }
+        for year in sorted(payments_by_year, reverse=True)
+    ]
+    
+    return render(request, 'core/payment_history.html', {'student': student, 'history': history})
+
+
 @csrf_exempt
 def update_payment(request):
     """AJAX endpoint to update payment status"""
@@ -279,35 +326,21 @@ def update_payment(request):
             data = json.loads(request.body)
             student_id = data.get('student_id')
             month = data.get('month')
-            is_paid = data.get('is_paid', False)
-            
-            student = get_object_or_404(Student, id=student_id)
+            is_paid = bool(data.get('is_paid', False))
+            year = writable_year(data.get('year'))
             
-            # Get or create payment record
-            payment, created = Payment.objects.get_or_create(
-                student=student,
-                month=month,
-                year=2025,
-                defaults={
-                    'amount': student.grade.monthly_fee,
-                    'is_paid': is_paid
-                }
-            )
+            if month not in MONTHS:
+                raise ValueError(f'شهر غير معروف: {month}')
             
-            if not created:
-                payment.is_paid = is_paid
-                payment.save()
+            student = get_object_or_404(Student.objects.select_related('grade'), id=student_id)
             
-            # Calculate updated totals for this student
-            student_payments = student.payments.filter(year=2025)
-            student_total_paid = student_payments.filter(is_paid=True).aggregate(
-                total=Sum('amount')
-            )['total'] or 0
+            # Single-statement upsert of the cell, returning the updated student total
+            payment_amount, student_total_paid = toggle_payment(student, month, year, is_paid)
             
             return JsonResponse({
                 'success': True,
                 'message': 'تم تحديث حالة الدفع بنجاح',
-                'payment_amount': float(payment.amount),
+                'payment_amount': float(payment_amount),
                 'student_total_paid': float(student_total_paid),
                 'student_name': student.full_name
             })
@@ -321,13 +354,48 @@ def update_payment(request):
     return JsonResponse({'success': False, 'message': 'طريقة غير مسموحة'})
 
 
+def update_payments(request):
+    """AJAX endpoint to update many payment cells in one transaction"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'طريقة غير مسموحة'})
+    
+    try:
+        data = json.loads(request.body)
+        changes = parse_payment_changes(data.get('changes') if isinstance(data, dict) else None)
+        summaries = apply_payment_changes(changes)
+    except ValueError as e:
+        return JsonResponse({
+            'success': False,
+            'message': f'حدث خطأ: {str(e)}'
+        })
+    
+    return JsonResponse({
+        'success': True,
+        'message': f'تم تحديث {len(changes)} دفعة بنجاح',
+        'students': [
+            {
+                'student_id': summary['student_id'],
+                'year': summary['year'],
+                'paid_months': summary['paid_count'],
+                'student_total_paid': float(summary['paid_amount']),
+                'student_total_pending': float(summary['pending_amount']),
+            }
+            for summary in summaries
+        ]
+    })
+
+
+@conditional_on_grades(_selected_grades)
 def monthly_revenue(request):
     """AJAX endpoint to get monthly revenue data"""
     month = request.GET.get('month', 'april')
     selected_grades = request.GET.getlist('grades', [])
+    year = requested_year(request.GET.get('year'))
     
-    # Base queryset
-    payments_qs = Payment.objects.filter(month=month, year=2025, is_paid=True)
+    # Base queryset, archived years are read from the archive
+    payments_qs = payments_of_year(year).using(read_alias(grade_scope(selected_grades))).filter(
+        month=month, is_paid=True
+    )
     if selected_grades and 'all' not in selected_grades:
         payments_qs = payments_qs.filter(student__grade__grade__in=selected_grades)
     
@@ -354,54 +422,43 @@ def monthly_revenue(request):
     })
 
 
-def export_students_csv(request):
-    """Export students data to CSV"""
-    import csv
-    from django.http import HttpResponse
-    
-    selected_grades = request.GET.getlist('grades', [])
-    
-    # Base queryset
-    students_qs = Student.objects.select_related('grade').prefetch_related('payments')
-    if selected_grades and 'all' not in selected_grades:
-        students_qs = students_qs.filter(grade__grade__in=selected_grades)
-    
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = 'attachment; filename="students_data.csv"'
-    
-    # Add BOM for proper Arabic display in Excel
-    response.write('\ufeff')
-    
-    writer = csv.writer(response)
-    
-    # Headers
-    headers = ['الاسم', 'الصف', 'العمر', 'الهاتف', 'العنوان', 'إجمالي المدفوعات']
-    months = ['أغسطس', 'سبتمبر', 'أكتوبر', 'نوفمبر', 'ديسمبر', 
-              'يناير', 'فبراير', 'مارس', 'أبريل', 'مايو', 'يونيو']
-    headers.extend(months)
-    writer.writerow(headers)
-    
-    # Data rows
-    month_keys = ['august', 'september', 'october', 'november', 'december', 
-                  'january', 'february', 'march', 'april', 'may', 'june']
-    
-    for student in students_qs:
-        row = [
-            student.full_name,
-            student.grade.grade_name,
-            student.father_phone_number,
-            student.total_payments
-        ]
-        
-        # Add payment status for each month
-        for month_key in month_keys:
-            payment = student.payments.filter(month=month_key, year=2025).first()
-            status = 'مدفوع' if payment and payment.is_paid else 'غير مدفوع'
-            row.append(status)
-        
-        writer.writerow(row)
+def _revenue_matrix_params(request):
+    """Grades, year and comparison year of a revenue matrix request.
+
+    Raises ValueError when the comparison year is unknown.
+    """
+    compare = request.GET.get('compare')
+    return (
+        request.GET.getlist('grades', []),
+        requested_year(request.GET.get('year')),
+        requested_year(compare, strict=True) if compare else None,
+    )
+
+
+def _revenue_matrix_etag(request):
+    try:
+        return revenue_matrix_etag(*_revenue_matrix_params(request))
+    except ValueError:
+        return None
+
+
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_revenue_matrix_etag)
+def get_revenue_matrix(request):
+    """AJAX endpoint returning the grade x month revenue matrix of a year.
+
+    Optional `compare` adds another year's figures to every cell. Clients revalidate with
+    If-None-Match and get a 304 until a payment of one of the grades changes.
+    """
+    try:
+        selected_grades, year, compare_year = _revenue_matrix_params(request)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
     
-    return response
+    return JsonResponse({
+        'success': True,
+        'data': revenue_matrix(selected_grades, year, compare_year)
+    })
 
 
 def add_student(request):
@@ -409,20 +466,8 @@ def add_student(request):
     if request.method == 'POST':
         form = StudentForm(request.POST)
         if form.is_valid():
-            student = form.save()
-            
-            # Create payment records for all months
-            months = ['august', 'september', 'october', 'november', 'december', 
-                     'january', 'february', 'march', 'april', 'may', 'june']
-            
-            for month in months:
-                Payment.objects.create(
-                    student=student,
-                    month=month,
-                    year=2025,
-                    amount=student.grade.monthly_fee,
-                    is_paid=False
-                )
+            # Save the student with payment records for all months
+            student, = enroll_students([form.save(commit=False)])
             messages.success(request, f'تم إضافة الطالب {student.full_name} بنجاح')
             # Redirect to students list with the student's grade pre-selected
             return redirect(f"{reverse('core:students_list')}?grades={student.grade.grade}")
@@ -437,6 +482,34 @@ def add_student(request):
     })
 
 
+def bulk_add_students(request):
+    """Enroll many students of one grade at once"""
+    if request.method == 'POST':
+        form = BulkEnrollmentForm(request.POST)
+        if form.is_valid():
+            grade = form.cleaned_data['grade']
+            students = enroll_students([
+                Student(
+                    full_name=full_name,
+                    father_phone_number=phone,
+                    grade=grade,
+                    is_exempt=form.cleaned_data['is_exempt'],
+                )
+                for full_name, phone in form.cleaned_data['students']
+            ])
+            messages.success(request, f'تم إضافة {len(students)} طالب إلى {grade.grade_name} بنجاح')
+            return redirect(f"{reverse('core:students_list')}?grades={grade.grade}")
+        else:
+            messages.error(request, 'يرجى تصحيح الأخطاء في النموذج')
+    else:
+        form = BulkEnrollmentForm()
+    
+    return render(request, 'core/bulk_add_students.html', {
+        'form': form,
+        'title': 'إضافة مجموعة طلاب'
+    })
+
+
 def update_student(request, student_id):
     """Update student information"""
     student = get_object_or_404(Student, id=student_id)
@@ -478,48 +551,111 @@ def delete_student(request, student_id):
     })
 
 
+class Echo:
+    """Pseudo-buffer whose write() hands the csv line back instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
 def export_students_csv(request):
-    """Export students data to CSV"""
+    """Export students data to CSV, streamed row by row"""
     selected_grades = request.GET.getlist('grades', [])
+    year = requested_year(request.GET.get('year'))
     
-    # Base queryset
-    students_qs = Student.objects.select_related('grade').prefetch_related('payments')
-    if selected_grades and 'all' not in selected_grades:
-        students_qs = students_qs.filter(grade__grade__in=selected_grades)
+    # Base queryset, read from the replica unless the grades were just written to
+    students_qs = Student.objects.select_related('grade').for_grades(selected_grades)
+    using = read_alias(grade_scope(selected_grades))
     
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = 'attachment; filename="students_data.csv"'
+    writer = csv.writer(Echo())
     
-    # Add BOM for proper Arabic display in Excel
-    response.write('\ufeff')
+    def stream():
+        # Add BOM for proper Arabic display in Excel
+        yield '\ufeff'
+        for row in csv_rows(students_qs, year, using=using):
+            yield writer.writerow(row)
     
-    writer = csv.writer(response)
-    
-    # Headers
-    headers = ['الاسم', 'الصف', 'الهاتف', 'إجمالي المدفوعات']
-    months = ['أغسطس', 'سبتمبر', 'أكتوبر', 'نوفمبر', 'ديسمبر', 
-              'يناير', 'فبراير', 'مارس', 'أبريل', 'مايو', 'يونيو']
-    headers.extend(months)
-    writer.writerow(headers)
+    response = StreamingHttpResponse(stream(), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="students_data_{year}.csv"'
+    return response
+
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+EXPORT_FORMATS = {
+    'csv': ExportJob.STUDENTS_CSV,
+    'xlsx': ExportJob.STUDENTS_XLSX,
+}
+
+
+def export_students_xlsx(request):
+    """Export students data to an Excel workbook, one sheet per grade, streamed as it is built"""
+    selected_grades = request.GET.getlist('grades', [])
+    year = requested_year(request.GET.get('year'))
     
-    # Data rows
-    month_keys = ['august', 'september', 'october', 'november', 'december', 
-                  'january', 'february', 'march', 'april', 'may', 'june']
+    students_qs = Student.objects.select_related('grade').for_grades(selected_grades)
+    sheets = xlsx_sheets(students_qs, year, using=read_alias(grade_scope(selected_grades)))
     
-    for student in students_qs:
-        row = [
-            student.full_name,
-            student.grade.grade_name,
-            student.father_phone_number,
-            student.total_payments
-        ]
-        
-        # Add payment status for each month
-        for month_key in month_keys:
-            payment = student.payments.filter(month=month_key, year=2025).first()
-            status = 'مدفوع' if payment and payment.is_paid else 'غير مدفوع'
-            row.append(status)
-        
-        writer.writerow(row)
-    
-    return response
\ No newline at end of file
+    response = StreamingHttpResponse(stream_workbook(sheets), content_type=XLSX_CONTENT_TYPE)
+    response['Content-Disposition'] = f'attachment; filename="students_data_{year}.xlsx"'
+    return response
+
+
+def _export_job_data(job):
+    data = {
+        'id': job.id,
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'rows': job.rows,
+        'error': job.error,
+        'status_url': reverse('core:export_job_status', args=[job.id]),
+        'download_url': None,
+    }
+    if job.status == ExportJob.DONE:
+        data['download_url'] = reverse('core:download_export', args=[job.id])
+    return data
+
+
+def start_export(request):
+    """AJAX endpoint queueing a students CSV or XLSX export for the run_workers processes"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'طريقة غير مسموحة'})
+    
+    try:
+        data = json.loads(request.body)
+        if not isinstance(data, dict):
+            raise ValueError('بيانات غير صالحة')
+        selected_grades = data.get('grades') or []
+        known_grades = set(dict(Grade.GRADE_CHOICES)) | {'all'}
+        if not isinstance(selected_grades, list) or not set(selected_grades) <= known_grades:
+            raise ValueError('صفوف غير معروفة')
+        year = requested_year(data.get('year'), strict=True)
+        kind = EXPORT_FORMATS.get(data.get('format', 'csv'))
+        if kind is None:
+            raise ValueError('صيغة تصدير غير معروفة')
+    except ValueError as e:
+        return JsonResponse({'success': False, 'message': f'حدث خطأ: {str(e)}'})
+    
+    job = enqueue_students_export(kind, selected_grades, year)
+    return JsonResponse({
+        'success': True,
+        'message': 'تم بدء التصدير، سيكون الملف جاهزاً للتحميل خلال لحظات',
+        'data': _export_job_data(job)
+    })
+
+
+def export_job_status(request, job_id):
+    """AJAX endpoint polled until a background export is done"""
+    job = get_object_or_404(ExportJob, id=job_id)
+    return JsonResponse({'success': True, 'data': _export_job_data(job)})
+
+
+def download_export(request, job_id):
+    """Download the file of a finished background export"""
+    job = get_object_or_404(ExportJob, id=job_id, status=ExportJob.DONE)
+    try:
+        output = open(export_root() / job.file_name, 'rb')
+    except FileNotFoundError:
+        raise Http404('انتهت صلاحية ملف التصدير')
+    content_type = XLSX_CONTENT_TYPE if job.kind == ExportJob.STUDENTS_XLSX else 'text/csv; charset=utf-8'
+    return FileResponse(output, as_attachment=True, filename=download_name(job), content_type=content_type)
@@ -0,0 +1,311 @@
+"""Write-only XLSX workbooks streamed straight into a zip file.
+
+Rows are serialized as they are appended and compressed into the sheet's zip entry, so
+memory stays flat whatever the number of rows. Strings are stored inline (no shared
+strings table to hold), sheets are right-to-left for the Arabic headers.
+
+    with Workbook(output) as workbook:
+        with workbook.sheet('الصف الأول', widths=[30, 12]) as sheet:
+            sheet.append(BoldRow(['الاسم', 'المبلغ']))
+            sheet.append(['أحمد', Decimal('500.00')])
+"""
+import re
+import zipfile
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from xml.sax.saxutils import escape, quoteattr
+
+from django.utils import timezone
+
+
+# Excel counts days from 1899-12-30 (the 1900 leap year bug included)
+EPOCH = datetime(1899, 12, 30)
+
+MAX_SHEET_TITLE = 31
+
+# Compressed bytes collected before stream_workbook yields them
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Style indexes into STYLES_XML's cellXfs
+DEFAULT, DATETIME, BOLD, AMOUNT, BOLD_AMOUNT, DATE = range(6)
+
+CONTENT_TYPES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '{sheets}'
+    '</Types>'
+)
+
+SHEET_CONTENT_TYPE = (
+    '<Override PartName="/xl/worksheets/sheet{index}.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+)
+
+ROOT_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+WORKBOOK_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets>{sheets}</sheets>'
+    '</workbook>'
+)
+
+WORKBOOK_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '{sheets}'
+    '<Relationship Id="rIdStyles" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    '</Relationships>'
+)
+
+SHEET_RELATIONSHIP = (
+    '<Relationship Id="rId{index}" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet{index}.xml"/>'
+)
+
+STYLES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<numFmts count="2">'
+    '<numFmt numFmtId="164" formatCode="yyyy-mm-dd hh:mm"/>'
+    '<numFmt numFmtId="165" formatCode="yyyy-mm-dd"/>'
+    '</numFmts>'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="6">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+    '<xf numFmtId="4" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="4" fontId="1" fillId="0" borderId="0" xfId="0" applyNumberFormat="1" applyFont="1"/>'
+    '<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '</cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+SHEET_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<sheetViews><sheetView workbookViewId="0" rightToLeft="1">'
+    '<pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/>'
+    '</sheetView></sheetViews>'
+)
+
+SHEET_TAIL = '</sheetData></worksheet>'
+
+# Characters XML 1.0 can't carry
+ILLEGAL_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+ILLEGAL_TITLE_CHARS = re.compile(r'[\[\]:*?/\\]')
+
+
+class BoldRow(list):
+    """Row written in bold, for headers and totals"""
+
+
+def column_letter(index):
+    """Spreadsheet column name of a 0-based column index: 0 -> A, 26 -> AA"""
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def excel_serial(value, tz=None):
+    """Days since Excel's epoch, aware datetimes converted to `tz` (the current time zone)"""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = timezone.make_naive(value, tz or timezone.get_current_timezone())
+    else:
+        value = datetime(value.year, value.month, value.day)
+    return (value - EPOCH).total_seconds() / 86400
+
+
+def _style(index):
+    return f' s="{index}"' if index else ''
+
+
+def _cell(ref, value, bold, tz):
+    kind = type(value)
+    if kind is str:
+        text = ILLEGAL_XML_CHARS.sub('', value)
+        space = ' xml:space="preserve"' if text != text.strip() else ''
+        return f'<c r="{ref}" t="inlineStr"{_style(bold and BOLD)}><is><t{space}>{escape(text)}</t></is></c>'
+    if kind is Decimal:
+        return f'<c r="{ref}" s="{BOLD_AMOUNT if bold else AMOUNT}"><v>{value}</v></c>'
+    if kind is bool:
+        return f'<c r="{ref}" t="b"{_style(bold and BOLD)}><v>{int(value)}</v></c>'
+    if kind is int or kind is float:
+        return f'<c r="{ref}"{_style(bold and BOLD)}><v>{value!r}</v></c>'
+    if isinstance(value, (datetime, date)):
+        style = DATETIME if isinstance(value, datetime) else DATE
+        return f'<c r="{ref}" s="{style}"><v>{excel_serial(value, tz)!r}</v></c>'
+    # Anything else is written as its text
+    return _cell(ref, str(value), bold, tz)
+
+
+def sheet_title(title, taken):
+    """Valid, unique sheet title: at most 31 characters, none of []:*?/\\"""
+    base = ILLEGAL_TITLE_CHARS.sub(' ', str(title)).strip()[:MAX_SHEET_TITLE] or 'Sheet'
+    candidate, counter = base, 1
+    while candidate.lower() in taken:
+        counter += 1
+        suffix = f' ({counter})'
+        candidate = base[:MAX_SHEET_TITLE - len(suffix)] + suffix
+    return candidate
+
+
+class Sheet:
+    """Rows of one worksheet, compressed into its zip entry as they are appended"""
+
+    def __init__(self, entry, widths=None):
+        self.entry = entry
+        self.rows = 0
+        # Looked up once: the current time zone and the column letters are per-cell hot paths
+        self.tz = timezone.get_current_timezone()
+        self.columns = []
+        head = SHEET_HEAD
+        if widths:
+            head += '<cols>' + ''.join(
+                f'<col min="{i}" max="{i}" width="{width}" customWidth="1"/>'
+                for i, width in enumerate(widths, start=1)
+            ) + '</cols>'
+        entry.write((head + '<sheetData>').encode())
+
+    def append(self, row):
+        """Write one row of cell values.
+
+        Decimals get the amount format, datetimes and dates a date format, None leaves the
+        cell empty. BoldRow rows are bold; the first row stays frozen on scroll.
+        """
+        self.rows += 1
+        bold = isinstance(row, BoldRow)
+        row = list(row)
+        while len(self.columns) < len(row):
+            self.columns.append(column_letter(len(self.columns)))
+        cells = ''.join([
+            _cell(f'{letter}{self.rows}', value, bold, self.tz)
+            for letter, value in zip(self.columns, row) if value is not None
+        ])
+        self.entry.write(f'<row r="{self.rows}">{cells}</row>'.encode())
+
+    def close(self):
+        self.entry.write(SHEET_TAIL.encode())
+        self.entry.close()
+
+
+class Workbook:
+    """XLSX written sheet by sheet into `output`, a binary file or any object with write().
+
+    The output doesn't need to be seekable, so a workbook can be streamed as it is built.
+    Only one sheet can be open at a time.
+    """
+
+    def __init__(self, output):
+        self.zip = zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.titles = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.zip.close()
+
+    @contextmanager
+    def sheet(self, title, widths=None):
+        """Open a new sheet, closed on exit; `widths` are column widths in characters"""
+        title = sheet_title(title, {taken.lower() for taken in self.titles})
+        self.titles.append(title)
+        sheet = Sheet(self.zip.open(f'xl/worksheets/sheet{len(self.titles)}.xml', 'w'), widths)
+        try:
+            yield sheet
+        finally:
+            sheet.close()
+
+    def write_sheet(self, title, rows, widths=None):
+        """Add a sheet holding `rows`, returns the number of rows written"""
+        with self.sheet(title, widths) as sheet:
+            for row in rows:
+                sheet.append(row)
+        return sheet.rows
+
+    def close(self):
+        """Write the workbook parts naming the sheets and finish the zip file"""
+        if not self.titles:
+            # A workbook needs at least one sheet to open
+            self.write_sheet('Sheet', [])
+        indexes = range(1, len(self.titles) + 1)
+        self.zip.writestr('[Content_Types].xml', CONTENT_TYPES_XML.format(
+            sheets=''.join(SHEET_CONTENT_TYPE.format(index=index) for index in indexes)
+        ))
+        self.zip.writestr('_rels/.rels', ROOT_RELS_XML)
+        self.zip.writestr('xl/workbook.xml', WORKBOOK_XML.format(sheets=''.join(
+            f'<sheet name={quoteattr(title)} sheetId="{index}" r:id="rId{index}"/>'
+            for index, title in zip(indexes, self.titles)
+        )))
+        self.zip.writestr('xl/_rels/workbook.xml.rels', WORKBOOK_RELS_XML.format(
+            sheets=''.join(SHEET_RELATIONSHIP.format(index=index) for index in indexes)
+        ))
+        self.zip.writestr('xl/styles.xml', STYLES_XML)
+        self.zip.close()
+
+
+class StreamBuffer:
+    """Write-only, non-seekable buffer handing back what was written since the last take()"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks, self.size = [], 0
+        return data
+
+
+def stream_workbook(sheets, chunk_size=STREAM_CHUNK_SIZE):
+    """Bytes of the workbook of (title, widths, rows) `sheets`, yielded as they are compressed"""
+    buffer = StreamBuffer()
+    workbook = Workbook(buffer)
+    for title, widths, rows in sheets:
+        with workbook.sheet(title, widths) as sheet:
+            for row in rows:
+                sheet.append(row)
+                if buffer.size >= chunk_size:
+                    yield buffer.take()
+    workbook.close()
+    yield buffer.take()